@@ -0,0 +1,88 @@
+"""
+Approximate neighbour benchmark: recall and speed of the random projection
+forest (``--neighbors``) against exact all-pairs scoring.
+
+Synthetic latent vectors are drawn around cluster centres, standardized as in
+`favapy.fava._score_pairs`, and the exact `neighbors` most correlated rows of
+every row are computed block by block. For every number of trees the script
+reports the wall time of `_approximate_neighbors` and its recall, i.e. the
+fraction of the exact neighbours it finds, and exits with a non-zero status
+if the largest forest stays below ``--min-recall``.
+
+Usage::
+
+    python benchmarks/bench_knn.py [--proteins 20000] [--dim 15] [--neighbors 10] [--trees 1 2 4 8 16]
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+from favapy import fava
+
+
+def _latent(proteins, dim, clusters, seed):
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(clusters, dim))
+    labels = rng.integers(0, clusters, size=proteins)
+    return centres[labels] + 0.5 * rng.normal(size=(proteins, dim))
+
+
+def _exact_neighbors(z, neighbors, block_size=2048):
+    indices = np.empty((z.shape[0], neighbors), dtype=np.int64)
+    for start in range(0, z.shape[0], block_size):
+        block = z[start : start + block_size] @ z.T
+        rows = np.arange(block.shape[0])
+        block[rows, rows + start] = -np.inf
+        indices[start : start + block.shape[0]] = np.argpartition(
+            -block, neighbors - 1, axis=1
+        )[:, :neighbors]
+    return indices
+
+
+def _recall(found, exact):
+    hits = sum(len(np.intersect1d(f, e)) for f, e in zip(found, exact))
+    return hits / exact.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--proteins", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=15)
+    parser.add_argument("--clusters", type=int, default=100)
+    parser.add_argument("--neighbors", type=int, default=10)
+    parser.add_argument("--trees", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--min-recall", type=float, default=0.9)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    z = fava._standardize_rows(
+        _latent(args.proteins, args.dim, args.clusters, args.seed)
+    )
+
+    start = time.perf_counter()
+    exact = _exact_neighbors(z, args.neighbors)
+    report = {"proteins": args.proteins, "exact_seconds": time.perf_counter() - start}
+
+    report["approximate"] = []
+    for n_trees in args.trees:
+        start = time.perf_counter()
+        found, _ = fava._approximate_neighbors(z, args.neighbors, n_trees=n_trees)
+        report["approximate"].append(
+            {
+                "n_trees": n_trees,
+                "seconds": time.perf_counter() - start,
+                "recall": _recall(found, exact),
+            }
+        )
+    print(json.dumps(report, indent=2))
+
+    best = max(report["approximate"], key=lambda run: run["n_trees"])
+    sys.exit(int(best["recall"] < args.min_recall))
+
+
+if __name__ == "__main__":
+    main()
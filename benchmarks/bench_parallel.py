@@ -0,0 +1,74 @@
+"""
+Parallel scoring benchmark: scaling of the shared-memory tile scorer
+(``-w``/``--num_workers``) with the number of worker processes.
+
+Synthetic latent vectors are standardized as in `favapy.fava._score_pairs`
+and the best pairs of all proteins are selected by
+`_select_pairs_parallel` with every number of workers, including the start
+of the spawned pool. The script reports the wall time of every run, its
+speed-up over one worker and its parallel efficiency (speed-up divided by the
+number of workers), and exits with a non-zero status if a run selects other
+pairs than the single worker run, or if the efficiency of a run with no more
+workers than cores falls below ``--min-efficiency``.
+
+Usage::
+
+    python benchmarks/bench_parallel.py [--proteins 20000] [--dim 45] [--workers 1 2 4 8]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from favapy import fava
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--proteins", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=45)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--interaction-count", type=int, default=100000)
+    parser.add_argument("--min-efficiency", type=float, default=0.7)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    z = fava._standardize_rows(rng.normal(size=(args.proteins, args.dim)))
+    cores = os.cpu_count()
+
+    report = {"proteins": args.proteins, "cores": cores, "runs": []}
+    reference = None
+    failed = False
+    for num_workers in sorted(set([1] + args.workers)):
+        start = time.perf_counter()
+        rows, cols, _ = fava._select_pairs_parallel(
+            z, interaction_count=args.interaction_count, num_workers=num_workers
+        )
+        seconds = time.perf_counter() - start
+        if reference is None:
+            reference = (rows, cols, seconds)
+        speedup = reference[2] / seconds
+        run = {
+            "workers": num_workers,
+            "seconds": seconds,
+            "speedup": speedup,
+            "efficiency": speedup / num_workers,
+            "same_pairs": bool(
+                np.array_equal(rows, reference[0])
+                and np.array_equal(cols, reference[1])
+            ),
+        }
+        report["runs"].append(run)
+        failed |= not run["same_pairs"]
+        failed |= num_workers <= cores and run["efficiency"] < args.min_efficiency
+    print(json.dumps(report, indent=2))
+    sys.exit(int(failed))
+
+
+if __name__ == "__main__":
+    main()
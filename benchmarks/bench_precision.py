@@ -0,0 +1,138 @@
+"""
+Precision benchmark: accuracy, memory and speed of the mixed precision modes
+(``--precision``) against full precision on the example dataset.
+
+Every precision trains a VAE with the same seed on the same data, and its
+top-k pairs are compared with the top-k pairs of the float32 run: the report
+lists the overlap of the two sets for every k, the size of the latent spaces
+and the wall time of the train, encode and score stages. Three references put
+the overlaps in perspective:
+
+* "repeat": float32 trained again with the same seed, which must reproduce
+  the float32 run exactly;
+* "seed": float32 trained with the next seed, i.e. the run-to-run variation
+  that is already there at full precision: a mixed precision mode that
+  overlaps float32 as much changes the pairs no more than a new seed does;
+* "score_only": the float32 latent spaces rounded to float16 and scored in
+  float32, i.e. the effect of the storage and scoring types alone.
+
+The script exits with a non-zero status if the repeated float32 run does not
+reproduce the top-k pairs, or if the "score_only" overlap is lower than
+``1 - --tolerance`` at the largest k.
+
+Usage::
+
+    python benchmarks/bench_precision.py [--data $DATA_DIR/Example_dataset_GSE75748_sc_cell_type_ec.tsv]
+        [--epochs 50] [--top 100 1000 10000] [--output report.json]
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+from favapy import fava
+
+PRECISIONS = ["float32", "mixed_float16", "mixed_bfloat16"]
+
+
+def _top_pairs(rows, cols, n, k):
+    return set((rows[:k].astype(np.int64) * n + cols[:k]).tolist())
+
+
+def _overlaps(pairs, reference, n, top):
+    return {
+        k: len(_top_pairs(*pairs, n, k) & _top_pairs(*reference, n, k)) / k for k in top
+    }
+
+
+def _run(path, precision, seed, epochs, interaction_count):
+    """
+    Train and score one precision as `Pipeline.embed` does, returning its
+    pairs, latent spaces and stage timings.
+    """
+    pipeline = fava.Pipeline(precision=precision)
+    pipeline.load(path, data_type="tsv")
+    pipeline.normalize()
+    x = pipeline.x
+    hidden_layer, latent_dim = fava._default_dimensions(x.shape[1])
+    latent = fava._embed(
+        x,
+        hidden_layer,
+        latent_dim,
+        epochs=epochs,
+        seed=seed,
+        stage=pipeline.stage,
+        precision=precision,
+    )
+    n = x.shape[0]
+    with pipeline.stage("score", n * (n - 1) // 2, unit="pairs"):
+        rows, cols, _ = fava._score_pairs(
+            latent,
+            interaction_count=interaction_count,
+            dtype=fava._SCORE_DTYPES[precision],
+        )
+    timings = {record["stage"]: record["seconds"] for record in pipeline.stages}
+    return (rows, cols), latent, timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument(
+        "--data",
+        default=os.path.join(
+            os.environ.get("DATA_DIR", "."),
+            "Example_dataset_GSE75748_sc_cell_type_ec.tsv",
+        ),
+    )
+    parser.add_argument("--epochs", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--top", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--tolerance", type=float, default=0.05)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    top = sorted(args.top)
+    runs = {
+        precision: _run(args.data, precision, args.seed, args.epochs, top[-1])
+        for precision in PRECISIONS
+    }
+    pairs, latent, _ = runs["float32"]
+    n = latent.shape[1]
+
+    repeat_pairs = _run(args.data, "float32", args.seed, args.epochs, top[-1])[0]
+    seed_pairs = _run(args.data, "float32", args.seed + 1, args.epochs, top[-1])[0]
+    rounded = fava._score_pairs(
+        latent.astype(np.float16), interaction_count=top[-1], dtype=np.float32
+    )[:2]
+    report = {
+        "proteins": n,
+        "references": {
+            "repeat": _overlaps(repeat_pairs, pairs, n, top),
+            "seed": _overlaps(seed_pairs, pairs, n, top),
+            "score_only": _overlaps(rounded, pairs, n, top),
+        },
+        "precisions": {
+            precision: {
+                "overlap": _overlaps(run_pairs, pairs, n, top),
+                "latent_bytes": run_latent.nbytes,
+                "seconds": timings,
+            }
+            for precision, (run_pairs, run_latent, timings) in runs.items()
+        },
+    }
+    print(json.dumps(report, indent=2))
+    if args.output is not None:
+        with open(args.output, "w") as outfile:
+            json.dump(report, outfile, indent=2)
+
+    references = report["references"]
+    reproducible = min(references["repeat"].values()) == 1.0
+    rounded_overlap = references["score_only"][top[-1]]
+    sys.exit(int(not reproducible or rounded_overlap < 1 - args.tolerance))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Startup benchmark: `import favapy.fava` and `favapy --help` must stay fast.
+
+TensorFlow, Keras, anndata, pandas and scipy are only imported when training
+or scoring actually runs. This script measures the median wall time of a
+fresh interpreter importing favapy and of the command line help, and exits
+with a non-zero status if either exceeds its budget or if a heavy dependency
+is imported eagerly.
+
+Usage::
+
+    python benchmarks/bench_startup.py [--repeat 5] [--import-budget 1.0] [--help-budget 1.5]
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = ("tensorflow", "keras", "anndata", "pandas", "scipy")
+
+
+def _median_time(command, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, capture_output=True)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--import-budget", type=float, default=1.0)
+    parser.add_argument("--help-budget", type=float, default=1.5)
+    args = parser.parse_args()
+
+    loaded = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, json, favapy.fava; "
+            f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))",
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    report = {
+        "eagerly_imported": json.loads(loaded.stdout),
+        "import_seconds": _median_time(
+            [sys.executable, "-c", "import favapy.fava"], args.repeat
+        ),
+        "help_seconds": _median_time(
+            [sys.executable, "-m", "favapy.fava", "--help"], args.repeat
+        ),
+    }
+    print(json.dumps(report, indent=2))
+
+    failed = bool(report["eagerly_imported"])
+    failed |= report["import_seconds"] > args.import_budget
+    failed |= report["help_seconds"] > args.help_budget
+    sys.exit(int(failed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""
+Benchmark suite: time and memory of every stage of a FAVA run at several
+scales, compared against stored baselines.
+
+Every case runs in a fresh interpreter, so that its peak memory is its own.
+A case generates a synthetic count matrix (dense, or sparse with 5% non-zero
+values) with the given number of features, or reads the 10x Genomics data in
+``data/filtered_gene_bc_matrices/hg19`` with ``-t mtx`` when its
+``matrix.mtx`` is present.
+Dense matrices are written to a TSV file first, so that the load stage times
+`_load_data` as the command line interface runs it. The case then runs the
+stages of `favapy.fava.Pipeline` (load, normalize, train, encode, score,
+select) and times the correlation of latent vectors of the same shape on its
+own, so that the cost of the top-k selection is the difference between the
+score and correlation stages.
+
+The report lists the wall time, throughput and peak resident memory of every
+stage. With ``--baseline`` the stages slower than ``--tolerance`` times their
+baseline, or using more than ``--memory-tolerance`` times its peak memory,
+are reported as regressions and the script exits with a non-zero status.
+Baselines depend on the machine: record them with ``--update-baseline``.
+
+Usage::
+
+    python benchmarks/bench_suite.py [--cases dense-1k sparse-10k ...] [--epochs 1]
+        [--baseline benchmarks/baselines.json] [--update-baseline] [--output report.json]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TENX_DIR = os.path.join(HERE, "..", "data", "filtered_gene_bc_matrices", "hg19")
+SCALES = {"1k": 1000, "10k": 10000, "50k": 50000}
+CASES = [f"{layout}-{scale}" for scale in SCALES for layout in ("dense", "sparse")]
+CASES.append("10x")
+
+
+def _synthetic(layout, features, samples, seed=0):
+    from scipy import sparse
+
+    rng = np.random.default_rng(seed)
+    if layout == "dense":
+        return rng.poisson(3, size=(features, samples)).astype(np.float32)
+    counts = sparse.random(
+        features, samples, density=0.05, format="csr", random_state=seed
+    )
+    counts.data = rng.poisson(5, size=counts.nnz).astype(np.float32) + 1
+    return counts
+
+
+def _run_case(case, samples, epochs, batch_size, interaction_count):
+    """
+    Run one case in the current process and return the reports of its stages.
+    """
+    import anndata
+    import pandas as pd
+    from favapy import fava
+
+    pipeline = fava.Pipeline(
+        epochs=epochs,
+        batch_size=batch_size,
+        interaction_count=interaction_count,
+        seed=0,
+    )
+    with tempfile.TemporaryDirectory() as workdir:
+        if case == "10x":
+            try:
+                pipeline.load(TENX_DIR, data_type="mtx")
+            except FileNotFoundError:
+                return None
+        else:
+            layout, scale = case.split("-")
+            counts = _synthetic(layout, SCALES[scale], samples)
+            index = [f"G{i}" for i in range(counts.shape[0])]
+            if layout == "dense":
+                path = os.path.join(workdir, "data.tsv")
+                pd.DataFrame(counts, index=index).to_csv(path, sep="\t")
+                del counts
+                pipeline.load(path, data_type="tsv")
+            else:
+                adata = anndata.AnnData(X=counts.T.tocsr())
+                adata.var.index = index
+                pipeline.load(adata)
+        try:
+            pipeline.normalize()
+            # the three latent components of the default latent space
+            dim = 3 * fava._default_dimensions(pipeline.x.shape[1])[1]
+            pipeline.embed()
+            pipeline.select()
+        finally:
+            pipeline.cleanup()
+
+    # correlation alone, on standardized latent vectors of the same shape
+    n = len(pipeline.row_names)
+    z = fava._standardize_rows(np.random.default_rng(0).normal(size=(n, dim)))
+    with pipeline.stage("correlation", n * (n - 1) // 2, unit="pairs"):
+        for _ in fava._pearson_blocks(z):
+            pass
+    return pipeline.stages
+
+
+def _compare(report, baseline, tolerance, memory_tolerance, min_seconds):
+    regressions = []
+    for case, stages in report.items():
+        for stage in stages or []:
+            reference = baseline.get(case, {}).get(stage["stage"])
+            if reference is None:
+                continue
+            slow = stage["seconds"] > tolerance * max(reference["seconds"], min_seconds)
+            heavy = (
+                stage["peak_rss_mib"] is not None
+                and reference["peak_rss_mib"] is not None
+                and stage["peak_rss_mib"] > memory_tolerance * reference["peak_rss_mib"]
+            )
+            if slow or heavy:
+                regressions.append(
+                    dict(
+                        case=case,
+                        stage=stage["stage"],
+                        seconds=stage["seconds"],
+                        peak_rss_mib=stage["peak_rss_mib"],
+                        baseline=reference,
+                    )
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--cases", nargs="+", default=CASES, choices=CASES)
+    parser.add_argument("--samples", type=int, default=200)
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--interaction-count", type=int, default=100000)
+    parser.add_argument("--baseline", default=os.path.join(HERE, "baselines.json"))
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=1.5)
+    parser.add_argument("--memory-tolerance", type=float, default=1.25)
+    parser.add_argument(
+        "--min-seconds",
+        type=float,
+        default=0.5,
+        help="Stages faster than this in the baseline are compared to it instead.",
+    )
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--case", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case is not None:
+        # worker mode: run a single case and print its stages
+        stages = _run_case(
+            args.case,
+            args.samples,
+            args.epochs,
+            args.batch_size,
+            args.interaction_count,
+        )
+        print(json.dumps(stages))
+        return
+
+    report = {}
+    for case in args.cases:
+        start = time.perf_counter()
+        result = subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                "--case",
+                case,
+                "--samples",
+                str(args.samples),
+                "--epochs",
+                str(args.epochs),
+                "--batch-size",
+                str(args.batch_size),
+                "--interaction-count",
+                str(args.interaction_count),
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        report[case] = json.loads(result.stdout.strip().splitlines()[-1])
+        status = "skipped" if report[case] is None else "done"
+        print(
+            f"{case}: {status} in {time.perf_counter() - start:.1f} s", file=sys.stderr
+        )
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as infile:
+            baseline = json.load(infile)
+    regressions = _compare(
+        report, baseline, args.tolerance, args.memory_tolerance, args.min_seconds
+    )
+    summary = {"cases": report, "regressions": regressions}
+    print(json.dumps(summary, indent=2))
+    if args.output is not None:
+        with open(args.output, "w") as outfile:
+            json.dump(summary, outfile, indent=2)
+
+    if args.update_baseline:
+        for case, stages in report.items():
+            if stages is not None:
+                baseline[case] = {
+                    stage["stage"]: {
+                        key: stage[key] for key in ("seconds", "peak_rss_mib")
+                    }
+                    for stage in stages
+                }
+        with open(args.baseline, "w") as outfile:
+            json.dump(baseline, outfile, indent=2, sort_keys=True)
+            outfile.write("\n")
+    sys.exit(int(bool(regressions) and not args.update_baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -24,8 +24,15 @@ setuptools.setup(
     ],
     package_dir={"": "src"},
     packages=setuptools.find_packages(where="src"),
-    python_requires=">=3.7",
-    install_requires=["tensorflow", "keras", "numpy", "pandas", "anndata"],
+    python_requires=">=3.9",
+    install_requires=[
+        "tensorflow>=2.16",
+        "keras>=3",
+        "numpy",
+        "pandas",
+        "scipy",
+        "anndata",
+    ],
     extras_require={
         "test": [
             "pytest",
@@ -34,5 +41,8 @@ setuptools.setup(
         "docs": [
             "nbsphinx",
         ],
+        "parquet": [
+            "pyarrow",
+        ],
     },
 )
@@ -0,0 +1,81 @@
+"""
+Row batching helpers shared by the pipeline (`favapy.fava`) and the model
+(`favapy.vae`). They only need numpy and scipy, so importing them does not
+import TensorFlow.
+"""
+
+import numpy as np
+
+
+def _row_batches(
+    x, batch_size, shuffle=False, block_rows=None, transform=None, mask=None
+):
+    """
+    Yield the rows of `x` as dense float32 mini-batches.
+
+    `x` is read in contiguous blocks of `block_rows` rows, which suits
+    memory-mapped and chunked on-disk arrays. Shuffling permutes the order of
+    the blocks and of the rows within each block. Sparse rows are only
+    densified one mini-batch at a time.
+
+    Parameters
+    ----------
+    x : array-like or scipy.sparse.csr_matrix
+        Row-indexable data with one row per protein.
+    batch_size : int
+        Number of rows per batch.
+    shuffle : bool, optional
+        Whether to shuffle the rows, by default False.
+    block_rows : int, optional
+        Number of rows read at once, by default all of them.
+    transform : callable, optional
+        Called as ``transform(block, start)`` on every dense block read from
+        `x`, e.g. to normalize it.
+    mask : np.ndarray, optional
+        Boolean array selecting the rows to yield, by default all of them.
+
+    Yields
+    ------
+    np.ndarray
+        A mini-batch of rows.
+    """
+    from scipy.sparse import issparse
+
+    n = x.shape[0]
+    if block_rows is None:
+        block_rows = n
+    starts = np.arange(0, n, block_rows)
+    if shuffle:
+        np.random.shuffle(starts)
+    for start in starts:
+        block = x if block_rows >= n else x[start : start + block_rows]
+        if not issparse(block):
+            block = np.array(block, dtype=np.float32)
+            if transform is not None:
+                block = transform(block, start)
+        if mask is not None:
+            block = block[mask[start : start + block.shape[0]]]
+        order = np.arange(block.shape[0])
+        if shuffle:
+            np.random.shuffle(order)
+        for batch_start in range(0, order.shape[0], batch_size):
+            batch = block[order[batch_start : batch_start + batch_size]]
+            if issparse(batch):
+                batch = batch.toarray().astype(np.float32)
+            yield batch
+
+
+def _encode_into(encoder, blocks, out, batch_size=32):
+    """
+    Encode blocks of rows and write the latent vectors into `out`, an array
+    of shape (outputs, rows, latent dimension), without stacking the outputs
+    of the encoder into intermediate copies.
+    """
+    start = 0
+    for block in blocks:
+        stop = start + block.shape[0]
+        outputs = encoder.predict(block, batch_size=batch_size, verbose=0)
+        for i, output in enumerate(outputs):
+            out[i, start:stop] = output
+        start = stop
+    return out
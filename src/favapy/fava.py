@@ -4,24 +4,38 @@ import warnings
 
 warnings.filterwarnings("ignore")
 
+import contextlib
+import gzip
+import hashlib
+import json
 import os
-import anndata
-import tensorflow as tf
-import keras
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+import multiprocessing as mp
+from multiprocessing import shared_memory
 import numpy as np
-import pandas as pd
-from keras import layers
-from keras import backend as K
 
+from favapy._batches import _encode_into, _row_batches
+
+# TensorFlow, Keras, anndata, pandas and scipy are imported where they are
+# needed, so that `import favapy` and `favapy --help` stay fast.
 
-config = tf.compat.v1.ConfigProto()
-config.intra_op_parallelism_threads = 1
-config.inter_op_parallelism_threads = 1
-tf.compat.v1.Session(config=config)
 
 logger = logging.getLogger().setLevel(logging.INFO)
 
 
+def __getattr__(name):
+    # the model classes need TensorFlow, which is only imported on first use
+    if name in ("VAE", "Sampling"):
+        from favapy import vae
+
+        return getattr(vae, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 def custom_formatwarning(msg, *args, **kwargs):
     # ignore everything except the message
     return str(msg) + "\n"
@@ -30,9 +44,10 @@ def custom_formatwarning(msg, *args, **kwargs):
 warnings.formatwarning = custom_formatwarning
 
 
-def argument_parser():
+def argument_parser(argv=None):
     parser = argparse.ArgumentParser(
-        description="Infer Functional Associations using Variational Autoencoders on -Omics data."
+        description="Infer Functional Associations using Variational Autoencoders on -Omics data.",
+        epilog="To run many inputs in one process pool, see: favapy batch --help. To update a network saved with --save_dir, see: favapy update --help.",
     )
     parser.add_argument("input_file", type=str, help="The absolute path of the data.")
     parser.add_argument(
@@ -43,15 +58,22 @@ def argument_parser():
         "--data_type",
         type=str,
         default="tsv",
-        choices=["tsv", "csv"],
-        help="Type of input data.",
+        choices=["tsv", "csv", "mtx", "h5ad"],
+        help="Type of input data: a delimited text file with one row per protein, a 10x Genomics matrix directory (mtx), or an AnnData file (h5ad).",
+    )
+    parser.add_argument(
+        "--normalization",
+        type=str,
+        default="minmax",
+        choices=["minmax", "max"],
+        help="How every protein is scaled after the log2 transform: to [0, 1] (minmax) or by its maximum (max, as fava.cook does).",
     )
     parser.add_argument(
         "-n",
         dest="interaction_count",
         type=int,
-        default=100000,
-        help="The number of interactions in the output file.",
+        default=None,
+        help="The number of interactions in the output file. Defaults to 100000, or to all the neighbour pairs with --neighbors.",
     )
     parser.add_argument(
         "-c",
@@ -76,6 +98,29 @@ def argument_parser():
     parser.add_argument(
         "-b", dest="batch_size", type=int, default=32, help="batch_size"
     )
+    parser.add_argument(
+        "--validation_split",
+        type=float,
+        default=0.0,
+        help="Fraction of the proteins held out to validate the model after every epoch.",
+    )
+    parser.add_argument(
+        "--early_stopping",
+        action="store_true",
+        help="Stop training once the (validation) loss stops improving.",
+    )
+    parser.add_argument(
+        "--patience",
+        type=int,
+        default=5,
+        help="Epochs without improvement before stopping early.",
+    )
+    parser.add_argument(
+        "--min_delta",
+        type=float,
+        default=0.0,
+        help="Minimum decrease of the loss counted as an improvement.",
+    )
     parser.add_argument(
         "-cor",
         "--correlation_type",
@@ -84,14 +129,148 @@ def argument_parser():
         choices=["pearson", "spearman"],
         help="Type of correlation to use (Pearson or Spearman).",
     )
+    parser.add_argument(
+        "--latent_components",
+        type=str,
+        default="all",
+        choices=["mean", "mean_sigma", "all"],
+        help="Latent components that are correlated: the means, the means and log-sigmas, or all three outputs of the encoder.",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="float32",
+        choices=["float32", "mixed_float16", "mixed_bfloat16"],
+        help="Train with a Keras mixed precision policy, keep the latent spaces in float16 and compute the correlations in float32.",
+    )
+    parser.add_argument(
+        "--upper_triangle",
+        action="store_true",
+        help="Report every interaction once (proteinA-proteinB) and count -n in unique pairs.",
+    )
+    parser.add_argument(
+        "--mirror",
+        action="store_true",
+        help="With --upper_triangle, also report proteinB-proteinA for every interaction.",
+    )
+    parser.add_argument(
+        "--neighbors",
+        type=int,
+        default=None,
+        help="Approximate mode: only score every protein against its N approximate nearest neighbours, and report all these pairs unless -n or -c is given.",
+    )
+    parser.add_argument(
+        "--n_trees",
+        type=int,
+        default=8,
+        help="Number of random projection trees of the approximate mode (more is slower but more exact).",
+    )
+    parser.add_argument(
+        "--query",
+        type=str,
+        default=None,
+        help="File with one protein of interest per line: only their correlations with all proteins are computed, and -n counts the partners of every query protein.",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Seed of the random number generators used for training.",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Directory where trained embeddings are cached and reused.",
+    )
+    parser.add_argument(
+        "--save_dir",
+        type=str,
+        default=None,
+        help="Directory where the model, latent spaces and interactions are saved for later incremental updates (see: favapy update --help).",
+    )
+    parser.add_argument(
+        "--num_threads",
+        type=str,
+        default=None,
+        help="Number of TensorFlow threads used within each operation during training, or 'auto' for all cores. Operations run at most 2 at a time (min(num_threads, 2) inter-op threads), since the layers of the VAE run one after another. Defaults to $FAVAPY_NUM_THREADS or 'auto'.",
+    )
+    parser.add_argument(
+        "-w",
+        "--num_workers",
+        type=int,
+        default=1,
+        help="Number of processes used to score the interactions.",
+    )
+    parser.add_argument(
+        "--ensemble",
+        type=int,
+        default=1,
+        help="Number of models trained with consecutive seeds whose networks are merged into a consensus network.",
+    )
+    parser.add_argument(
+        "--ensemble_workers",
+        type=int,
+        default=None,
+        help="Number of ensemble models trained at once in separate processes.",
+    )
+    parser.add_argument(
+        "-f",
+        "--output_format",
+        type=str,
+        default=None,
+        choices=["txt", "tsv", "parquet", "feather", "npz"],
+        help="Format of the output file. Defaults to the format of its extension (.tsv, .tsv.gz, .parquet, .feather, .npz), or 'txt'.",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help="Path of a JSON report with the wall time, peak memory and throughput of every stage.",
+    )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     return args
 
 
-def _load_data(input_file, data_type):
+def _open_binary(input_file):
+    """
+    Open a file for binary reading, decompressing it on the fly if it ends
+    with ``.gz``.
+    """
+    if str(input_file).endswith(".gz"):
+        return gzip.open(input_file, "rb")
+    return open(input_file, "rb")
+
+
+def _data_shape(input_file, sep, chunk_bytes=2**24):
     """
-    Loads and preprocesses data from a file.
+    Count the data rows (all lines after the header) and the value columns of
+    a delimited text file, without parsing the values.
+    """
+    with _open_binary(input_file) as infile:
+        infile.readline()
+        first_line = infile.readline()
+        n_cols = len(first_line.decode("utf-8").split(sep)) - 1
+        n_rows = first_line.count(b"\n")
+        last = first_line[-1:]
+        for chunk in iter(lambda: infile.read(chunk_bytes), b""):
+            n_rows += chunk.count(b"\n")
+            last = chunk[-1:]
+    if last and last != b"\n":
+        n_rows += 1
+    return n_rows, n_cols
+
+
+def _load_data(input_file, data_type, chunk_size=10000):
+    """
+    Loads data from a file.
+
+    The values are parsed with the C parser of pandas in chunks of
+    `chunk_size` rows, directly into a preallocated float32 array, so that
+    peak memory stays close to the size of the final array. Files ending with
+    ``.gz`` are decompressed on the fly. The values are not normalized, see
+    `_normalize`.
 
     Parameters
     ----------
@@ -99,461 +278,3349 @@ def _load_data(input_file, data_type):
         Path to the input file.
     data_type : str
         Type of the data file ('tsv' or 'csv').
+    chunk_size : int, optional
+        Number of rows parsed at once, by default 10000.
 
     Returns
     -------
     expr : np.ndarray
-        Processed data array.
+        Data array.
     row_names : list
         List of row names corresponding to the data.
     """
+    import pandas as pd
+
+    sep = "\t" if data_type == "tsv" else ","
+    n_rows, n_cols = _data_shape(input_file, sep)
+    columns = range(1, n_cols + 1)
+
+    expr = np.empty((n_rows, n_cols), dtype=np.float32)
     row_names = []
-    array = []
-    with open(input_file, "r", encoding="utf-8") as infile:
-        next(infile)
-        for line in infile:
-            if data_type == "tsv":
-                line = line.split("\t")
-            else:
-                line = line.split(",")
-            row_names.append(line[0])
-            array.append(line[1:])
+    reader = pd.read_csv(
+        input_file,
+        sep=sep,
+        header=None,
+        skiprows=1,
+        index_col=0,
+        engine="c",
+        chunksize=chunk_size,
+        dtype={0: str, **{column: np.float32 for column in columns}},
+        keep_default_na=False,
+        na_values={column: ["nan", "NaN", "NAN"] for column in columns},
+        compression="infer",
+    )
+    start = 0
+    with reader:
+        for chunk in reader:
+            stop = start + len(chunk)
+            expr[start:stop] = chunk.to_numpy(dtype=np.float32)
+            row_names.extend(chunk.index)
+            start = stop
+    return expr[:start], row_names
 
-    expr = np.asarray(array, dtype=np.float32)
 
-    if np.all(expr >= 0):
-        expr = np.log2(1 + expr[:])
-    else:
-        logging.warn(
-            " Negative values are detected, so log2 normalization is not applied."
-        )
+def _find_file(directory, names):
+    """
+    Path of the first of `names` (or of its gzip-compressed version) found in
+    `directory`.
+    """
+    for name in names:
+        for candidate in (name, name + ".gz"):
+            path = os.path.join(directory, candidate)
+            if os.path.exists(path):
+                return path
+    raise FileNotFoundError(f"None of {', '.join(names)} found in {directory}")
 
-    # expr = expr / np.max(expr, axis=1, keepdims=True)
-    constant = 1e-8  # small constant to avoid division by zero
-    expr = (expr - np.min(expr, axis=1, keepdims=True)) / (
-        np.max(expr, axis=1, keepdims=True)
-        - np.min(expr, axis=1, keepdims=True)
-        + constant
-    )
-    expr = np.nan_to_num(expr)
-    return expr, row_names
+
+def _make_unique(names, join="-"):
+    """
+    Make `names` unique as anndata's ``var_names_make_unique`` does: the
+    first occurrence of a name is kept and the following ones get the
+    suffixes ``-1``, ``-2``, ..., skipping names that are already taken.
+    """
+    counts = {}
+    for name in names:
+        counts[name] = counts.get(name, 0) + 1
+    if all(count == 1 for count in counts.values()):
+        return list(names)
+    taken = set(names)
+    seen = {}
+    unique = []
+    for name in names:
+        if counts[name] == 1 or name not in seen:
+            seen[name] = 0
+            unique.append(name)
+            continue
+        suffix = seen[name]
+        while True:
+            suffix += 1
+            candidate = f"{name}{join}{suffix}"
+            if candidate not in taken:
+                break
+        seen[name] = suffix
+        taken.add(candidate)
+        unique.append(candidate)
+    return unique
 
 
-class VAE(keras.Model):
+def _load_mtx(input_path):
     """
-    Variational Autoencoder model class.
+    Loads a 10x Genomics matrix as a sparse matrix with one row per gene.
 
     Parameters
     ----------
-    opt : tf.keras.optimizers.Optimizer
-        Optimizer for the model.
-    x_train : np.ndarray
-        Training data.
-    x_test : np.ndarray
-        Test data.
-    batch_size : int
-        Batch size for training.
-    original_dim : int
-        Dimension of the input data.
-    hidden_layer : int
-        Number of units in the hidden layer.
-    latent_dim : int
-        Dimension of the latent space.
-    epochs : int
-        Number of training epochs.
-    """
-
-    def __init__(
-        self,
-        opt,
-        x_train,
-        x_test,
-        batch_size,
-        original_dim,
-        hidden_layer,
-        latent_dim,
-        epochs,
-    ):
-        super(VAE, self).__init__()
-        inputs = keras.Input(shape=(original_dim,))
-        h = layers.Dense(hidden_layer, activation="relu")(inputs)
-
-        z_mean = layers.Dense(latent_dim)(h)
-        z_log_sigma = layers.Dense(latent_dim)(h)
-
-        # Sampling
-        def sampling(args):
-            z_mean, z_log_sigma = args
-            epsilon = K.random_normal(
-                shape=(K.shape(z_mean)[0], latent_dim), mean=0.0, stddev=0.1
-            )
-            return z_mean + K.exp(z_log_sigma) * epsilon
-
-        # z = layers.Lambda(sampling)([z_mean, z_log_sigma])
-        z = layers.Lambda(sampling, output_shape=(latent_dim,))([z_mean, z_log_sigma])
-
-        # Create encoder
-        encoder = keras.Model(inputs, [z_mean, z_log_sigma, z], name="encoder")
-        self.encoder = encoder
-        # Create decoder
-        latent_inputs = keras.Input(shape=(latent_dim,), name="z_sampling")
-        x = layers.Dense(hidden_layer, activation="relu")(latent_inputs)  # relu
-
-        outputs = layers.Dense(original_dim, activation="sigmoid")(x)
-        decoder = keras.Model(latent_inputs, outputs, name="decoder")
-        self.decoder = decoder
-
-        # instantiate VAE model
-        outputs = decoder(encoder(inputs)[2])
-        vae = keras.Model(inputs, outputs, name="vae_mlp")
-
-        # loss
-        reconstruction_loss = keras.losses.mean_squared_error(inputs, outputs)
-        reconstruction_loss *= original_dim
-        kl_loss = 1 + z_log_sigma - K.square(z_mean) - K.exp(z_log_sigma)
-        kl_loss = K.sum(kl_loss, axis=-1)
-        kl_loss *= -0.5
-        vae_loss = K.mean(0.9 * (reconstruction_loss) + 0.1 * (kl_loss))
-        vae.add_loss(vae_loss)
-
-        vae.compile(optimizer=opt, loss="mean_squared_error", metrics=["accuracy"])
-        vae.fit(
-            x_train,
-            x_train,
-            batch_size=batch_size,
-            epochs=epochs,
-            validation_data=(x_test, x_test),
+    input_path : str
+        Directory holding ``matrix.mtx``, ``genes.tsv`` (or ``features.tsv``)
+        and ``barcodes.tsv``, possibly gzip-compressed, or the path of the
+        ``matrix.mtx`` file itself.
+
+    Returns
+    -------
+    expr : scipy.sparse.csr_matrix
+        float32 matrix of shape (genes, barcodes).
+    row_names : list
+        Gene symbols (the second column of the genes file), or gene IDs when
+        the file only has one column. Symbols are not unique, so repeated
+        ones are made unique with `_make_unique` (``TBCE``, ``TBCE-1``, ...).
+    """
+    import pandas as pd
+    from scipy.io import mmread
+
+    directory = input_path
+    if not os.path.isdir(input_path):
+        directory = os.path.dirname(os.path.abspath(input_path))
+    matrix = input_path
+    if os.path.isdir(input_path):
+        matrix = _find_file(directory, ["matrix.mtx"])
+
+    with _open_binary(matrix) as infile:
+        expr = mmread(infile).tocsr().astype(np.float32)
+    genes = pd.read_csv(
+        _find_file(directory, ["genes.tsv", "features.tsv"]),
+        sep="\t",
+        header=None,
+        dtype=str,
+    )
+    row_names = _make_unique(list(genes[1] if genes.shape[1] > 1 else genes[0]))
+    if len(row_names) != expr.shape[0]:
+        raise ValueError(
+            f"{matrix} has {expr.shape[0]} rows but there are {len(row_names)} genes"
         )
+    return expr, row_names
 
 
-######### Code for multiprocessing correlations --> slower #########
-import multiprocessing as mp
-import time
+def _use_log2(has_negative, log2_normalization=True):
+    """
+    Decide whether log2 normalization is applied and report the decision.
+    """
+    if has_negative:
+        log2_normalization = False
+        logging.warn(
+            " Negative values are detected or log2_normalization was set to False, so log2 normalization is not applied."
+        )
+    if log2_normalization == True:
+        logging.warn(" log2 normalization is applied.")
+    return log2_normalization == True
 
 
-def _calculate_correlation(sub_df, correlation_type):
-    if correlation_type == "spearman":
-        corr = sub_df.corr(method="spearman")
-    else:
-        corr_matrix = np.corrcoef(sub_df)
-        corr = pd.DataFrame(corr_matrix, index=sub_df.index, columns=sub_df.index)
-    return corr
+# Small constant of the min-max normalization, to avoid division by zero.
+_MINMAX_EPSILON = 1e-8
 
 
-def _create_protein_pairs_parallel(
-    x_test_encoded, row_names, correlation_type="pearson", num_processes=4
-):
-    start_time = time.time()
+def _normalize(x, log2_normalization=True, normalization="max", chunk_size=10000):
+    """
+    Apply log2(1 + x) and scale every row, in place.
 
-    df_x_test_encoded = pd.concat(
-        [pd.DataFrame(x_test_encoded[i, :, :]) for i in range(x_test_encoded.shape[0])],
-        axis=1,
-    )
-    df_x_test_encoded.index = row_names
+    Parameters
+    ----------
+    x : np.ndarray or scipy.sparse.csr_matrix
+        Floating point data with one row per protein. Sparse matrices are
+        normalized through their stored values only, so they stay sparse.
+    log2_normalization : bool, optional
+        Whether to apply log2 normalization, by default True. It is skipped
+        if negative values are detected.
+    normalization : str, optional
+        "max" (default) divides every row by its maximum. "minmax" scales
+        every row to [0, 1] with ``(x - min) / (max - min + 1e-8)``, as the
+        command line interface does.
+    chunk_size : int, optional
+        Number of dense rows transformed at once, by default 10000.
 
-    # Split DataFrame into chunks for parallel processing
-    chunks = [df_x_test_encoded.iloc[i::num_processes] for i in range(num_processes)]
-    print(chunks)
-    # Create a pool of processes
-    pool = mp.Pool(processes=num_processes)
+    Returns
+    -------
+    x : np.ndarray or scipy.sparse.csr_matrix
+        The normalized input.
+    """
+    from scipy.sparse import issparse
 
-    # Calculate correlations in parallel
-    results = [
-        pool.apply_async(_calculate_correlation, args=(chunk, correlation_type))
-        for chunk in chunks
-    ]
+    if normalization not in ("max", "minmax"):
+        raise ValueError(f"Unknown normalization: {normalization}")
+
+    if issparse(x):
+        values = x.data
+        if _use_log2(np.any(values < 0), log2_normalization):
+            # log2(1 + x)
+            np.log1p(values, out=values)
+            values /= values.dtype.type(np.log(2))
+        row_max = x.max(axis=1).toarray().ravel()
+        if normalization == "minmax":
+            # the minimum of a row is 0 unless all its values are stored, in
+            # which case it can be subtracted from the stored values only
+            counts = np.diff(x.indptr)
+            row_min = x.min(axis=1).toarray().ravel()
+            if np.any((row_min != 0) & (counts < x.shape[1])):
+                raise ValueError(
+                    "minmax normalization of sparse rows with a negative minimum would make them dense"
+                )
+            values -= np.repeat(row_min.astype(values.dtype), counts)
+            row_max = row_max - row_min + _MINMAX_EPSILON
+        with np.errstate(divide="ignore"):
+            scale = 1 / row_max
+        scale[~np.isfinite(scale)] = 0
+        values *= np.repeat(scale.astype(values.dtype), np.diff(x.indptr))
+        return x
+
+    blocks = [x[start : start + chunk_size] for start in range(0, len(x), chunk_size)]
+    has_negative = any(bool(np.any(block < 0)) for block in blocks)
+    log2_normalization = _use_log2(has_negative, log2_normalization)
+    for block in blocks:
+        if log2_normalization:
+            # log2(1 + x)
+            np.log1p(block, out=block)
+            block /= block.dtype.type(np.log(2))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if normalization == "minmax":
+                low = np.min(block, axis=1, keepdims=True)
+                block -= low
+                block /= np.max(block, axis=1, keepdims=True) + _MINMAX_EPSILON
+            else:
+                block /= np.max(block, axis=1, keepdims=True)
+        np.nan_to_num(block, copy=False)
+    return x
 
-    correlations = pd.DataFrame(columns=row_names, index=row_names)
-    for r in results:
-        corr_chunk = r.get()
-        for idx in corr_chunk.index:
-            correlations.loc[idx, corr_chunk.columns] = corr_chunk.loc[idx, :]
 
-    pool.close()
-    pool.join()
+def _is_out_of_core(data):
+    """
+    Whether `data` is an on-disk matrix that should be streamed instead of
+    loaded: a path, a backed AnnData object, a `np.memmap` or a Zarr array.
+    """
+    import anndata
 
-    threshold = 0.85
-    threshold_decrement = 0.05
-    max_iterations = 5
+    if isinstance(data, (str, os.PathLike)):
+        return True
+    if isinstance(data, anndata.AnnData):
+        return data.isbacked
+    return isinstance(data, np.memmap) or type(data).__module__.startswith("zarr")
 
-    for _ in range(max_iterations):
-        high_corr = correlations.where(
-            (np.abs(correlations) > threshold) & (np.abs(correlations) < 1)
-        )
 
-        if high_corr.stack().empty:
-            threshold -= threshold_decrement  # Decrease the threshold
-            print(
-                f"No correlations above threshold. Decreasing threshold to {threshold}"
-            )
-            if threshold <= 0:
-                print("Threshold reached 0. No further reduction possible.")
-                break
+def _open_out_of_core(data, workdir, chunk_size=4096):
+    """
+    Open an on-disk matrix as a row-indexable array with one row per protein.
+
+    ``.npy`` files, memmaps and Zarr arrays are used as they are and must hold
+    one row per protein, like the files read by the command line interface.
+    Backed AnnData objects (or ``.h5ad`` paths) hold one row per cell, so
+    they are transposed, `chunk_size` cells at a time, into a memory-mapped
+    ``.npy`` file in `workdir`.
+
+    Parameters
+    ----------
+    data : str, os.PathLike, np.memmap, zarr.Array or anndata.AnnData
+        The on-disk matrix or its path (``.npy``, ``.h5ad`` or a Zarr store).
+    workdir : str
+        Directory for the transposed copy of backed AnnData objects.
+    chunk_size : int, optional
+        Number of cells transposed at once, by default 4096.
+
+    Returns
+    -------
+    x : array-like
+        Row-indexable matrix with one row per protein.
+    row_names : list
+        List of row names corresponding to the data.
+    """
+    import anndata
+    from scipy.sparse import issparse
+
+    if isinstance(data, (str, os.PathLike)):
+        path = str(data)
+        if path.endswith(".npy"):
+            data = np.load(path, mmap_mode="r")
+        elif path.endswith(".h5ad"):
+            data = anndata.read_h5ad(path, backed="r")
         else:
-            correlation_df = high_corr.stack().reset_index()
-            print(f"Correlations found above threshold {threshold}.")
-            end_time = time.time()
-            break
+            import zarr
+
+            data = zarr.open(path, mode="r")
 
-    total_time = end_time - start_time
-    print(f"Total time taken: {total_time} seconds")
-    correlation_df.columns = ["Protein_1", "Protein_2", "Score"]
+    if not isinstance(data, anndata.AnnData):
+        return data, [str(i) for i in range(data.shape[0])]
+
+    x = np.lib.format.open_memmap(
+        os.path.join(workdir, "x.npy"),
+        mode="w+",
+        dtype=np.float32,
+        shape=(data.n_vars, data.n_obs),
+    )
+    for start in range(0, data.n_obs, chunk_size):
+        block = data.X[start : start + chunk_size]
+        if issparse(block):
+            block = block.toarray()
+        x[:, start : start + block.shape[0]] = block.T
+    x.flush()
+    return x, list(data.var.index)
 
-    return correlation_df
 
+def _row_scale(x, log2_normalization=True, normalization="max", block_rows=4096):
+    """
+    Compute the per-row scaling of `_normalize` with one streaming pass over
+    an on-disk matrix.
 
-###################################################################################################
+    Returns
+    -------
+    log2_normalization : bool
+        Whether log2 normalization has to be applied.
+    offset, scale : np.ndarray
+        Value subtracted from every row after the optional log2 transform,
+        and factor applied afterwards.
+    """
+    row_min = np.empty(x.shape[0], dtype=np.float32)
+    row_max = np.empty(x.shape[0], dtype=np.float32)
+    has_negative = False
+    for start in range(0, x.shape[0], block_rows):
+        block = np.asarray(x[start : start + block_rows], dtype=np.float32)
+        has_negative |= bool(np.any(block < 0))
+        row_min[start : start + block.shape[0]] = block.min(axis=1)
+        row_max[start : start + block.shape[0]] = block.max(axis=1)
+
+    log2_normalization = _use_log2(has_negative, log2_normalization)
+    if log2_normalization:
+        row_min, row_max = np.log2(1 + row_min), np.log2(1 + row_max)
+    if normalization == "minmax":
+        offset = row_min
+        row_max = row_max - row_min + np.float32(_MINMAX_EPSILON)
+    else:
+        offset = np.zeros_like(row_min)
+    with np.errstate(divide="ignore"):
+        scale = 1 / row_max
+    scale[~np.isfinite(scale)] = 0
+    return log2_normalization, offset, scale
 
 
-def _create_protein_pairs(x_test_encoded, row_names, correlation_type="pearson"):
+def _row_dataset(x, batch_size, shuffle=False, **kwargs):
     """
-    Create pairs of proteins based on their encoded latent spaces.
+    Wrap `_row_batches` in a prefetching `tf.data.Dataset`.
 
     Parameters
     ----------
-    x_test_encoded : np.ndarray
-        Encoded latent spaces.
-    row_names : list
-        List of row names corresponding to the data.
-    correlation_type : str
-        Type of correlation to use (Pearson or Spearman).
+    x : array-like or scipy.sparse.csr_matrix
+        Row-indexable data with one row per protein.
+    batch_size : int
+        Number of rows per batch.
+    shuffle : bool, optional
+        Whether to reshuffle the rows at every pass, by default False.
+    **kwargs
+        Passed to `_row_batches`.
 
     Returns
     -------
-    correlation_df : pd.DataFrame
-        DataFrame containing protein pairs and correlation scores.
+    dataset : tf.data.Dataset
     """
-    start_time = time.time()
-    # Concatenate latent spaces
-    df_x_test_encoded_0 = pd.DataFrame(x_test_encoded[0, :, :])
-    df_x_test_encoded_1 = pd.DataFrame(x_test_encoded[1, :, :])
-    df_x_test_encoded_2 = pd.DataFrame(x_test_encoded[2, :, :])
+    import tensorflow as tf
 
-    df_x_test_encoded_01 = pd.merge(
-        df_x_test_encoded_0, df_x_test_encoded_1, left_index=True, right_index=True
-    )
-    df_x_test_encoded = pd.merge(
-        df_x_test_encoded_01, df_x_test_encoded_2, left_index=True, right_index=True
+    dataset = tf.data.Dataset.from_generator(
+        lambda: _row_batches(x, batch_size, shuffle, **kwargs),
+        output_signature=tf.TensorSpec(shape=(None, x.shape[1]), dtype=tf.float32),
     )
+    # every block ends with its own, possibly partial, batch
+    n = x.shape[0]
+    block_rows = kwargs.get("block_rows") or max(n, 1)
+    mask = kwargs.get("mask")
+    n_batches = 0
+    for start in range(0, n, block_rows):
+        if mask is None:
+            rows = min(block_rows, n - start)
+        else:
+            rows = np.count_nonzero(mask[start : start + block_rows])
+        n_batches += -(-rows // batch_size)
+    dataset = dataset.apply(tf.data.experimental.assert_cardinality(n_batches))
+    return dataset.prefetch(tf.data.AUTOTUNE)
 
-    df_x_test_encoded = np.asarray(df_x_test_encoded)
-
-    # Correlation of the latent space: Pearson or Spearman
-    if correlation_type == "spearman":
-        corr = pd.DataFrame(df_x_test_encoded.T).corr(method="spearman")
-        corr.columns = corr.index = row_names
-    else:
-        corr = np.corrcoef(df_x_test_encoded)
-        corr = pd.DataFrame(corr, columns=row_names, index=row_names)
-
-    correlation_df = corr.stack().reset_index()
 
-    end_time = time.time()
-    total_time = end_time - start_time
-    print(f"Total time taken OLD: {total_time} seconds")
-    correlation_df.columns = ["Protein_1", "Protein_2", "Score"]
-    return correlation_df
+def _encode_to_memmap(encoder, blocks, shape, path, batch_size=32, dtype=np.float32):
+    """
+    Encode blocks of rows and write the latent vectors to a memory-mapped
+    ``.npy`` file of the given `shape` (outputs, rows, latent dimension) and
+    `dtype`.
+    """
+    encoded = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+    _encode_into(encoder, blocks, encoded, batch_size)
+    encoded.flush()
+    return encoded
 
 
-def _pairs_after_cutoff(correlation, interaction_count=100000, CC_cutoff=None):
+def _content_hash(x, block_rows=None, transform=None):
     """
-    Filter protein pairs based on correlation scores and cutoffs.
+    Hash the values of a (normalized) matrix, reading it block by block.
 
     Parameters
     ----------
-    correlation : pd.DataFrame
-        DataFrame containing protein pairs and correlation scores.
-    interaction_count : int, optional
-        Maximum number of interactions to include, by default 100000.
-    CC_cutoff : float, optional
-        Correlation Coefficient cutoff, by default None.
+    x : array-like or scipy.sparse.csr_matrix
+        Row-indexable data with one row per protein.
+    block_rows : int, optional
+        Number of rows hashed at once, by default all of them.
+    transform : callable, optional
+        Called as ``transform(block, start)`` on a copy of every block before
+        it is hashed, as in `_row_batches`.
 
     Returns
     -------
-    correlation_df_new : pd.DataFrame
-        Filtered DataFrame with selected protein pairs.
+    digest : str
     """
-    if CC_cutoff is not None and isinstance(CC_cutoff, (int, float)):
-        logging.info(" A cut-off of " + str(CC_cutoff) + " is applied.")
-        correlation_df_new = correlation.loc[(correlation["Score"] >= CC_cutoff)]
-    else:
-        correlation_df_new = correlation.iloc[:interaction_count, :]
-        logging.warn(
-            " The number of interactions in the output file is "
-            + str(interaction_count)
-            + " in which both directions are included: proteinA - proteinB and proteinB - proteinA."
+    from scipy.sparse import issparse
+
+    digest = hashlib.sha256(repr(tuple(x.shape)).encode())
+    if issparse(x):
+        for part in (x.indptr, x.indices, x.data):
+            digest.update(np.ascontiguousarray(part))
+        return digest.hexdigest()
+
+    block_rows = block_rows or max(x.shape[0], 1)
+    for start in range(0, x.shape[0], block_rows):
+        block = x[start : start + block_rows]
+        if transform is not None:
+            block = transform(np.array(block, dtype=np.float32), start)
+        digest.update(np.ascontiguousarray(block, dtype=np.float32))
+    return digest.hexdigest()
+
+
+def _cache_key(content_hash, **params):
+    """
+    Key of a cached embedding: the input hash plus the training parameters.
+    """
+    params = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256((content_hash + params).encode()).hexdigest()[:32]
+
+
+def _cache_load(cache_dir, key):
+    """
+    Return the cached latent spaces of `key`, or None on a cache miss.
+
+    A hit refreshes the modification time of the entry, which is what the
+    least-recently-used eviction of `_cache_store` is based on.
+    """
+    entry = os.path.join(cache_dir, key)
+    if not os.path.exists(os.path.join(entry, "encoded.npy")):
+        return None
+    os.utime(entry)
+    logging.info(" Reusing the cached embedding in " + entry)
+    return np.load(os.path.join(entry, "encoded.npy"), mmap_mode="r")
+
+
+def _cache_store(cache_dir, key, vae, x_test_encoded, cache_size):
+    """
+    Store a trained model and its latent spaces in the cache, then evict the
+    least recently used entries until the cache fits in `cache_size` bytes.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = os.path.join(cache_dir, key)
+    staging = tempfile.mkdtemp(dir=cache_dir, prefix=".staging-")
+    vae.save(os.path.join(staging, "model"))
+    np.save(os.path.join(staging, "encoded.npy"), x_test_encoded)
+    try:
+        os.rename(staging, entry)
+    except OSError:
+        # another run stored the same entry first
+        shutil.rmtree(staging, ignore_errors=True)
+
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.startswith(".") or not os.path.isdir(path):
+            continue
+        size = sum(
+            os.path.getsize(os.path.join(root, f))
+            for root, _, files in os.walk(path)
+            for f in files
         )
-    return correlation_df_new
+        entries.append((os.path.getmtime(path), size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= cache_size or path == entry:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
 
 
-def cook(
-    data,
-    log2_normalization=True,
-    hidden_layer=None,
-    latent_dim=None,
-    epochs=50,
-    batch_size=32,
-    interaction_count=100000,
-    correlation_type="pearson",
-    CC_cutoff=None,
-):
+def _standardize_rows(x, dtype=np.float64, copy=True):
     """
-    Preprocess data, train a Variational Autoencoder (VAE), and create filtered protein pairs.
+    Center and scale every row to unit norm.
+
+    After this transformation the dot product of two rows is their Pearson
+    correlation, so correlations can be computed with matrix multiplication.
+    Rows with zero variance become NaN, as they do with `np.corrcoef`.
 
     Parameters
     ----------
-    data : np.ndarray or anndata._core.anndata.AnnData
-        Input data or AnnData object.
-    log2_normalization : bool, optional
-        Whether to apply log2 normalization, by default True.
-    hidden_layer : int, optional
-        Number of units in the hidden layer, by default None.
-    latent_dim : int, optional
-        Dimension of the latent space, by default None.
-    epochs : int, optional
-        Number of training epochs, by default 50.
-    batch_size : int, optional
-        Batch size for training, by default 32.
-    interaction_count : int, optional
-        Maximum number of interactions to include, by default 100000.
-    correlation_type : str, optional
-        Type of correlation to use (Pearson or Spearman), by default Pearson.
-    CC_cutoff : float, optional
-        Correlation Coefficient cutoff, by default None.
+    x : np.ndarray
+        2D array with one row per protein.
+    dtype : np.dtype, optional
+        Floating point type of the result, by default np.float64.
+    copy : bool, optional
+        Whether to standardize a copy of `x`, by default True. Otherwise `x`
+        is standardized in place when it already has type `dtype`.
 
     Returns
     -------
-    final_pairs : pd.DataFrame
-        Filtered protein pairs based on correlation and cutoffs.
+    z : np.ndarray
+        Standardized rows.
     """
-    from scipy.sparse import issparse
+    z = np.array(x, dtype=dtype) if copy else np.asarray(x, dtype=dtype)
+    z -= z.mean(axis=1, keepdims=True)
+    norm = np.sqrt(np.einsum("ij,ij->i", z, z))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z /= norm[:, None]
+    return z
 
-    if type(data) == anndata._core.anndata.AnnData:
-        # if issparse(data.X):
-        data.X = data.X.toarray()
-        data.var.index.name = None
-        x = data.X.T
-        row_names = data.var.index
-    else:
-        x = np.asarray(data, dtype=np.float32)
-        row_names = data.index
 
-    if np.any(x < 0):
-        log2_normalization = False
-        logging.warn(
-            " Negative values are detected or log2_normalization was set to False, so log2 normalization is not applied."
-        )
+# Floating point type of the correlations for every precision policy.
+_SCORE_DTYPES = {
+    "float32": np.float64,
+    "mixed_float16": np.float32,
+    "mixed_bfloat16": np.float32,
+}
 
-    if log2_normalization == True:
-        x = np.log2(1 + x[:])
-        logging.warn(" log2 normalization is applied.")
+# Components of the encoder output that can feed the correlation.
+_LATENT_COMPONENTS = {"mean": (0,), "mean_sigma": (0, 1), "all": None}
+
+
+def _latent_matrix(x_test_encoded, latent_components="all", dtype=np.float64):
+    """
+    Stack the chosen latent components of every protein side by side.
+
+    Parameters
+    ----------
+    x_test_encoded : np.ndarray
+        Latent spaces of shape ``(3, rows, latent_dim)``: means, log-sigmas
+        and sampled vectors.
+    latent_components : str, optional
+        "mean" (the latent means), "mean_sigma" (the means and the
+        log-sigmas) or "all" (default, also the sampled vectors).
+    dtype : np.dtype, optional
+        Floating point type of the result, by default np.float64.
+
+    Returns
+    -------
+    latent : np.ndarray
+        C-contiguous array of shape ``(rows, components * latent_dim)``,
+        written in a single pass from `x_test_encoded`.
+    """
+    outputs, rows, latent_dim = x_test_encoded.shape
+    components = _LATENT_COMPONENTS[latent_components] or range(outputs)
+    latent = np.empty((rows, len(components), latent_dim), dtype=dtype)
+    for i, component in enumerate(components):
+        latent[:, i] = x_test_encoded[component]
+    return latent.reshape(rows, -1)
+
+
+def _rank_rows(x):
+    """
+    Rank the values of every row, giving tied values their average rank as
+    `pd.DataFrame.corr(method="spearman")` does. The Pearson correlation of
+    the ranks is the Spearman correlation of the original rows.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        2D array with one row per protein.
+
+    Returns
+    -------
+    ranks : np.ndarray
+        Array of the same shape as `x` holding the row-wise ranks.
+    """
+    from scipy.stats import rankdata
+
+    return rankdata(x, method="average", axis=1)
+
+
+def _default_block_size(n_rows, n_cols, target_elements=2**24):
+    """
+    Number of rows per correlation block so that a block of scores holds
+    about `target_elements` values (128 MB in float64).
+    """
+    return int(max(1, min(n_rows, target_elements // max(n_cols, 1))))
+
+
+def _merge_top_pairs(rows, cols, scores, k):
+    """
+    Keep the `k` highest scoring pairs of the given candidates.
+
+    Parameters
+    ----------
+    rows, cols : np.ndarray
+        Integer indices of the candidate pairs.
+    scores : np.ndarray
+        Scores of the candidate pairs.
+    k : int
+        Number of pairs to keep.
+
+    Returns
+    -------
+    rows, cols, scores : np.ndarray
+        The (unsorted) `k` best candidates, none when `k` is not positive.
+    """
+    if k <= 0:
+        keep = np.empty(0, dtype=np.int64)
+        return rows[keep], cols[keep], scores[keep]
+    if scores.shape[0] <= k:
+        return rows, cols, scores
+    keep = np.argpartition(scores, -k)[-k:]
+    return rows[keep], cols[keep], scores[keep]
+
+
+def _block_candidates(row_start, col_start, block, interaction_count, CC_cutoff):
+    """
+    Extract the pairs of a correlation tile that can make it into the output:
+    its best `interaction_count` pairs, or its pairs above `CC_cutoff`.
+
+    Parameters
+    ----------
+    row_start, col_start : int
+        Position of the tile in the full correlation matrix.
+    block : np.ndarray
+        Correlations of the tile. Pairs that must not be selected (e.g. the
+        diagonal) are expected to be NaN.
+    interaction_count : int
+        Maximum number of pairs to keep.
+    CC_cutoff : float or None
+        Correlation Coefficient cutoff. Overrides `interaction_count` when
+        given.
+
+    Returns
+    -------
+    rows, cols, scores : np.ndarray
+        Candidate pairs, indexed in the full matrix.
+    """
+    with np.errstate(invalid="ignore"):
+        if isinstance(CC_cutoff, (int, float)):
+            r, c = np.nonzero(block >= CC_cutoff)
+        elif interaction_count <= 0:
+            r = c = np.empty(0, dtype=np.int64)
+        else:
+            flat = np.where(np.isnan(block), -np.inf, block).ravel()
+            if flat.shape[0] > interaction_count:
+                candidates = np.argpartition(flat, -interaction_count)
+                candidates = candidates[-interaction_count:]
+            else:
+                candidates = np.arange(flat.shape[0])
+            candidates = candidates[np.isfinite(flat[candidates])]
+            r, c = np.divmod(candidates, block.shape[1])
+    return r + row_start, c + col_start, block[r, c]
+
+
+def _collect_pairs(candidates, interaction_count=100000, CC_cutoff=None):
+    """
+    Merge the candidates of several tiles into the final selection.
+
+    Only the running top `interaction_count` pairs (or the pairs above
+    `CC_cutoff`) are kept between tiles, so memory depends on the tile size
+    and on the number of selected pairs, not on the total number of pairs.
+
+    Parameters
+    ----------
+    candidates : iterable of (np.ndarray, np.ndarray, np.ndarray)
+        Candidate ``(rows, cols, scores)`` of every tile, as returned by
+        `_block_candidates`.
+    interaction_count : int, optional
+        Maximum number of pairs to keep, by default 100000.
+    CC_cutoff : float, optional
+        Correlation Coefficient cutoff, by default None. Overrides
+        `interaction_count` when given.
+
+    Returns
+    -------
+    rows, cols, scores : np.ndarray
+        Selected pairs sorted by decreasing score.
+    """
+    use_cutoff = isinstance(CC_cutoff, (int, float))
+    rows = np.empty(0, dtype=np.int64)
+    cols = np.empty(0, dtype=np.int64)
+    # float32 so that the candidates keep their own type
+    scores = np.empty(0, dtype=np.float32)
+    found_rows, found_cols, found_scores = [rows], [cols], [scores]
+
+    for r, c, block_scores in candidates:
+        if use_cutoff:
+            found_rows.append(r)
+            found_cols.append(c)
+            found_scores.append(block_scores)
+        else:
+            rows, cols, scores = _merge_top_pairs(
+                np.concatenate([rows, r]),
+                np.concatenate([cols, c]),
+                np.concatenate([scores, block_scores]),
+                interaction_count,
+            )
+
+    if use_cutoff:
+        rows = np.concatenate(found_rows)
+        cols = np.concatenate(found_cols)
+        scores = np.concatenate(found_scores)
+
+    # sort by decreasing score; ties are broken by position for reproducibility
+    order = np.lexsort((cols, rows, -scores))
+    return rows[order], cols[order], scores[order]
+
+
+def _select_pairs(blocks, interaction_count=100000, CC_cutoff=None):
+    """
+    Select the best scoring pairs from a stream of correlation blocks.
+
+    Parameters
+    ----------
+    blocks : iterable of (int, int, np.ndarray)
+        Tuples ``(row_start, col_start, scores)`` where `scores` holds the
+        correlations of a rectangular tile of the full matrix. Pairs that must
+        not be selected (e.g. the diagonal) are expected to be NaN.
+    interaction_count : int, optional
+        Maximum number of pairs to keep, by default 100000.
+    CC_cutoff : float, optional
+        Correlation Coefficient cutoff, by default None. Overrides
+        `interaction_count` when given.
+
+    Returns
+    -------
+    rows, cols, scores : np.ndarray
+        Selected pairs sorted by decreasing score.
+    """
+    candidates = (
+        _block_candidates(row_start, col_start, block, interaction_count, CC_cutoff)
+        for row_start, col_start, block in blocks
+    )
+    return _collect_pairs(candidates, interaction_count, CC_cutoff)
+
+
+def _mask_pairs(block, row_start, col_start):
+    """
+    Set the scores of a tile that lie on or below the diagonal to NaN, so that
+    every unordered pair is only scored once (as i < j).
+    """
+    rows = np.arange(row_start, row_start + block.shape[0])[:, None]
+    cols = np.arange(col_start, col_start + block.shape[1])[None, :]
+    block[cols <= rows] = np.nan
+    return block
+
+
+def _pearson_blocks(z, block_size=None):
+    """
+    Yield row blocks of the upper triangle of the Pearson correlation matrix
+    of standardized rows.
+
+    Parameters
+    ----------
+    z : np.ndarray
+        Rows standardized with `_standardize_rows`.
+    block_size : int, optional
+        Number of rows per block, by default chosen from the matrix size.
+
+    Yields
+    ------
+    (int, int, np.ndarray)
+        Row offset, column offset and scores of each block. Block ``i`` only
+        covers the columns from its first row onwards, and the entries on or
+        below the diagonal are set to NaN.
+    """
+    n = z.shape[0]
+    if block_size is None:
+        block_size = _default_block_size(n, n)
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        block = z[start:stop] @ z[start:].T
+        yield start, start, _mask_pairs(block, start, start)
+
+
+# Parallel scoring: the standardized latent matrix lives in shared memory and
+# every worker scores disjoint tiles of the upper triangle of the correlation
+# matrix, returning only the candidates of its tiles. The workers are spawned
+# rather than forked, since TensorFlow has usually run in this process by then
+# (TensorFlow is not fork-safe); they only need numpy and the shared memory.
+_shared_latent = None
+
+# Environment variables that limit the BLAS thread pools of a new process
+_BLAS_THREAD_VARIABLES = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+
+
+@contextlib.contextmanager
+def _single_threaded_blas():
+    """
+    Limit the BLAS libraries of the processes started in the context to one
+    thread each, and restore the environment afterwards. A spawned process
+    reads these variables when it imports numpy, even without threadpoolctl.
+    """
+    previous = {name: os.environ.get(name) for name in _BLAS_THREAD_VARIABLES}
+    try:
+        os.environ.update(dict.fromkeys(_BLAS_THREAD_VARIABLES, "1"))
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def _init_scoring_worker(shm_name, shape, dtype):
+    """
+    Attach a scoring worker to the shared standardized latent matrix.
+    """
+    global _shared_latent
+    try:
+        # one BLAS thread per worker, the pool provides the parallelism
+        from threadpoolctl import threadpool_limits
+
+        threadpool_limits(1)
+    except ImportError:
+        pass
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _shared_latent = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+
+
+def _score_tile(task):
+    """
+    Score one tile of the shared latent matrix and return its candidates.
+    """
+    row_start, row_stop, col_start, col_stop, interaction_count, CC_cutoff = task
+    z = _shared_latent[1]
+    block = z[row_start:row_stop] @ z[col_start:col_stop].T
+    _mask_pairs(block, row_start, col_start)
+    return _block_candidates(row_start, col_start, block, interaction_count, CC_cutoff)
+
+
+def _upper_tiles(n, tile_size):
+    """
+    Split the upper triangle of an ``n x n`` matrix into square tiles.
+    """
+    for row_start in range(0, n, tile_size):
+        row_stop = min(row_start + tile_size, n)
+        for col_start in range(row_start, n, tile_size):
+            yield row_start, row_stop, col_start, min(col_start + tile_size, n)
+
+
+def _select_pairs_parallel(
+    z, interaction_count=100000, CC_cutoff=None, tile_size=None, num_workers=None
+):
+    """
+    Select the best scoring pairs of standardized rows with a pool of workers.
+
+    Parameters
+    ----------
+    z : np.ndarray
+        Rows standardized with `_standardize_rows`.
+    interaction_count : int, optional
+        Maximum number of pairs to keep, by default 100000.
+    CC_cutoff : float, optional
+        Correlation Coefficient cutoff, by default None.
+    tile_size : int, optional
+        Side of the square tiles handed to the workers, by default 1024.
+    num_workers : int, optional
+        Number of worker processes, by default the number of CPUs. Every
+        worker uses one BLAS thread.
+
+    Returns
+    -------
+    rows, cols, scores : np.ndarray
+        Selected pairs sorted by decreasing score.
+    """
+    n = z.shape[0]
+    if tile_size is None:
+        tile_size = 1024
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    if num_workers < 1:
+        raise ValueError(f"num_workers must be at least 1, got {num_workers}.")
+
+    shm = shared_memory.SharedMemory(create=True, size=max(z.nbytes, 1))
+    shared = np.ndarray(z.shape, dtype=z.dtype, buffer=shm.buf)
+    try:
+        shared[:] = z
+        tasks = (
+            tile + (interaction_count, CC_cutoff) for tile in _upper_tiles(n, tile_size)
+        )
+        with _single_threaded_blas(), mp.get_context("spawn").Pool(
+            processes=num_workers,
+            initializer=_init_scoring_worker,
+            initargs=(shm.name, z.shape, z.dtype),
+        ) as pool:
+            return _collect_pairs(
+                pool.imap_unordered(_score_tile, tasks),
+                interaction_count,
+                CC_cutoff,
+            )
+    finally:
+        del shared
+        shm.close()
+        shm.unlink()
+
+
+# Approximate mode: a forest of random projection trees splits the standardized
+# latent vectors into small leaves of nearby vectors (Pearson correlation is
+# the cosine similarity of standardized vectors). Only the pairs sharing a leaf
+# in some tree are scored, which finds the strongest partners of every protein
+# in O(n_trees * N * leaf_size * d) instead of O(N^2 * d).
+
+
+def _projection_leaves(z, leaf_size, rng):
+    """
+    Split the rows of `z` into leaves of at most `leaf_size` rows with one
+    random projection tree.
+
+    Every node is split at the median of the projection of its rows on the
+    difference of two random rows, so that similar rows tend to stay together.
+    """
+    leaves = []
+    nodes = [np.arange(z.shape[0])]
+    while nodes:
+        node = nodes.pop()
+        if node.shape[0] <= leaf_size:
+            leaves.append(node)
+            continue
+        a, b = rng.choice(node, size=2, replace=False)
+        projection = z[node] @ (z[a] - z[b])
+        order = np.argsort(projection, kind="stable")
+        half = node.shape[0] // 2
+        nodes += [node[order[:half]], node[order[half:]]]
+    return leaves
+
+
+def _merge_neighbors(indices, scores, new_indices, new_scores, m):
+    """
+    Merge candidate neighbours into the running `m` best neighbours of a set
+    of rows, dropping neighbours that were found twice.
+    """
+    indices = np.concatenate([indices, new_indices], axis=1)
+    scores = np.concatenate([scores, new_scores], axis=1)
+    order = np.argsort(indices, axis=1, kind="stable")
+    indices = np.take_along_axis(indices, order, axis=1)
+    scores = np.take_along_axis(scores, order, axis=1)
+    duplicate = np.zeros(indices.shape, dtype=bool)
+    duplicate[:, 1:] = (indices[:, 1:] == indices[:, :-1]) & (indices[:, 1:] >= 0)
+    scores[duplicate] = -np.inf
+
+    best = np.argsort(-scores, axis=1, kind="stable")[:, :m]
+    return np.take_along_axis(indices, best, axis=1), np.take_along_axis(
+        scores, best, axis=1
+    )
+
+
+def _approximate_neighbors(z, neighbors=10, n_trees=8, leaf_size=None, seed=0):
+    """
+    Find approximately the `neighbors` most correlated rows of every row.
+
+    Parameters
+    ----------
+    z : np.ndarray
+        Rows standardized with `_standardize_rows`.
+    neighbors : int, optional
+        Number of neighbours per row, by default 10.
+    n_trees : int, optional
+        Number of random projection trees, by default 8. More trees find more
+        of the true neighbours (higher recall) and take proportionally longer.
+    leaf_size : int, optional
+        Maximum number of rows per leaf, by default ``max(4 * neighbors, 64)``.
+        Larger leaves also increase recall and cost.
+    seed : int, optional
+        Seed of the random projections, by default 0.
+
+    Returns
+    -------
+    indices, scores : np.ndarray
+        Arrays of shape ``(n, neighbors)`` with the neighbours of every row,
+        by decreasing correlation. Missing neighbours have index -1 and score
+        -inf.
+    """
+    n = z.shape[0]
+    if leaf_size is None:
+        leaf_size = max(4 * neighbors, 64)
+    leaf_size = max(leaf_size, 2)
+    rng = np.random.default_rng(seed)
+
+    indices = np.full((n, neighbors), -1, dtype=np.int64)
+    scores = np.full((n, neighbors), -np.inf)
+    for _ in range(n_trees):
+        for leaf in _projection_leaves(z, leaf_size, rng):
+            block = z[leaf] @ z[leaf].T
+            np.fill_diagonal(block, -np.inf)
+            candidates = np.broadcast_to(leaf, block.shape)
+            if leaf.shape[0] > neighbors:
+                best = np.argpartition(-block, neighbors - 1, axis=1)[:, :neighbors]
+                block = np.take_along_axis(block, best, axis=1)
+                candidates = leaf[best]
+            indices[leaf], scores[leaf] = _merge_neighbors(
+                indices[leaf], scores[leaf], candidates, block, neighbors
+            )
+    indices[~np.isfinite(scores)] = -1
+    return indices, scores
+
+
+def _select_pairs_approximate(
+    z, interaction_count=100000, CC_cutoff=None, neighbors=10, **kwargs
+):
+    """
+    Select the best scoring pairs among the approximate nearest neighbours of
+    every row.
+
+    Parameters
+    ----------
+    z : np.ndarray
+        Rows standardized with `_standardize_rows`.
+    interaction_count : int, optional
+        Maximum number of pairs to keep, by default 100000.
+    CC_cutoff : float, optional
+        Correlation Coefficient cutoff, by default None.
+    neighbors : int, optional
+        Number of neighbours per row, by default 10.
+    **kwargs
+        `n_trees`, `leaf_size` and `seed` of `_approximate_neighbors`.
+
+    Returns
+    -------
+    rows, cols, scores : np.ndarray
+        Selected pairs with ``rows < cols``, sorted by decreasing score.
+    """
+    indices, scores = _approximate_neighbors(z, neighbors, **kwargs)
+    rows = np.repeat(np.arange(z.shape[0]), neighbors)
+    cols, scores = indices.ravel(), scores.ravel()
+    found = np.isfinite(scores)
+    rows, cols, scores = rows[found], cols[found], scores[found]
+
+    # every pair once, as i < j, even when both proteins found each other
+    rows, cols = np.minimum(rows, cols), np.maximum(rows, cols)
+    _, first = np.unique(rows * z.shape[0] + cols, return_index=True)
+    return _collect_pairs(
+        [(rows[first], cols[first], scores[first])], interaction_count, CC_cutoff
+    )
+
+
+def _mirror_pairs(rows, cols, *values):
+    """
+    Add the reverse direction of every pair right after it, so that
+    proteinA - proteinB is followed by proteinB - proteinA. The per-pair
+    `values` (e.g. the scores) are repeated accordingly.
+    """
+    return (
+        np.stack([rows, cols], axis=1).ravel(),
+        np.stack([cols, rows], axis=1).ravel(),
+        *(np.repeat(value, 2) for value in values),
+    )
+
+
+def _pair_count(interaction_count, upper_triangle=False):
+    """
+    Number of unique pairs to select for `interaction_count` interactions,
+    which count both directions unless `upper_triangle` is set.
+    """
+    if upper_triangle:
+        return interaction_count
+    return (interaction_count + 1) // 2
+
+
+def _score_pairs(
+    x_test_encoded,
+    correlation_type="pearson",
+    interaction_count=100000,
+    CC_cutoff=None,
+    block_size=None,
+    num_workers=1,
+    neighbors=None,
+    n_trees=8,
+    latent_components="all",
+    dtype=np.float64,
+):
+    """
+    Score the pairs of proteins with i < j and select the best ones.
+
+    Parameters
+    ----------
+    x_test_encoded : np.ndarray
+        Encoded latent spaces.
+    correlation_type : str
+        Type of correlation to use (Pearson or Spearman).
+    interaction_count : int, optional
+        Maximum number of unique pairs to select, by default 100000.
+    CC_cutoff : float, optional
+        Correlation Coefficient cutoff, by default None.
+    block_size : int, optional
+        Number of proteins correlated at once, by default chosen from the
+        number of proteins.
+    num_workers : int, optional
+        Number of processes scoring tiles of the correlation matrix in
+        parallel, by default 1. None uses all available CPUs.
+    neighbors : int, optional
+        Only score the pairs of every protein with its approximate
+        `neighbors` most correlated proteins, found with `n_trees` random
+        projection trees, see `_approximate_neighbors`. By default None, all
+        pairs are scored exactly.
+    n_trees : int, optional
+        Number of random projection trees with `neighbors`, by default 8.
+    latent_components : str, optional
+        Latent components that are correlated: "mean", "mean_sigma" or "all"
+        (default), see `_latent_matrix`.
+    dtype : np.dtype, optional
+        Floating point type the correlations are computed in, by default
+        np.float64.
+
+    Returns
+    -------
+    rows, cols, scores : np.ndarray
+        Row indices of the selected pairs (with ``rows < cols``) and their
+        scores, sorted by decreasing score.
+    """
+    # Stack the latent components into one buffer, standardized in place
+    latent = _latent_matrix(np.asarray(x_test_encoded), latent_components, dtype)
+
+    # Correlation of the latent space: Pearson or Spearman (Pearson on ranks)
+    if correlation_type == "spearman":
+        latent = _rank_rows(latent)
+    z = _standardize_rows(latent, dtype=dtype, copy=False)
+
+    if neighbors is not None:
+        return _select_pairs_approximate(
+            z, interaction_count, CC_cutoff, neighbors=neighbors, n_trees=n_trees
+        )
+    if num_workers == 1:
+        blocks = _pearson_blocks(z, block_size)
+        return _select_pairs(blocks, interaction_count, CC_cutoff)
+    return _select_pairs_parallel(
+        z, interaction_count, CC_cutoff, tile_size=block_size, num_workers=num_workers
+    )
+
+
+def _query_indices(row_names, query):
+    """
+    Positions of the `query` proteins among `row_names`, in the order of
+    `query`. Unknown and repeated names are skipped with a warning.
+    """
+    positions = {}
+    for i, name in enumerate(row_names):
+        positions.setdefault(name, i)
+    indices, missing = [], []
+    for name in dict.fromkeys(query):
+        if name in positions:
+            indices.append(positions[name])
+        else:
+            missing.append(str(name))
+    if missing:
+        logging.warn(
+            f" {len(missing)} query proteins are not in the data and are skipped: "
+            + ", ".join(missing[:10])
+            + (" ..." if len(missing) > 10 else "")
+        )
+    if not indices:
+        raise ValueError("None of the query proteins are in the data.")
+    return np.array(indices, dtype=np.int64)
+
+
+def _query_pairs(
+    x_test_encoded,
+    query,
+    correlation_type="pearson",
+    interaction_count=100000,
+    CC_cutoff=None,
+    block_size=None,
+    latent_components="all",
+    dtype=np.float64,
+):
+    """
+    Score the query proteins against all proteins and select the best
+    partners of every query protein.
+
+    Only the ``Q x N`` correlations of the query rows are computed, a block of
+    query rows at a time, instead of the ``N x N`` correlation matrix.
+
+    Parameters
+    ----------
+    x_test_encoded : np.ndarray
+        Encoded latent spaces.
+    query : np.ndarray
+        Row indices of the query proteins.
+    correlation_type : str
+        Type of correlation to use (Pearson or Spearman).
+    interaction_count : int, optional
+        Maximum number of partners of every query protein, by default 100000.
+    CC_cutoff : float, optional
+        Correlation Coefficient cutoff, by default None. Overrides
+        `interaction_count` when given.
+    block_size : int, optional
+        Number of query proteins scored at once, by default chosen from the
+        number of proteins.
+    latent_components : str, optional
+        Latent components that are correlated, see `_latent_matrix`.
+    dtype : np.dtype, optional
+        Floating point type the correlations are computed in, by default
+        np.float64.
+
+    Returns
+    -------
+    rows, cols, scores : np.ndarray
+        Query protein and partner of every selected pair, and its score. The
+        pairs are grouped by query protein, in the order of `query`, and
+        sorted by decreasing score within each group.
+    """
+    latent = _latent_matrix(np.asarray(x_test_encoded), latent_components, dtype)
+    if correlation_type == "spearman":
+        latent = _rank_rows(latent)
+    z = _standardize_rows(latent, dtype=dtype, copy=False)
+
+    n = z.shape[0]
+    if block_size is None:
+        block_size = _default_block_size(len(query), n)
+    use_cutoff = isinstance(CC_cutoff, (int, float))
+    k = min(interaction_count, n - 1)
+    found_rows, found_cols, found_scores = [], [], []
+    for start in range(0, len(query), block_size):
+        rows = query[start : start + block_size]
+        block = z[rows] @ z.T
+        block[np.arange(len(rows)), rows] = np.nan
+        block[np.isnan(block)] = -np.inf
+        if use_cutoff:
+            r, c = np.nonzero(block >= CC_cutoff)
+        else:
+            c = np.argpartition(-block, max(k - 1, 0), axis=1)[:, :k].ravel()
+            r = np.repeat(np.arange(len(rows)), k)
+            keep = np.isfinite(block[r, c])
+            r, c = r[keep], c[keep]
+        scores = block[r, c]
+        # group by query protein, best partners first
+        order = np.lexsort((c, -scores, r))
+        found_rows.append(rows[r[order]])
+        found_cols.append(c[order])
+        found_scores.append(scores[order])
+    return (
+        np.concatenate(found_rows),
+        np.concatenate(found_cols),
+        np.concatenate(found_scores),
+    )
+
+
+def _pairs_frame(
+    rows,
+    cols,
+    scores,
+    row_names,
+    interaction_count=100000,
+    CC_cutoff=None,
+    upper_triangle=False,
+    mirror=False,
+    **columns,
+):
+    """
+    Turn selected pairs of row indices into a DataFrame of protein names.
+
+    Parameters
+    ----------
+    rows, cols, scores : np.ndarray
+        Selected pairs, as returned by `_score_pairs`.
+    row_names : list
+        List of row names corresponding to the data.
+    interaction_count : int, optional
+        Maximum number of interactions to include, by default 100000.
+    CC_cutoff : float, optional
+        Correlation Coefficient cutoff, by default None.
+    upper_triangle : bool, optional
+        Report every pair once, by default False.
+    mirror : bool, optional
+        With `upper_triangle`, also report the reverse direction of each
+        selected pair, by default False.
+    **columns
+        Additional per-pair columns of the DataFrame.
+
+    Returns
+    -------
+    correlation_df : pd.DataFrame
+        DataFrame with the "Protein_1", "Protein_2" and "Score" columns,
+        followed by `columns`.
+    """
+    import pandas as pd
+
+    names = ["Score"] + list(columns)
+    rows, cols, values = next(
+        _pair_chunks(
+            rows,
+            cols,
+            [scores] + list(columns.values()),
+            interaction_count,
+            CC_cutoff,
+            upper_triangle=upper_triangle,
+            mirror=mirror,
+        )
+    )
+    row_names = np.asarray(row_names, dtype=object)
+    data = {"Protein_1": row_names[rows], "Protein_2": row_names[cols]}
+    data.update(zip(names, values))
+    return pd.DataFrame(data)
+
+
+def _pair_chunks(
+    rows,
+    cols,
+    values,
+    interaction_count=100000,
+    CC_cutoff=None,
+    upper_triangle=False,
+    mirror=False,
+    chunk_size=None,
+):
+    """
+    Yield the reported pairs in chunks, adding the reverse directions and
+    truncating to `interaction_count` on the fly.
+
+    Parameters
+    ----------
+    rows, cols : np.ndarray
+        Selected pairs, as returned by `_score_pairs`.
+    values : list of np.ndarray
+        Per-pair values, e.g. the scores.
+    interaction_count, CC_cutoff, upper_triangle, mirror
+        See `_pairs_frame`.
+    chunk_size : int, optional
+        Number of selected pairs per chunk, by default all of them.
+
+    Yields
+    ------
+    rows, cols, values
+        Row indices and values of the pairs of each chunk. At least one
+        (possibly empty) chunk is yielded.
+    """
+    both_directions = not upper_triangle or mirror
+    limit = None
+    if not upper_triangle and not isinstance(CC_cutoff, (int, float)):
+        limit = interaction_count
+    if chunk_size is None:
+        chunk_size = max(len(rows), 1)
+
+    reported = 0
+    for start in range(0, max(len(rows), 1), chunk_size):
+        stop = start + chunk_size
+        r, c = rows[start:stop], cols[start:stop]
+        v = [value[start:stop] for value in values]
+        if both_directions:
+            r, c, *v = _mirror_pairs(r, c, *v)
+        if limit is not None:
+            keep = limit - reported
+            r, c, v = r[:keep], c[:keep], [value[:keep] for value in v]
+        reported += len(r)
+        yield r, c, v
+        if limit is not None and reported >= limit:
+            break
+
+
+def _create_protein_pairs(
+    x_test_encoded,
+    row_names,
+    correlation_type="pearson",
+    interaction_count=100000,
+    CC_cutoff=None,
+    block_size=None,
+    upper_triangle=False,
+    mirror=False,
+    num_workers=1,
+):
+    """
+    Create pairs of proteins based on their encoded latent spaces.
+
+    The correlation matrix is never materialized: correlations are computed in
+    row blocks and only the best pairs are kept, so that memory depends on
+    `block_size` and `interaction_count` instead of the square of the number of
+    proteins. Only the pairs with i < j are scored, self-pairs are never
+    reported.
+
+    Parameters
+    ----------
+    x_test_encoded : np.ndarray
+        Encoded latent spaces.
+    row_names : list
+        List of row names corresponding to the data.
+    correlation_type : str
+        Type of correlation to use (Pearson or Spearman).
+    interaction_count : int, optional
+        Maximum number of interactions to include, by default 100000.
+    CC_cutoff : float, optional
+        Correlation Coefficient cutoff, by default None.
+    block_size : int, optional
+        Number of proteins correlated at once, by default chosen from the
+        number of proteins.
+    upper_triangle : bool, optional
+        Report every pair once (proteinA - proteinB only) and count
+        `interaction_count` in unique pairs, by default False. When False, both
+        directions are reported and count towards `interaction_count`.
+    mirror : bool, optional
+        With `upper_triangle`, also report the reverse direction of each
+        selected pair, by default False.
+    num_workers : int, optional
+        Number of processes scoring tiles of the correlation matrix in
+        parallel, by default 1. None uses all available CPUs.
+
+    Returns
+    -------
+    correlation_df : pd.DataFrame
+        DataFrame containing protein pairs and correlation scores, sorted by
+        decreasing score.
+    """
+    rows, cols, scores = _score_pairs(
+        x_test_encoded,
+        correlation_type,
+        _pair_count(interaction_count, upper_triangle),
+        CC_cutoff,
+        block_size=block_size,
+        num_workers=num_workers,
+    )
+    return _pairs_frame(
+        rows,
+        cols,
+        scores,
+        row_names,
+        interaction_count,
+        CC_cutoff,
+        upper_triangle=upper_triangle,
+        mirror=mirror,
+    )
+
+
+def _pairs_after_cutoff(
+    correlation, interaction_count=100000, CC_cutoff=None, both_directions=True
+):
+    """
+    Filter protein pairs based on correlation scores and cutoffs.
+
+    Parameters
+    ----------
+    correlation : pd.DataFrame
+        DataFrame containing protein pairs and correlation scores.
+    interaction_count : int, optional
+        Maximum number of interactions to include, by default 100000.
+    CC_cutoff : float, optional
+        Correlation Coefficient cutoff, by default None.
+    both_directions : bool, optional
+        Whether `correlation` holds both directions of every pair, by default
+        True. Only used to report what `interaction_count` counts.
+
+    Returns
+    -------
+    correlation_df_new : pd.DataFrame
+        Filtered DataFrame with selected protein pairs.
+    """
+    if CC_cutoff is not None and isinstance(CC_cutoff, (int, float)):
+        correlation_df_new = correlation.loc[(correlation["Score"] >= CC_cutoff)]
+    elif both_directions:
+        correlation_df_new = correlation.iloc[:interaction_count, :]
+    else:
+        correlation_df_new = correlation
+    _log_interactions(len(correlation_df_new), CC_cutoff, both_directions)
+    return correlation_df_new
+
+
+def _log_interactions(count, CC_cutoff=None, both_directions=True):
+    """
+    Report how the interactions of the output were selected.
+
+    Parameters
+    ----------
+    count : int
+        Number of interactions in the output.
+    CC_cutoff : float, optional
+        Correlation Coefficient cutoff, by default None.
+    both_directions : bool, optional
+        Whether the output holds both directions of every pair, by default
+        True.
+    """
+    if CC_cutoff is not None and isinstance(CC_cutoff, (int, float)):
+        logging.info(" A cut-off of " + str(CC_cutoff) + " is applied.")
+    elif both_directions:
+        logging.warn(
+            " The number of interactions in the output file is "
+            + str(count)
+            + " in which both directions are included: proteinA - proteinB and proteinB - proteinA."
+        )
+    else:
+        logging.warn(
+            " The number of interactions in the output file is "
+            + str(count)
+            + " in which every pair is included once: proteinA - proteinB."
+        )
+
+
+def _pairs_adjacency(chunks, n):
+    """
+    Gather the reported pairs into a sparse adjacency matrix.
+
+    Parameters
+    ----------
+    chunks : iterable
+        Chunks of pairs, as yielded by `_pair_chunks`. Only the first value
+        of every pair (the score) is kept.
+    n : int
+        Number of proteins.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        ``n x n`` float32 matrix whose entry ``(i, j)`` is the score of the
+        pair of the i-th and j-th proteins, in the order of the input rows.
+        Both directions are stored unless only one was reported. Indices are
+        32-bit whenever `n` allows it, i.e. about 8 bytes per pair.
+    """
+    from scipy.sparse import csr_matrix
+
+    found_rows, found_cols, found_scores = [], [], []
+    for rows, cols, values in chunks:
+        found_rows.append(rows)
+        found_cols.append(cols)
+        found_scores.append(values[0].astype(np.float32))
+    rows = np.concatenate(found_rows)
+    cols = np.concatenate(found_cols)
+    scores = np.concatenate(found_scores)
+
+    # build CSR directly: sort by row, then column (pairs are unique)
+    index_dtype = np.int32 if n < 2**31 and len(rows) < 2**31 else np.int64
+    order = np.lexsort((cols, rows))
+    indptr = np.zeros(n + 1, dtype=index_dtype)
+    np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+    return csr_matrix(
+        (scores[order], cols[order].astype(index_dtype), indptr), shape=(n, n)
+    )
+
+
+def _output_format(output_file, output_format=None):
+    """
+    Choose the writer of `output_file`: the given `output_format`, or the one
+    matching the file extension. Unknown extensions keep the original
+    space-separated text format without header ("txt").
+    """
+    if output_format is not None:
+        return output_format
+    name = str(output_file).lower()
+    for suffix, fmt in [
+        (".parquet", "parquet"),
+        (".feather", "feather"),
+        (".npz", "npz"),
+        (".tsv", "tsv"),
+        (".tsv.gz", "tsv"),
+    ]:
+        if name.endswith(suffix):
+            return fmt
+    return "txt"
+
+
+def _import_pyarrow(output_format):
+    """
+    Import pyarrow for the Arrow output formats, with an error naming the
+    extra that installs it.
+    """
+    try:
+        import pyarrow
+    except ImportError as error:
+        raise ImportError(
+            f"The {output_format} output format requires pyarrow, install it with "
+            "pip install 'favapy[parquet]'."
+        ) from error
+    return pyarrow
+
+
+def _chunk_frame(rows, cols, values, names, row_names, categories=None):
+    """
+    Build the DataFrame of a chunk of pairs. With `categories`, the protein
+    names are stored as a categorical (dictionary-encoded) column.
+    """
+    import pandas as pd
+
+    if categories is not None:
+        data = {
+            "Protein_1": pd.Categorical.from_codes(rows, categories=categories),
+            "Protein_2": pd.Categorical.from_codes(cols, categories=categories),
+        }
+    else:
+        data = {"Protein_1": row_names[rows], "Protein_2": row_names[cols]}
+    data.update(zip(names, values))
+    return pd.DataFrame(data)
+
+
+def _write_pairs(chunks, names, row_names, output_file, output_format=None):
+    """
+    Write the reported pairs chunk by chunk, so that the full table of
+    protein names never has to be in memory.
+
+    Parameters
+    ----------
+    chunks : iterable
+        Chunks of pairs, as yielded by `_pair_chunks`.
+    names : list of str
+        Names of the values of every pair, starting with "Score".
+    row_names : list
+        Names of the proteins.
+    output_file : str
+        Path of the output file.
+    output_format : str, optional
+        One of:
+
+        - "txt": space-separated text without header, the original format
+        - "tsv": tab-separated text with header, gzip-compressed if
+          `output_file` ends with ``.gz``
+        - "parquet", "feather": Arrow tables with dictionary-encoded protein
+          names (requires pyarrow, see the "parquet" extra)
+        - "npz": sparse adjacency matrix in the `scipy.sparse.save_npz`
+          layout, with the protein names of its rows and columns stored as
+          ``names``
+
+        By default chosen from the file extension, see `_output_format`.
+
+    Returns
+    -------
+    int
+        Number of written pairs.
+    """
+    output_format = _output_format(output_file, output_format)
+    row_names = np.asarray(row_names, dtype=object)
+    written = 0
+
+    if output_format in ("txt", "tsv"):
+        header = output_format == "tsv"
+        sep = "\t" if header else " "
+        if str(output_file).endswith(".gz"):
+            handle = gzip.open(output_file, "wt", newline="")
+        else:
+            handle = open(output_file, "w", newline="")
+        with handle:
+            for rows, cols, values in chunks:
+                frame = _chunk_frame(rows, cols, values, names, row_names)
+                frame["Score"] = frame["Score"].astype(float).round(5)
+                frame.to_csv(handle, sep=sep, header=header, index=False)
+                header = False
+                written += len(frame)
+
+    elif output_format in ("parquet", "feather"):
+        import pandas as pd
+
+        pa = _import_pyarrow(output_format)
+
+        categories = None
+        if pd.Index(row_names).is_unique:
+            categories = row_names
+        writer = None
+        try:
+            for rows, cols, values in chunks:
+                frame = _chunk_frame(rows, cols, values, names, row_names, categories)
+                table = pa.Table.from_pandas(frame, preserve_index=False)
+                if writer is None:
+                    if output_format == "parquet":
+                        import pyarrow.parquet as pq
+
+                        writer = pq.ParquetWriter(output_file, table.schema)
+                    else:
+                        writer = pa.ipc.new_file(output_file, table.schema)
+                writer.write_table(table)
+                written += len(frame)
+        finally:
+            if writer is not None:
+                writer.close()
+
+    elif output_format == "npz":
+        adjacency = _pairs_adjacency(chunks, len(row_names))
+        written = adjacency.nnz
+        np.savez_compressed(
+            output_file,
+            format=b"csr",
+            shape=adjacency.shape,
+            data=adjacency.data,
+            indices=adjacency.indices,
+            indptr=adjacency.indptr,
+            names=row_names.astype(str),
+        )
+
+    else:
+        raise ValueError(f"Unknown output format: {output_format}")
+    return written
+
+
+def _configure_threads(num_threads=None):
+    """
+    Size the TensorFlow thread pools used for training.
+
+    Parameters
+    ----------
+    num_threads : int or str, optional
+        Number of threads used within each TensorFlow operation, or "auto" to
+        keep the TensorFlow defaults (all available cores). By default the
+        value of the ``FAVAPY_NUM_THREADS`` environment variable, or "auto".
+        Use 1 for one-process-per-core throughput runs.
+
+    The number of operations run at once (the inter-op threads) is capped at
+    ``min(num_threads, 2)``: the layers of the VAE depend on each other, so
+    more of them would only compete with the threads of every operation.
+    """
+    import tensorflow as tf
+
+    if num_threads is None:
+        num_threads = os.environ.get("FAVAPY_NUM_THREADS", "auto")
+    if str(num_threads).lower() == "auto":
+        return
+    num_threads = int(num_threads)
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(min(num_threads, 2))
+    except RuntimeError:
+        logging.warn(
+            " TensorFlow is already initialized in this process, so the number of threads cannot be changed to "
+            + str(num_threads)
+            + "."
+        )
+
+
+def _default_dimensions(original_dim, hidden_layer=None, latent_dim=None):
+    """
+    Choose the sizes of the hidden layer and of the latent space that were
+    not given, from the number of input columns.
+    """
+    if hidden_layer == None:
+        if original_dim >= 2000:
+            hidden_layer = 1000
+        if original_dim > 500 and original_dim < 2000:
+            hidden_layer = 500
+        if original_dim <= 500:
+            hidden_layer = 50
+
+    if latent_dim == None:
+        if hidden_layer >= 1000:
+            latent_dim = 100
+        if hidden_layer >= 500 and hidden_layer < 1000:
+            latent_dim = 50
+        if hidden_layer <= 500:
+            latent_dim = 5
+    return hidden_layer, latent_dim
+
+
+def _peak_rss_mib():
+    """
+    Peak resident memory of the process, or of its largest finished child
+    process (e.g. a worker), in MiB. None where it cannot be measured.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    import sys
+
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # bytes on macOS, KiB on Linux
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+@contextlib.contextmanager
+def _untimed_stage(name, items=None, unit="proteins"):
+    """
+    Stand-in for `Pipeline.stage` when stages are not timed.
+    """
+    yield {}
+
+
+# Models kept for reuse by the batch mode, keyed by their shape and precision:
+# building a VAE traces and compiles its training step again, which takes
+# longer than training it on a small matrix.
+_model_pool = None
+
+
+def _pooled_vae(original_dim, hidden_layer, latent_dim, precision):
+    """
+    Return a reset VAE of the given shape from `_model_pool`, or None if
+    there is none to reuse.
+    """
+    if _model_pool is None:
+        return None
+    vae = _model_pool.get((original_dim, hidden_layer, latent_dim, precision))
+    if vae is not None:
+        vae.reset()
+    return vae
+
+
+def _embed(
+    x,
+    hidden_layer,
+    latent_dim,
+    epochs=50,
+    batch_size=32,
+    seed=None,
+    cache_dir=None,
+    cache_size=10 * 2**30,
+    num_threads=None,
+    validation_split=0.0,
+    early_stopping=False,
+    patience=5,
+    min_delta=0.0,
+    workdir=None,
+    stage=None,
+    precision="float32",
+    model_dir=None,
+    **streaming,
+):
+    """
+    Train a VAE on `x` and encode it, or reuse a cached embedding.
+
+    Parameters
+    ----------
+    x : array-like or scipy.sparse.csr_matrix
+        Normalized data with one row per protein, or an on-disk matrix
+        together with the `streaming` options that normalize it.
+    hidden_layer : int
+        Number of units in the hidden layer.
+    latent_dim : int
+        Dimension of the latent space.
+    epochs : int, optional
+        Number of training epochs, by default 50.
+    batch_size : int, optional
+        Batch size for training, by default 32.
+    seed : int, optional
+        Seed of the random number generators used for training, by default
+        None.
+    cache_dir : str, optional
+        Directory of the embedding cache, by default None (no caching).
+    cache_size : int, optional
+        Maximum size of the cache in bytes, by default 10 GiB.
+    num_threads : int or str, optional
+        Number of TensorFlow threads, see `_configure_threads`.
+    validation_split : float, optional
+        Fraction of the rows held out to validate the model after every
+        epoch, by default 0 (no validation pass).
+    early_stopping : bool, optional
+        Whether to stop training once the loss (the validation loss if
+        `validation_split` is set) stops improving, by default False. The
+        weights of the best epoch are kept.
+    patience : int, optional
+        Number of epochs without improvement before stopping, by default 5.
+    min_delta : float, optional
+        Minimum decrease of the loss counted as an improvement, by default 0.
+    workdir : str, optional
+        Directory for the memory-mapped latent spaces of on-disk inputs.
+    stage : callable, optional
+        Context manager timing the "train" and "encode" stages, see
+        `Pipeline.stage`. By default they are not timed.
+    precision : str, optional
+        Precision policy of the VAE, see `favapy.vae.VAE`, by default
+        "float32".
+    model_dir : str, optional
+        Directory where the trained model is saved, see `favapy.vae.VAE.save`.
+        By default the model is not saved.
+    **streaming
+        `block_rows` and `transform` passed to `_row_batches` for on-disk
+        inputs.
+
+    Returns
+    -------
+    x_test_encoded : np.ndarray
+        Latent spaces of shape ``(3, rows, latent_dim)``, in float16 with a
+        mixed precision policy.
+    """
+    import tensorflow as tf
+    from scipy.sparse import issparse
+    from favapy.vae import VAE
+
+    if stage is None:
+        stage = _untimed_stage
+
+    key = None
+    if cache_dir is not None:
+        key = _cache_key(
+            _content_hash(x, **streaming),
+            hidden_layer=hidden_layer,
+            latent_dim=latent_dim,
+            epochs=epochs,
+            batch_size=batch_size,
+            seed=seed,
+            validation_split=validation_split,
+            early_stopping=early_stopping,
+            patience=patience,
+            min_delta=min_delta,
+            precision=precision,
+        )
+        with stage("encode", items=x.shape[0]) as record:
+            x_test_encoded = _cache_load(cache_dir, key)
+            record["cached"] = x_test_encoded is not None
+        if x_test_encoded is not None:
+            if model_dir is not None:
+                shutil.copytree(
+                    os.path.join(cache_dir, key, "model"), model_dir, dirs_exist_ok=True
+                )
+            return x_test_encoded
+
+    _configure_threads(num_threads)
+    if seed is not None:
+        tf.keras.utils.set_random_seed(seed)
+
+    train_mask = x_val = None
+    if validation_split:
+        train_mask = np.random.uniform(size=x.shape[0]) >= validation_split
+    if workdir is not None or issparse(x):
+        x_train = _row_dataset(
+            x, batch_size, shuffle=True, mask=train_mask, **streaming
+        )
+        if train_mask is not None:
+            x_val = _row_dataset(x, batch_size, mask=~train_mask, **streaming)
+    elif train_mask is not None:
+        x_train, x_val = x[train_mask], x[~train_mask]
+    else:
+        x_train = x
+
+    callbacks = []
+    if early_stopping:
+        callbacks.append(
+            tf.keras.callbacks.EarlyStopping(
+                monitor="loss" if x_val is None else "val_loss",
+                patience=patience,
+                min_delta=min_delta,
+                restore_best_weights=True,
+            )
+        )
+    with stage("train", unit="samples") as record:
+        vae = _pooled_vae(x.shape[1], hidden_layer, latent_dim, precision)
+        if vae is None:
+            vae = VAE(x.shape[1], hidden_layer, latent_dim, precision=precision)
+            if _model_pool is not None:
+                _model_pool[(x.shape[1], hidden_layer, latent_dim, precision)] = vae
+        else:
+            record["reused_model"] = True
+        history = vae.fit(
+            x_train,
+            batch_size=batch_size,
+            epochs=epochs,
+            validation_data=x_val,
+            callbacks=callbacks,
+        )
+        train_rows = x.shape[0] if train_mask is None else int(train_mask.sum())
+        record["items"] = train_rows * len(history.epoch)
+    with stage("encode", items=x.shape[0]):
+        if workdir is not None:
+            x_test_encoded = _encode_to_memmap(
+                vae.encoder,
+                _row_batches(x, streaming["block_rows"], **streaming),
+                (3, x.shape[0], latent_dim),
+                os.path.join(workdir, "encoded.npy"),
+                batch_size=batch_size,
+                dtype=vae.latent_dtype,
+            )
+        else:
+            x_test_encoded = vae.encode(x, batch_size=batch_size)
+    if model_dir is not None:
+        vae.save(model_dir)
+    if key is not None:
+        _cache_store(cache_dir, key, vae, x_test_encoded, cache_size)
+    return x_test_encoded
+
+
+# Ensemble mode: K VAEs trained with consecutive seeds, in a pool of spawned
+# processes (TensorFlow is not fork-safe), each returning only its selected
+# pairs. The pair sets are merged as sparse matrices into consensus scores.
+_ensemble_data = None
+
+
+def _init_ensemble_worker(x, embed_params, score_params):
+    """
+    Keep the normalized data and the parameters of an ensemble worker.
+    """
+    global _ensemble_data
+    _ensemble_data = (x, embed_params, score_params)
+
+
+def _ensemble_member(seed):
+    """
+    Train and encode one member of the ensemble and select its pairs.
+    """
+    x, embed_params, score_params = _ensemble_data
+    x_test_encoded = _embed(x, seed=seed, **embed_params)
+    return _score_pairs(x_test_encoded, **score_params)
+
+
+def _consensus_pairs(members, n, interaction_count=100000, CC_cutoff=None):
+    """
+    Merge the pairs selected by the members of an ensemble.
+
+    Parameters
+    ----------
+    members : list of (np.ndarray, np.ndarray, np.ndarray)
+        Selected ``(rows, cols, scores)`` of every member.
+    n : int
+        Number of proteins.
+    interaction_count : int, optional
+        Maximum number of unique pairs to keep, by default 100000.
+    CC_cutoff : float, optional
+        Correlation Coefficient cutoff on the consensus score, by default
+        None. Overrides `interaction_count` when given.
 
-    x = x / np.max(x, axis=1, keepdims=True)
-    x = np.nan_to_num(x)
+    Returns
+    -------
+    rows, cols, scores, stability : np.ndarray
+        Selected pairs sorted by decreasing consensus score, i.e. the score
+        averaged over all members, counting 0 for the members that did not
+        select the pair, and the number of members that selected each pair.
+    """
+    from scipy.sparse import coo_matrix
 
-    original_dim = x.shape[1]
-    if hidden_layer == None:
-        if original_dim >= 2000:
-            hidden_layer = 1000
-        if original_dim > 500 and original_dim < 2000:
-            hidden_layer = 500
-        if original_dim <= 500:
-            hidden_layer = 50
+    rows = np.concatenate([member[0] for member in members])
+    cols = np.concatenate([member[1] for member in members])
+    scores = np.concatenate([member[2] for member in members])
 
-    if latent_dim == None:
-        if hidden_layer >= 1000:
-            latent_dim = 100
-        if hidden_layer >= 500 and hidden_layer < 1000:
-            latent_dim = 50
-        if hidden_layer <= 500:
-            latent_dim = 5
+    # duplicates are summed when converting to CSR
+    totals = coo_matrix((scores, (rows, cols)), shape=(n, n)).tocsr()
+    counts = coo_matrix((np.ones_like(rows), (rows, cols)), shape=(n, n)).tocsr()
+    pairs = counts.tocoo()
+    consensus = np.asarray(totals[pairs.row, pairs.col]).ravel() / len(members)
+
+    rows, cols, scores = _collect_pairs(
+        [(pairs.row, pairs.col, consensus)], interaction_count, CC_cutoff
+    )
+    stability = np.asarray(counts[rows, cols]).ravel()
+    return rows, cols, scores, stability
+
+
+def _ensemble_pairs(
+    x,
+    ensemble,
+    embed_params,
+    score_params,
+    seed=None,
+    ensemble_workers=None,
+    workdir=None,
+):
+    """
+    Train an ensemble of VAEs and merge their selected pairs.
+
+    Parameters
+    ----------
+    x : array-like or scipy.sparse.csr_matrix
+        Normalized data, see `_embed`.
+    ensemble : int
+        Number of VAEs.
+    embed_params : dict
+        Keyword arguments of `_embed`, besides the data and the seed.
+    score_params : dict
+        Keyword arguments of `_score_pairs`, besides the latent spaces.
+    seed : int, optional
+        Seed of the first member, the others use the following seeds. By
+        default None (unseeded members).
+    ensemble_workers : int, optional
+        Number of members trained at once in separate processes, by default
+        as many as the members and CPUs allow. Members are trained one after
+        another in the current process when 1, which is always the case for
+        on-disk inputs.
+    workdir : str, optional
+        Directory for the memory-mapped latent spaces of on-disk inputs.
+
+    Returns
+    -------
+    rows, cols, scores, stability : np.ndarray
+        Consensus pairs, see `_consensus_pairs`.
+    """
+    seeds = [None if seed is None else seed + i for i in range(ensemble)]
+    if ensemble_workers is None:
+        ensemble_workers = min(ensemble, os.cpu_count())
+    if workdir is not None and ensemble_workers != 1:
+        logging.info(" On-disk inputs train the ensemble one model at a time.")
+        ensemble_workers = 1
+
+    if ensemble_workers == 1:
+        members = []
+        for i, member_seed in enumerate(seeds):
+            params = dict(embed_params)
+            if workdir is not None:
+                params["workdir"] = os.path.join(workdir, str(i))
+                os.makedirs(params["workdir"])
+            x_test_encoded = _embed(x, seed=member_seed, **params)
+            members.append(_score_pairs(x_test_encoded, **score_params))
+            del x_test_encoded
+    else:
+        embed_params = dict(embed_params)
+        if embed_params.get("num_threads") is None:
+            # share the cores between the members trained at once
+            embed_params["num_threads"] = max(1, os.cpu_count() // ensemble_workers)
+        score_params = dict(score_params, num_workers=1)
+        with mp.get_context("spawn").Pool(
+            processes=ensemble_workers,
+            initializer=_init_ensemble_worker,
+            initargs=(x, embed_params, score_params),
+        ) as pool:
+            members = pool.map(_ensemble_member, seeds, chunksize=1)
+
+    return _consensus_pairs(
+        members,
+        x.shape[0],
+        score_params["interaction_count"],
+        score_params["CC_cutoff"],
+    )
+
+
+# Incremental updates: a run with `save_dir` keeps its trained model, its latent
+# spaces and its selected pairs. `update` encodes only the new or changed
+# proteins with that model, scores them against all proteins and splices their
+# pairs into the saved selection; the pairs of the other proteins are kept as
+# they are, without being scored again.
+
+
+def _replace_file(path, write):
+    """
+    Write a file through ``write(outfile)`` on a temporary file that then
+    replaces `path`, so that readers never see a partial file.
+    """
+    with open(path + ".tmp", "wb") as outfile:
+        write(outfile)
+    os.replace(path + ".tmp", path)
+
+
+def _save_state(save_dir, x_test_encoded, row_names, rows, cols, scores, options):
+    """
+    Save the latent spaces, the protein names, the selected pairs and the
+    options of a run in `save_dir`, next to its model.
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    _replace_file(
+        os.path.join(save_dir, "encoded.npy"),
+        lambda outfile: np.save(outfile, x_test_encoded),
+    )
+    _replace_file(
+        os.path.join(save_dir, "network.npz"),
+        lambda outfile: np.savez(outfile, rows=rows, cols=cols, scores=scores),
+    )
+    state = {"row_names": [str(name) for name in row_names], "options": options}
+    _replace_file(
+        os.path.join(save_dir, "state.json"),
+        lambda outfile: outfile.write(json.dumps(state, default=str).encode()),
+    )
+
+
+def _load_state(save_dir):
+    """
+    Load the state saved by `_save_state`: the protein names and options,
+    the latent spaces (memory-mapped) and the selected pairs.
+    """
+    with open(os.path.join(save_dir, "state.json")) as infile:
+        state = json.load(infile)
+    x_test_encoded = np.load(os.path.join(save_dir, "encoded.npy"), mmap_mode="r")
+    with np.load(os.path.join(save_dir, "network.npz")) as network:
+        pairs = network["rows"], network["cols"], network["scores"]
+    return state, x_test_encoded, pairs
+
+
+def _update_pairs(
+    x_test_encoded,
+    changed,
+    pairs,
+    correlation_type="pearson",
+    interaction_count=100000,
+    CC_cutoff=None,
+    latent_components="all",
+    dtype=np.float64,
+):
+    """
+    Splice the pairs of changed proteins into a selection of pairs.
+
+    Parameters
+    ----------
+    x_test_encoded : np.ndarray
+        Latent spaces of all proteins, including the changed ones.
+    changed : np.ndarray
+        Row indices of the new or changed proteins.
+    pairs : tuple of np.ndarray
+        Previous selection ``(rows, cols, scores)``, as returned by
+        `_score_pairs`.
+    correlation_type, latent_components, dtype
+        See `_score_pairs`.
+    interaction_count : int, optional
+        Maximum number of unique pairs to select, by default 100000.
+    CC_cutoff : float, optional
+        Correlation Coefficient cutoff, by default None.
+
+    Returns
+    -------
+    rows, cols, scores : np.ndarray
+        Updated selection of pairs with ``rows < cols``, sorted by
+        decreasing score.
+    """
+    rows, cols, scores = pairs
+    keep = ~(np.isin(rows, changed) | np.isin(cols, changed))
+
+    # a pair among the best of all pairs is among the best of its two rows
+    new_rows, new_cols, new_scores = _query_pairs(
+        x_test_encoded,
+        changed,
+        correlation_type,
+        interaction_count,
+        CC_cutoff,
+        latent_components=latent_components,
+        dtype=dtype,
+    )
+    low, high = np.minimum(new_rows, new_cols), np.maximum(new_rows, new_cols)
+    # pairs of two changed proteins are found from both sides
+    _, unique = np.unique(low * len(x_test_encoded[0]) + high, return_index=True)
+    return _collect_pairs(
+        [
+            (rows[keep], cols[keep], scores[keep]),
+            (low[unique], high[unique], new_scores[unique]),
+        ],
+        interaction_count,
+        CC_cutoff,
+    )
+
+
+class Pipeline:
+    """
+    A FAVA run in stages: load, normalize, train, encode, score, select (or
+    write). `cook` and the command line interface both run it.
+
+    Every stage is timed. Its report is a dictionary with the name of the
+    stage, its wall time in seconds, the number of items it processed (and
+    their unit: proteins, values, samples or pairs), its throughput in items
+    per second and the peak resident memory in MiB so far. Reports are logged,
+    passed to `callback` and kept in `stages`.
 
-    opt = tf.keras.optimizers.Adam(learning_rate=0.001, clipnorm=0.001)
-    x_train = x_test = np.array(x)
-    vae = VAE(
-        opt, x_train, x_test, batch_size, original_dim, hidden_layer, latent_dim, epochs
+    Parameters
+    ----------
+    callback : callable, optional
+        Called with the report of every stage once it finishes.
+    **options
+        Options of the run, with the names and defaults of the parameters of
+        `cook`.
+    """
+
+    defaults = dict(
+        log2_normalization=True,
+        normalization="max",
+        hidden_layer=None,
+        latent_dim=None,
+        epochs=50,
+        batch_size=32,
+        interaction_count=None,
+        correlation_type="pearson",
+        CC_cutoff=None,
+        upper_triangle=False,
+        mirror=False,
+        num_workers=1,
+        temp_dir=None,
+        seed=None,
+        cache_dir=None,
+        cache_size=10 * 2**30,
+        num_threads=None,
+        validation_split=0.0,
+        early_stopping=False,
+        patience=5,
+        min_delta=0.0,
+        ensemble=1,
+        ensemble_workers=None,
+        neighbors=None,
+        n_trees=8,
+        latent_components="all",
+        precision="float32",
+        query=None,
+        save_dir=None,
     )
-    x_test_encoded = np.array(vae.encoder.predict(x_test, batch_size=batch_size))
-    correlation = _create_protein_pairs(x_test_encoded, row_names, correlation_type)
-    # correlation = _create_protein_pairs_parallel(x_test_encoded, row_names, correlation_type, num_processes=6)
 
-    final_pairs = correlation[correlation.iloc[:, 0] != correlation.iloc[:, 1]]
-    final_pairs = final_pairs.sort_values(by=["Score"], ascending=False)
-    final_pairs = _pairs_after_cutoff(
-        correlation=final_pairs,
+    def __init__(self, callback=None, **options):
+        unknown = set(options) - set(self.defaults)
+        if unknown:
+            raise TypeError(f"Unknown options: {', '.join(sorted(unknown))}")
+        self.options = dict(self.defaults, **options)
+        if self.options["query"] is not None and (
+            self.options["upper_triangle"]
+            or self.options["mirror"]
+            or self.options["ensemble"] > 1
+            or self.options["neighbors"] is not None
+        ):
+            raise ValueError(
+                "query cannot be combined with upper_triangle, mirror, ensemble or neighbors"
+            )
+        if self.options["num_workers"] is not None and self.options["num_workers"] < 1:
+            raise ValueError(
+                f"num_workers must be at least 1, got {self.options['num_workers']}."
+            )
+        # an update scores the changed proteins exactly, which would break
+        # the neighbour structure of an approximate network
+        if self.options["save_dir"] is not None and (
+            self.options["ensemble"] > 1
+            or self.options["query"] is not None
+            or self.options["neighbors"] is not None
+        ):
+            raise ValueError(
+                "save_dir cannot be combined with ensemble, query or neighbors"
+            )
+        # the approximate mode keeps all neighbour pairs unless a count is
+        # given, see `embed`
+        if (
+            self.options["interaction_count"] is None
+            and self.options["neighbors"] is None
+        ):
+            self.options["interaction_count"] = 100000
+        self.callback = callback
+        self.stages = []
+        self.workdir = None
+
+    @contextlib.contextmanager
+    def stage(self, name, items=None, unit="proteins"):
+        """
+        Time the code run in the context as stage `name`. The context value
+        is the report of the stage, whose "items" can be set from within.
+        """
+        record = {"stage": name, "items": items, "unit": unit}
+        start = time.perf_counter()
+        yield record
+        record["seconds"] = time.perf_counter() - start
+        record["items_per_second"] = None
+        if record["items"] and record["seconds"] > 0:
+            record["items_per_second"] = record["items"] / record["seconds"]
+        record["peak_rss_mib"] = _peak_rss_mib()
+        self.stages.append(record)
+
+        message = f" Stage {name}: {record['seconds']:.2f} s"
+        if record["items"] is not None:
+            message += f", {record['items']} {unit}"
+        if record["items_per_second"] is not None:
+            message += f" ({record['items_per_second']:.0f}/s)"
+        if record["peak_rss_mib"] is not None:
+            message += f", peak RSS {record['peak_rss_mib']:.0f} MiB"
+        logging.info(message)
+        if self.callback is not None:
+            self.callback(record)
+
+    def report(self):
+        """
+        Summary of the run: the reports of all stages, their total wall time
+        and the peak resident memory in MiB.
+        """
+        return {
+            "stages": self.stages,
+            "total_seconds": sum(record["seconds"] for record in self.stages),
+            "peak_rss_mib": _peak_rss_mib(),
+        }
+
+    def run(self, data, data_type=None, output="dataframe", output_file=None, **kwargs):
+        """
+        Run all stages on `data`, see `load`.
+
+        Returns the pairs as a DataFrame, or as a sparse matrix with
+        ``output="sparse"``. When `output_file` is given, they are written
+        to it instead and their number is returned; `kwargs` go to `write`.
+        """
+        if output_file is not None:
+            # fail before training rather than when writing
+            output_format = _output_format(output_file, kwargs.get("output_format"))
+            if output_format in ("parquet", "feather"):
+                _import_pyarrow(output_format)
+        try:
+            self.load(data, data_type)
+            self.normalize()
+            self.embed()
+            if output_file is not None:
+                return self.write(output_file, **kwargs)
+            return self.select(output)
+        finally:
+            self.cleanup()
+
+    def load(self, data, data_type=None):
+        """
+        Load stage.
+
+        Parameters
+        ----------
+        data : path, np.ndarray, pd.DataFrame, AnnData, np.memmap or zarr.Array
+            Input data, see `cook`.
+        data_type : str, optional
+            How the command line interface reads the path `data`: "tsv" or
+            "csv" for a delimited text file with one row per protein, "mtx"
+            for a 10x Genomics matrix (see `_load_mtx`) and "h5ad" for an
+            AnnData file read into memory. Sparse matrices stay sparse.
+        """
+        import anndata
+        from scipy.sparse import issparse
+
+        with self.stage("load") as record:
+            if data_type == "h5ad":
+                data = anndata.read_h5ad(data)
+            if data_type in ("tsv", "csv"):
+                x, row_names = _load_data(data, data_type)
+            elif data_type == "mtx":
+                x, row_names = _load_mtx(data)
+            elif _is_out_of_core(data):
+                self.workdir = tempfile.TemporaryDirectory(dir=self.options["temp_dir"])
+                x, row_names = _open_out_of_core(data, self.workdir.name)
+            elif type(data) == anndata._core.anndata.AnnData:
+                # work on a transposed copy, the caller's AnnData is left untouched
+                if issparse(data.X):
+                    x = data.X.T.tocsr().astype(np.float32)
+                else:
+                    x = np.array(data.X.T, dtype=np.float32)
+                row_names = data.var.index.rename(None)
+            else:
+                x = np.array(data, dtype=np.float32)
+                row_names = data.index
+            record["items"] = x.shape[0]
+        self.x, self.row_names = x, row_names
+
+    def normalize(self):
+        """
+        Normalize stage: in place for in-memory data, as a transform applied
+        to every block read for on-disk data.
+        """
+        from scipy.sparse import issparse
+
+        x, options = self.x, self.options
+        items = x.nnz if issparse(x) else x.shape[0] * x.shape[1]
+        with self.stage("normalize", items=items, unit="values"):
+            if self.workdir is None:
+                self.x = _normalize(
+                    x, options["log2_normalization"], options["normalization"]
+                )
+                self.streaming = {}
+                return
+
+            log2_normalization, offset, scale = _row_scale(
+                x, options["log2_normalization"], options["normalization"]
+            )
+            minmax = options["normalization"] == "minmax"
+
+            def transform(block, start):
+                if log2_normalization:
+                    np.log1p(block, out=block)
+                    block /= np.float32(np.log(2))
+                if minmax:
+                    block -= offset[start : start + block.shape[0], None]
+                block *= scale[start : start + block.shape[0], None]
+                return block
+
+            self.streaming = dict(
+                block_rows=options["batch_size"] * 64, transform=transform
+            )
+
+    def embed(self):
+        """
+        Train, encode and score stages (the ensemble stage in ensemble mode),
+        which leave the selected pairs in `rows`, `cols`, `scores` and
+        `columns` (extra per-pair values).
+        """
+        options, x = self.options, self.x
+        if options["interaction_count"] is None:
+            # every protein adds at most `neighbors` unique pairs
+            pair_count = x.shape[0] * options["neighbors"]
+            options["interaction_count"] = (
+                pair_count if options["upper_triangle"] else 2 * pair_count
+            )
+        hidden_layer, latent_dim = _default_dimensions(
+            x.shape[1], options["hidden_layer"], options["latent_dim"]
+        )
+        embed_params = dict(
+            hidden_layer=hidden_layer,
+            latent_dim=latent_dim,
+            **{
+                name: options[name]
+                for name in [
+                    "epochs",
+                    "batch_size",
+                    "cache_dir",
+                    "cache_size",
+                    "num_threads",
+                    "validation_split",
+                    "early_stopping",
+                    "patience",
+                    "min_delta",
+                    "precision",
+                ]
+            },
+            **self.streaming,
+        )
+        if options["save_dir"] is not None:
+            embed_params["model_dir"] = os.path.join(options["save_dir"], "model")
+        score_params = dict(
+            correlation_type=options["correlation_type"],
+            interaction_count=_pair_count(
+                options["interaction_count"], options["upper_triangle"]
+            ),
+            CC_cutoff=options["CC_cutoff"],
+            num_workers=options["num_workers"],
+            neighbors=options["neighbors"],
+            n_trees=options["n_trees"],
+            latent_components=options["latent_components"],
+            dtype=_SCORE_DTYPES[options["precision"]],
+        )
+        workdir = None if self.workdir is None else self.workdir.name
+
+        if options["ensemble"] > 1:
+            with self.stage("ensemble", options["ensemble"], unit="models"):
+                rows, cols, scores, stability = _ensemble_pairs(
+                    x,
+                    options["ensemble"],
+                    embed_params,
+                    score_params,
+                    seed=options["seed"],
+                    ensemble_workers=options["ensemble_workers"],
+                    workdir=workdir,
+                )
+            self.columns = dict(Stability=stability)
+        else:
+            x_test_encoded = _embed(
+                x,
+                seed=options["seed"],
+                workdir=workdir,
+                stage=self.stage,
+                **embed_params,
+            )
+            logging.info(
+                f" Calculating {options['correlation_type']} correlation scores."
+            )
+            n = x.shape[0]
+            if options["query"] is not None:
+                query = _query_indices(self.row_names, options["query"])
+                logging.info(
+                    f" Scoring {len(query)} query proteins against all {n} proteins."
+                )
+                with self.stage("score", len(query) * (n - 1), unit="pairs"):
+                    rows, cols, scores = _query_pairs(
+                        x_test_encoded,
+                        query,
+                        options["correlation_type"],
+                        options["interaction_count"],
+                        options["CC_cutoff"],
+                        latent_components=options["latent_components"],
+                        dtype=score_params["dtype"],
+                    )
+            else:
+                with self.stage("score", n * (n - 1) // 2, unit="pairs"):
+                    rows, cols, scores = _score_pairs(x_test_encoded, **score_params)
+            if options["save_dir"] is not None:
+                with self.stage("save", n):
+                    _save_state(
+                        options["save_dir"],
+                        x_test_encoded,
+                        self.row_names,
+                        rows,
+                        cols,
+                        scores,
+                        options,
+                    )
+            self.columns = {}
+            del x_test_encoded
+        self.rows, self.cols, self.scores = rows, cols, scores
+
+    def update(self):
+        """
+        Update stage, in place of `embed`: encode the loaded proteins with the
+        model saved in the ``save_dir`` option, score them against all saved
+        proteins, splice their pairs into the saved pairs (see
+        `_update_pairs`) and save the result. Loaded proteins with a saved
+        name replace it, the others are added.
+        """
+        from favapy.vae import VAE
+
+        options, x = self.options, self.x
+        save_dir = options["save_dir"]
+        state, saved_encoded, pairs = _load_state(save_dir)
+        vae = VAE.load(os.path.join(save_dir, "model"))
+        if x.shape[1] != vae.original_dim:
+            raise ValueError(
+                f"The updated proteins have {x.shape[1]} columns, the saved model expects {vae.original_dim}."
+            )
+
+        row_names = state["row_names"]
+        positions = {name: i for i, name in enumerate(row_names)}
+        changed = []
+        for name in map(str, self.row_names):
+            if name not in positions:
+                positions[name] = len(row_names)
+                row_names.append(name)
+            changed.append(positions[name])
+        changed = np.array(changed, dtype=np.int64)
+        logging.info(
+            f" Updating {len(changed)} proteins, {len(row_names) - saved_encoded.shape[1]} of them new."
+        )
+
+        with self.stage("encode", items=x.shape[0]):
+            if self.workdir is None:
+                encoded = vae.encode(x, batch_size=options["batch_size"])
+            else:
+                encoded = _encode_into(
+                    vae.encoder,
+                    _row_batches(x, self.streaming["block_rows"], **self.streaming),
+                    np.empty((3, x.shape[0], vae.latent_dim), dtype=vae.latent_dtype),
+                    options["batch_size"],
+                )
+            x_test_encoded = np.empty(
+                (3, len(row_names), vae.latent_dim), dtype=saved_encoded.dtype
+            )
+            x_test_encoded[:, : saved_encoded.shape[1]] = saved_encoded
+            x_test_encoded[:, changed] = encoded
+            del saved_encoded
+
+        n = len(row_names)
+        with self.stage("score", len(changed) * (n - 1), unit="pairs"):
+            rows, cols, scores = _update_pairs(
+                x_test_encoded,
+                changed,
+                pairs,
+                options["correlation_type"],
+                _pair_count(options["interaction_count"], options["upper_triangle"]),
+                options["CC_cutoff"],
+                latent_components=options["latent_components"],
+                dtype=_SCORE_DTYPES[options["precision"]],
+            )
+        with self.stage("save", n):
+            _save_state(
+                save_dir, x_test_encoded, row_names, rows, cols, scores, options
+            )
+        self.row_names = row_names
+        self.rows, self.cols, self.scores, self.columns = rows, cols, scores, {}
+
+    @property
+    def _one_direction(self):
+        # query pairs are reported once, from the query protein to its partner
+        return self.options["upper_triangle"] or self.options["query"] is not None
+
+    def _chunks(self, values, chunk_size=None):
+        options = self.options
+        return _pair_chunks(
+            self.rows,
+            self.cols,
+            values,
+            options["interaction_count"],
+            options["CC_cutoff"],
+            upper_triangle=self._one_direction,
+            mirror=options["mirror"],
+            chunk_size=chunk_size,
+        )
+
+    def select(self, output="dataframe"):
+        """
+        Select stage: the pairs as a DataFrame of protein names, or as a
+        sparse adjacency matrix with ``output="sparse"``, see `cook`.
+        """
+        options = self.options
+        both_directions = not self._one_direction or options["mirror"]
+        with self.stage("select", unit="pairs") as record:
+            if output == "sparse":
+                result = _pairs_adjacency(
+                    self._chunks([self.scores]), len(self.row_names)
+                )
+                record["items"] = result.nnz
+                _log_interactions(result.nnz, options["CC_cutoff"], both_directions)
+            else:
+                correlation = _pairs_frame(
+                    self.rows,
+                    self.cols,
+                    self.scores,
+                    self.row_names,
+                    options["interaction_count"],
+                    options["CC_cutoff"],
+                    upper_triangle=self._one_direction,
+                    mirror=options["mirror"],
+                    **self.columns,
+                )
+                result = _pairs_after_cutoff(
+                    correlation=correlation,
+                    interaction_count=options["interaction_count"],
+                    CC_cutoff=options["CC_cutoff"],
+                    both_directions=both_directions,
+                )
+                record["items"] = len(result)
+        return result
+
+    def write(self, output_file, output_format=None, chunk_size=2**20):
+        """
+        Write stage: write the pairs to `output_file` a chunk at a time, see
+        `_write_pairs`, and return their number.
+        """
+        options = self.options
+        logging.info(
+            " Saving the file with the interactions in the chosen directory ..."
+        )
+        names = ["Score"] + list(self.columns)
+        values = [self.scores] + list(self.columns.values())
+        with self.stage("write", unit="pairs") as record:
+            record["items"] = _write_pairs(
+                self._chunks(values, chunk_size),
+                names,
+                self.row_names,
+                output_file,
+                output_format,
+            )
+        _log_interactions(
+            record["items"],
+            options["CC_cutoff"],
+            both_directions=not self._one_direction or options["mirror"],
+        )
+        return record["items"]
+
+    def cleanup(self):
+        """
+        Release the data and the temporary files of on-disk inputs.
+        """
+        self.x = None
+        if self.workdir is not None:
+            self.workdir.cleanup()
+            self.workdir = None
+
+
+def cook(
+    data,
+    log2_normalization=True,
+    hidden_layer=None,
+    latent_dim=None,
+    epochs=50,
+    batch_size=32,
+    interaction_count=None,
+    correlation_type="pearson",
+    CC_cutoff=None,
+    upper_triangle=False,
+    mirror=False,
+    num_workers=1,
+    temp_dir=None,
+    seed=None,
+    cache_dir=None,
+    cache_size=10 * 2**30,
+    num_threads=None,
+    validation_split=0.0,
+    early_stopping=False,
+    patience=5,
+    min_delta=0.0,
+    ensemble=1,
+    ensemble_workers=None,
+    output="dataframe",
+    varp_key=None,
+    neighbors=None,
+    n_trees=8,
+    latent_components="all",
+    normalization="max",
+    precision="float32",
+    query=None,
+    save_dir=None,
+    callback=None,
+):
+    """
+    Preprocess data, train a Variational Autoencoder (VAE), and create filtered protein pairs.
+
+    Parameters
+    ----------
+    data : np.ndarray, anndata._core.anndata.AnnData, np.memmap, zarr.Array or str
+        Input data or AnnData object. A sparse `.X` stays sparse during
+        preprocessing and training, and the AnnData object is not modified.
+        Backed AnnData objects, memmaps, Zarr arrays and paths to ``.h5ad``,
+        ``.npy`` or Zarr stores are streamed from disk in mini-batches, so
+        the matrix never has to fit in memory. Memmaps, Zarr arrays and
+        ``.npy`` files hold one row per protein.
+    log2_normalization : bool, optional
+        Whether to apply log2 normalization, by default True.
+    hidden_layer : int, optional
+        Number of units in the hidden layer, by default None.
+    latent_dim : int, optional
+        Dimension of the latent space, by default None.
+    epochs : int, optional
+        Number of training epochs, by default 50.
+    batch_size : int, optional
+        Batch size for training, by default 32.
+    interaction_count : int, optional
+        Maximum number of interactions to include, by default 100000, or all
+        the candidate pairs with `neighbors`.
+    correlation_type : str, optional
+        Type of correlation to use (Pearson or Spearman), by default Pearson.
+    CC_cutoff : float, optional
+        Correlation Coefficient cutoff, by default None.
+    upper_triangle : bool, optional
+        Report every pair once (proteinA - proteinB) and count
+        `interaction_count` in unique pairs, by default False.
+    mirror : bool, optional
+        With `upper_triangle`, also report proteinB - proteinA for every
+        selected pair, by default False.
+    num_workers : int, optional
+        Number of processes used to score the protein pairs, by default 1.
+        None uses all available CPUs.
+    temp_dir : str, optional
+        Where on-disk inputs keep their temporary memory-mapped files (the
+        transposed backed AnnData and the latent vectors), by default the
+        system temporary directory.
+    seed : int, optional
+        Seed of the random number generators used for training, by default
+        None.
+    cache_dir : str, optional
+        Directory of an on-disk cache of trained models and their latent
+        spaces, by default None (no caching). Entries are keyed by a hash of
+        the normalized input and by `hidden_layer`, `latent_dim`, `epochs`,
+        `batch_size` and `seed`, so runs that only change the pair selection
+        (`interaction_count`, `CC_cutoff`, `correlation_type`, ...) skip
+        training.
+    cache_size : int, optional
+        Maximum size of the cache in bytes, by default 10 GiB. The least
+        recently used entries are evicted first.
+    num_threads : int or str, optional
+        Number of threads TensorFlow uses within each operation during
+        training, or "auto" for all available cores. By default the value of
+        the ``FAVAPY_NUM_THREADS`` environment variable, or "auto". At most
+        ``min(num_threads, 2)`` operations run at once, as the layers of the
+        VAE run one after another. It can only be changed before TensorFlow
+        starts running in the process.
+    validation_split : float, optional
+        Fraction of the proteins held out to validate the model after every
+        epoch, by default 0 (no validation pass). All proteins are encoded
+        after training.
+    early_stopping : bool, optional
+        Whether to stop training once the loss (the validation loss if
+        `validation_split` is set) stops improving, by default False. The
+        weights of the best epoch are kept and `epochs` becomes an upper
+        bound.
+    patience : int, optional
+        Number of epochs without improvement before stopping early, by
+        default 5.
+    min_delta : float, optional
+        Minimum decrease of the loss counted as an improvement, by default 0.
+    ensemble : int, optional
+        Number of VAEs trained with consecutive seeds (starting at `seed`)
+        whose networks are merged, by default 1. Every model selects its own
+        pairs; the "Score" of a pair is then its score averaged over all the
+        models, counting 0 for the models that did not select it, and the
+        additional "Stability" column holds the number of models that
+        selected it.
+    ensemble_workers : int, optional
+        Number of ensemble models trained at once in separate processes, by
+        default as many as the models and CPUs allow. On-disk inputs train
+        one model at a time.
+    output : str, optional
+        "dataframe" (default) returns the pairs as a DataFrame of protein
+        names. "sparse" returns them as a `scipy.sparse.csr_matrix` whose
+        rows and columns follow the order of the input proteins, with the
+        scores as float32 values (about 8 bytes per pair instead of the
+        Python strings of the DataFrame).
+    varp_key : str, optional
+        With ``output="sparse"`` and AnnData input, also store the matrix in
+        ``data.varp[varp_key]``. This is the only case where `data` is
+        modified.
+    neighbors : int, optional
+        Approximate mode for very large numbers of proteins: only the pairs
+        of every protein with its `neighbors` most correlated proteins are
+        candidates, found with a forest of random projection trees on the
+        latent spaces instead of scoring all pairs. Unless `interaction_count`
+        or `CC_cutoff` is given, all these pairs are returned. By default None
+        (exact).
+    n_trees : int, optional
+        Number of random projection trees in approximate mode, by default 8.
+        More trees find more of the exact neighbours and take longer.
+    latent_components : str, optional
+        Latent components of every protein that are correlated: "mean" (the
+        latent means only, 3 times cheaper to score), "mean_sigma" (the means
+        and the log-sigmas) or "all" (default, also the sampled vectors).
+    normalization : str, optional
+        How every protein is scaled after the optional log2 transform: "max"
+        (default) divides it by its maximum, "minmax" scales it to [0, 1] as
+        the command line interface does by default.
+    precision : str, optional
+        "float32" (default) trains the VAE in float32 and computes the
+        correlations in float64. "mixed_float16" and "mixed_bfloat16" train
+        it with the Keras mixed precision policy of that name, keep the
+        latent spaces in float16 (also in the cache) and compute the
+        correlations in float32, which halves the memory and bandwidth of
+        the latent matrix at the cost of small changes in the scores, see
+        ``benchmarks/bench_precision.py``.
+    query : list of str, optional
+        Names of the proteins of interest. Only their correlations with all
+        proteins are computed (``Q x N`` instead of ``N x N``), and every
+        query protein gets its best `interaction_count` partners, or all its
+        partners above `CC_cutoff`. The pairs are grouped by query protein,
+        in the order of `query`, with the query protein as "Protein_1".
+        Unknown names are skipped with a warning. Cannot be combined with
+        `upper_triangle`, `mirror`, `ensemble` or `neighbors`.
+    save_dir : str, optional
+        Directory where the trained model, the latent spaces, the selected
+        pairs and the options of the run are saved, so that `update` can
+        later add or replace proteins without training again. By default
+        nothing is saved. Cannot be combined with `ensemble`, `query` or
+        `neighbors`.
+    callback : callable, optional
+        Called with the report of every stage of the run (wall time, peak
+        memory and throughput), see `Pipeline`.
+
+    Returns
+    -------
+    final_pairs : pd.DataFrame or scipy.sparse.csr_matrix
+        Filtered protein pairs based on correlation and cutoffs.
+    """
+    import anndata
+
+    if output not in ("dataframe", "sparse"):
+        raise ValueError(f"Unknown output: {output}")
+    if precision not in _SCORE_DTYPES:
+        raise ValueError(f"Unknown precision: {precision}")
+    if varp_key is not None and (
+        output != "sparse" or not isinstance(data, anndata.AnnData)
+    ):
+        raise ValueError('varp_key requires AnnData input and output="sparse"')
+
+    pipeline = Pipeline(
+        callback=callback,
+        log2_normalization=log2_normalization,
+        normalization=normalization,
+        hidden_layer=hidden_layer,
+        latent_dim=latent_dim,
+        epochs=epochs,
+        batch_size=batch_size,
         interaction_count=interaction_count,
+        correlation_type=correlation_type,
         CC_cutoff=CC_cutoff,
+        upper_triangle=upper_triangle,
+        mirror=mirror,
+        num_workers=num_workers,
+        temp_dir=temp_dir,
+        seed=seed,
+        cache_dir=cache_dir,
+        cache_size=cache_size,
+        num_threads=num_threads,
+        validation_split=validation_split,
+        early_stopping=early_stopping,
+        patience=patience,
+        min_delta=min_delta,
+        ensemble=ensemble,
+        ensemble_workers=ensemble_workers,
+        neighbors=neighbors,
+        n_trees=n_trees,
+        latent_components=latent_components,
+        precision=precision,
+        query=query,
+        save_dir=save_dir,
     )
+    final_pairs = pipeline.run(data, output=output)
+    if varp_key is not None:
+        data.varp[varp_key] = final_pairs
     return final_pairs
 
 
-def main():
+def update(
+    save_dir,
+    data,
+    data_type=None,
+    output="dataframe",
+    output_file=None,
+    output_format=None,
+    callback=None,
+):
     """
-    Main function for preprocessing data, training VAE, and saving results.
+    Update a network saved with ``cook(save_dir=...)`` with new or changed proteins.
+
+    Only the proteins in `data` are encoded, with the saved model, and only
+    their correlations with all proteins are computed. Their pairs replace
+    their previous pairs in the saved selection, while the pairs of the other
+    proteins are kept as they are. With a `CC_cutoff` the result is the
+    network a full run would select from the same latent spaces. With
+    `interaction_count`, a pair of two unchanged proteins that was not
+    selected before is not scored again, so when pairs of changed proteins
+    drop out of the selection, the pairs that would have replaced them are
+    missing (and the network can hold fewer pairs) until the next full run.
+    The updated latent spaces and pairs are saved back to `save_dir`.
 
-    This function loads data, applies preprocessing, trains a Variational Autoencoder (VAE),
-    calculates correlation scores between encoded latent spaces, filters protein pairs based
-    on correlation and cutoffs, and finally saves the results to a file.
+    Parameters
+    ----------
+    save_dir : str
+        Directory of the saved run.
+    data : np.ndarray, pd.DataFrame, AnnData or str
+        New or changed proteins, with the same samples as the saved run,
+        see `cook`. Proteins with a saved name replace it, the others are
+        added. They are normalized with the options of the saved run.
+    data_type : str, optional
+        How a path `data` is read, see `Pipeline.load`.
+    output : str, optional
+        "dataframe" (default) or "sparse", see `cook`.
+    output_file : str, optional
+        Write the pairs to this file instead and return their number, see
+        the ``-f`` option of the command line interface for the formats.
+    output_format : str, optional
+        Format of `output_file`, by default inferred from its extension.
+    callback : callable, optional
+        Called with the report of every stage, see `Pipeline`.
+
+    Returns
+    -------
+    final_pairs : pd.DataFrame, scipy.sparse.csr_matrix or int
+        All pairs of the updated network, selected with the options of the
+        saved run, or their number when written to `output_file`.
     """
-    args = argument_parser()
+    if output not in ("dataframe", "sparse"):
+        raise ValueError(f"Unknown output: {output}")
+    with open(os.path.join(save_dir, "state.json")) as infile:
+        options = json.load(infile)["options"]
+    options["save_dir"] = save_dir
+
+    pipeline = Pipeline(callback=callback, **options)
+    try:
+        pipeline.load(data, data_type)
+        pipeline.normalize()
+        pipeline.update()
+        if output_file is not None:
+            return pipeline.write(output_file, output_format)
+        return pipeline.select(output)
+    finally:
+        pipeline.cleanup()
+
+
+def _read_query(query_file):
+    """
+    Read the protein names of a query file: the first field of every line,
+    skipping empty lines and lines starting with #.
+    """
+    with open(query_file) as infile:
+        return [
+            line.split()[0]
+            for line in infile
+            if line.strip() and not line.startswith("#")
+        ]
 
-    x, row_names = _load_data(args.input_file, args.data_type)
-    original_dim = x.shape[1]
 
-    if args.hidden_layer == None:
-        if original_dim >= 2000:
-            args.hidden_layer = 1000
-        if original_dim > 500 and original_dim < 2000:
-            args.hidden_layer = 500
-        if original_dim <= 500:
-            args.hidden_layer = 50
-
-    if args.latent_dim == None:
-        if args.hidden_layer >= 1000:
-            args.latent_dim = 100
-        if args.hidden_layer >= 500 and args.hidden_layer < 1000:
-            args.latent_dim = 50
-        if args.hidden_layer <= 500:
-            args.latent_dim = 5
-
-    opt = tf.keras.optimizers.Adam(learning_rate=0.001, clipnorm=0.001)
-    x_train = x_test = np.array(x)
-    vae = VAE(
-        opt,
-        x_train,
-        x_test,
-        args.batch_size,
-        original_dim,
-        args.hidden_layer,
-        args.latent_dim,
-        args.epochs,
-    )
-    x_test_encoded = np.array(vae.encoder.predict(x_test, batch_size=args.batch_size))
-
-    logging.info(f" Calculating {args.correlation_type} correlation scores.")
-    correlation = _create_protein_pairs(
-        x_test_encoded, row_names, args.correlation_type
-    )
-
-    final_pairs = correlation[correlation.iloc[:, 0] != correlation.iloc[:, 1]]
-    final_pairs = final_pairs.sort_values(by=["Score"], ascending=False)
-    final_pairs = _pairs_after_cutoff(
-        correlation=final_pairs,
+def _run_cli(args):
+    """
+    Run the pipeline on the parsed arguments of the command line interface
+    and return it with the number of interactions written.
+    """
+    pipeline = Pipeline(
+        normalization=args.normalization,
+        hidden_layer=args.hidden_layer,
+        latent_dim=args.latent_dim,
+        epochs=args.epochs,
+        batch_size=args.batch_size,
         interaction_count=args.interaction_count,
+        correlation_type=args.correlation_type,
         CC_cutoff=args.CC_cutoff,
+        upper_triangle=args.upper_triangle,
+        mirror=args.mirror,
+        num_workers=args.num_workers,
+        seed=args.seed,
+        cache_dir=args.cache_dir,
+        num_threads=args.num_threads,
+        validation_split=args.validation_split,
+        early_stopping=args.early_stopping,
+        patience=args.patience,
+        min_delta=args.min_delta,
+        ensemble=args.ensemble,
+        ensemble_workers=args.ensemble_workers,
+        neighbors=args.neighbors,
+        n_trees=args.n_trees,
+        latent_components=args.latent_components,
+        precision=args.precision,
+        query=None if args.query is None else _read_query(args.query),
+        save_dir=args.save_dir,
+    )
+    count = pipeline.run(
+        args.input_file,
+        data_type=args.data_type,
+        output_file=args.output_file,
+        output_format=args.output_format,
     )
-    final_pairs.Score = final_pairs.Score.astype(float).round(5)
     logging.warn(
         " If it is not the desired cut-off, please check again the value assigned to the related parameter (-n or interaction_count | -c or CC_cutoff)."
     )
+    logging.info(
+        " Congratulations! A file is waiting for you here: " + args.output_file
+    )
+    if args.profile is not None:
+        with open(args.profile, "w") as outfile:
+            json.dump(pipeline.report(), outfile, indent=2)
+        logging.info(" The profile of the run is saved here: " + args.profile)
+    return pipeline, count
+
+
+def batch_argument_parser(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="favapy batch",
+        description="Run the favapy jobs listed in a manifest in one pool of processes, which import TensorFlow and build every model shape only once.",
+        epilog="Any other argument of favapy applies to every job; the arguments of a manifest line override it.",
+    )
+    parser.add_argument(
+        "manifest",
+        type=str,
+        help="Tab-separated file with one job per line: the input file, the output file and optionally more favapy arguments for this job. Empty lines and lines starting with # are skipped.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of jobs run at once in separate processes.",
+    )
+    parser.add_argument(
+        "--threads_per_job",
+        type=int,
+        default=None,
+        help="Number of TensorFlow and BLAS threads of every job. Defaults to the number of cores divided by --jobs.",
+    )
+    parser.add_argument(
+        "--report",
+        type=str,
+        default=None,
+        help="Path of a JSON summary of the jobs: status, interactions, wall time, peak memory and errors.",
+    )
+    return parser.parse_known_args(argv)
+
+
+def update_argument_parser(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="favapy update",
+        description="Add or replace proteins in a network saved with --save_dir: only these proteins are encoded, with the saved model, and scored against all proteins.",
+    )
+    parser.add_argument(
+        "save_dir", type=str, help="Directory of the run saved with --save_dir."
+    )
+    parser.add_argument(
+        "input_file",
+        type=str,
+        help="The absolute path of the new or changed proteins, with the same samples as the saved run.",
+    )
+    parser.add_argument(
+        "output_file",
+        type=str,
+        help="The absolute path where the updated network will be saved",
+    )
+    parser.add_argument(
+        "-t",
+        "--data_type",
+        type=str,
+        default="tsv",
+        choices=["tsv", "csv", "mtx", "h5ad"],
+        help="Type of input data, as for favapy.",
+    )
+    parser.add_argument(
+        "-f",
+        "--output_format",
+        type=str,
+        default=None,
+        choices=["txt", "tsv", "parquet", "feather", "npz"],
+        help="Format of the output file, as for favapy.",
+    )
+    return parser.parse_args(argv)
+
+
+def _read_manifest(manifest):
+    """
+    Read the command line arguments of every job of a batch manifest.
+    """
+    jobs = []
+    with open(manifest) as infile:
+        for number, line in enumerate(infile, 1):
+            if not line.strip() or line.startswith("#"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 2:
+                raise ValueError(
+                    f"Line {number} of {manifest} needs an input and an output file."
+                )
+            jobs.append(
+                fields[:2] + [arg for field in fields[2:] for arg in shlex.split(field)]
+            )
+    return jobs
+
+
+def _init_batch_worker(num_threads=None):
+    """
+    Prepare a process to run batch jobs: import TensorFlow once, limit its
+    threads and the BLAS threads, and keep the models for reuse.
+    """
+    global _model_pool
+    if num_threads is not None:
+        os.environ["FAVAPY_NUM_THREADS"] = str(num_threads)
+        try:
+            from threadpoolctl import threadpool_limits
+
+            threadpool_limits(num_threads)
+        except ImportError:
+            pass
+    _configure_threads(num_threads)
+    _model_pool = {}
+
+
+@contextlib.contextmanager
+def _batch_in_process(num_threads=None):
+    """
+    Prepare the current process to run batch jobs as `_init_batch_worker`
+    prepares a pool process, and restore ``FAVAPY_NUM_THREADS``, the BLAS
+    thread limits and the model pool afterwards.
+    """
+    global _model_pool
+    previous = os.environ.get("FAVAPY_NUM_THREADS")
+    limits = contextlib.nullcontext()
+    try:
+        if num_threads is not None:
+            os.environ["FAVAPY_NUM_THREADS"] = str(num_threads)
+            try:
+                from threadpoolctl import threadpool_limits
+
+                limits = threadpool_limits(num_threads)
+            except ImportError:
+                pass
+        with limits:
+            _configure_threads(num_threads)
+            _model_pool = {}
+            yield
+    finally:
+        _model_pool = None
+        if previous is None:
+            os.environ.pop("FAVAPY_NUM_THREADS", None)
+        else:
+            os.environ["FAVAPY_NUM_THREADS"] = previous
+
+
+def _batch_job(job):
+    """
+    Run one batch job and return its summary. Errors are reported in the
+    summary instead of stopping the batch.
+    """
+    index, argv, in_pool = job
+    result = dict(
+        job=index,
+        input_file=argv[0],
+        output_file=argv[1],
+        status="done",
+        interactions=None,
+        reused_model=False,
+        error=None,
+    )
+    start = time.perf_counter()
+    try:
+        args = argument_parser(argv)
+        if in_pool:
+            # pool processes cannot start pools of their own
+            args.num_workers = args.ensemble_workers = 1
+        pipeline, result["interactions"] = _run_cli(args)
+        result["reused_model"] = any(
+            record.get("reused_model") for record in pipeline.stages
+        )
+    except SystemExit:
+        # argparse already printed the usage
+        result["status"] = "failed"
+        result["error"] = "Invalid arguments: " + " ".join(argv[2:])
+        logging.warn(f" Job {index} ({argv[0]}) failed: {result['error']}")
+    except Exception as error:
+        result["status"] = "failed"
+        result["error"] = f"{type(error).__name__}: {error}"
+        logging.warn(f" Job {index} ({argv[0]}) failed: {result['error']}")
+    result["seconds"] = time.perf_counter() - start
+    result["peak_rss_mib"] = _peak_rss_mib()
+    return result
+
+
+def run_batch(manifest, jobs=1, threads_per_job=None, common_args=(), report=None):
+    """
+    Run the jobs of a batch manifest, see `favapy batch --help`.
+
+    Every process imports TensorFlow once and keeps the models it builds:
+    a later job with the same model shape resets and trains one of them
+    instead of building and compiling a new one. Jobs run in one process
+    share its random number generators, so a seeded job can differ from the
+    same job run on its own.
+
+    Parameters
+    ----------
+    manifest : str
+        Tab-separated file with one job per line: the input file, the output
+        file and optionally more command line arguments of the job.
+    jobs : int, optional
+        Number of jobs run at once in a pool of processes, by default 1 (in
+        the current process).
+    threads_per_job : int, optional
+        Number of TensorFlow and BLAS threads of every job, by default the
+        number of cores divided by `jobs` (all of them when `jobs` is 1).
+        With `jobs` 1 the BLAS limits and ``FAVAPY_NUM_THREADS`` are restored
+        when the batch ends, but TensorFlow keeps its thread pools for the
+        life of the process once it has started.
+    common_args : sequence of str, optional
+        Command line arguments of every job, overridden by the arguments of
+        its manifest line.
+    report : str, optional
+        Path of a JSON summary of the batch.
+
+    Returns
+    -------
+    summary : dict
+        Summary of every job (its status, number of interactions, wall time,
+        peak memory, whether it reused a model and its error), the total
+        wall time and the number of failed jobs.
+    """
+    start = time.perf_counter()
+    tasks = [
+        (index, argv[:2] + list(common_args) + argv[2:], jobs > 1)
+        for index, argv in enumerate(_read_manifest(manifest))
+    ]
+    if threads_per_job is None and jobs > 1:
+        threads_per_job = max(1, os.cpu_count() // jobs)
 
-    logging.info(" Saving the file with the interactions in the chosen directory ...")
+    if jobs == 1:
+        with _batch_in_process(threads_per_job):
+            results = [_batch_job(task) for task in tasks]
+    else:
+        with mp.get_context("spawn").Pool(
+            processes=jobs,
+            initializer=_init_batch_worker,
+            initargs=(threads_per_job,),
+        ) as pool:
+            results = sorted(
+                pool.imap_unordered(_batch_job, tasks, chunksize=1),
+                key=lambda result: result["job"],
+            )
 
-    # Save the file
-    np.savetxt(args.output_file, final_pairs, fmt="%s")
+    summary = {
+        "jobs": results,
+        "total_seconds": time.perf_counter() - start,
+        "failed": sum(result["status"] == "failed" for result in results),
+    }
     logging.info(
-        " Congratulations! A file is waiting for you here: " + args.output_file
+        f" Batch of {len(results)} jobs finished in {summary['total_seconds']:.1f} s, "
+        f"{summary['failed']} failed, "
+        f"{sum(result['reused_model'] for result in results)} reused a model."
     )
+    for result in results:
+        logging.info(
+            f" Job {result['job']}: {result['status']} in {result['seconds']:.1f} s, "
+            f"{result['interactions']} interactions, {result['input_file']}"
+        )
+    if report is not None:
+        with open(report, "w") as outfile:
+            json.dump(summary, outfile, indent=2)
+        logging.info(" The summary of the batch is saved here: " + str(report))
+    return summary
+
+
+def main():
+    """
+    Main function for preprocessing data, training VAE, and saving results.
+
+    This function loads data, applies preprocessing, trains a Variational Autoencoder (VAE),
+    calculates correlation scores between encoded latent spaces, filters protein pairs based
+    on correlation and cutoffs, and finally saves the results to a file.
+
+    ``favapy batch`` runs the jobs of a manifest instead, see `run_batch`, and
+    ``favapy update`` updates a saved network, see `update`.
+    """
+    if sys.argv[1:2] == ["batch"]:
+        args, common_args = batch_argument_parser(sys.argv[2:])
+        summary = run_batch(
+            args.manifest,
+            jobs=args.jobs,
+            threads_per_job=args.threads_per_job,
+            common_args=common_args,
+            report=args.report,
+        )
+        sys.exit(int(summary["failed"] > 0))
+    if sys.argv[1:2] == ["update"]:
+        args = update_argument_parser(sys.argv[2:])
+        update(
+            args.save_dir,
+            args.input_file,
+            data_type=args.data_type,
+            output_file=args.output_file,
+            output_format=args.output_format,
+        )
+        logging.info(
+            " Congratulations! The updated network is waiting for you here: "
+            + args.output_file
+        )
+        return
+    _run_cli(argument_parser())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,353 @@
+import json
+import os
+
+import keras
+import numpy as np
+import tensorflow as tf
+from keras import layers
+from scipy.sparse import issparse
+
+from favapy._batches import _encode_into, _row_batches
+
+
+class Sampling(layers.Layer):
+    """
+    Draw latent vectors from the Gaussian defined by ``(z_mean, z_log_sigma)``
+    with the reparameterization trick.
+
+    The noise comes from a seed generator of the layer rather than the
+    stateful TensorFlow generator, which XLA compiled steps do not seed, so
+    ``tf.keras.utils.set_random_seed`` makes the draws reproducible.
+    """
+
+    def __init__(self, seed=None, **kwargs):
+        super(Sampling, self).__init__(**kwargs)
+        self.seed_generator = keras.random.SeedGenerator(seed)
+
+    def call(self, inputs):
+        z_mean, z_log_sigma = inputs
+        epsilon = keras.random.normal(
+            shape=tf.shape(z_mean), mean=0.0, stddev=0.1, seed=self.seed_generator
+        )
+        return z_mean + tf.exp(z_log_sigma) * epsilon
+
+
+class VAE(keras.Model):
+    """
+    Variational Autoencoder model class.
+
+    Building the model does not train it: use `fit` (or `partial_fit` to
+    continue training), `encode` to compute the latent spaces of any data
+    with the same number of features, `save`/`load` to reuse a trained
+    model and `reset` to train it again from scratch.
+
+    Training uses a custom `train_step` that only computes the VAE objective
+    (0.9 * reconstruction + 0.1 * KL divergence) and reports its terms as the
+    ``loss``, ``reconstruction_loss`` and ``kl_loss`` metrics.
+
+    Parameters
+    ----------
+    original_dim : int
+        Dimension of the input data.
+    hidden_layer : int
+        Number of units in the hidden layer.
+    latent_dim : int
+        Dimension of the latent space.
+    opt : tf.keras.optimizers.Optimizer, optional
+        Optimizer for the model, by default Adam with a learning rate of
+        0.001 and a clipnorm of 0.001.
+    jit_compile : bool, optional
+        Whether to compile the training and evaluation steps with XLA, by
+        default True.
+    precision : str, optional
+        "float32" (default), or the Keras mixed precision policy
+        "mixed_float16" or "mixed_bfloat16": the hidden layers then compute
+        in 16 bits while the weights, the latent layers, the output layer
+        and the losses stay in float32. With "mixed_float16" the optimizer
+        scales the loss to keep small gradients from underflowing. `encode`
+        returns float16 latent spaces for the mixed policies, half the size
+        of float32 ones (numpy has no bfloat16 type).
+    """
+
+    def __init__(
+        self,
+        original_dim,
+        hidden_layer,
+        latent_dim,
+        opt=None,
+        jit_compile=True,
+        precision="float32",
+        **kwargs,
+    ):
+        super(VAE, self).__init__(**kwargs)
+        self.original_dim = original_dim
+        self.hidden_layer = hidden_layer
+        self.latent_dim = latent_dim
+        self.precision = precision
+        self.latent_dtype = np.float32 if precision == "float32" else np.float16
+
+        # hidden layers follow the policy, the latent and output layers
+        # stay in float32 for numerically stable losses
+        policy = keras.mixed_precision.Policy(precision)
+        inputs = keras.Input(shape=(original_dim,))
+        h = layers.Dense(hidden_layer, activation="relu", dtype=policy)(inputs)
+
+        z_mean = layers.Dense(latent_dim, dtype="float32")(h)
+        z_log_sigma = layers.Dense(latent_dim, dtype="float32")(h)
+        z = Sampling(dtype="float32")([z_mean, z_log_sigma])
+
+        # Create encoder
+        encoder = keras.Model(inputs, [z_mean, z_log_sigma, z], name="encoder")
+        self.encoder = encoder
+        # Create decoder
+        latent_inputs = keras.Input(shape=(latent_dim,), name="z_sampling")
+        x = layers.Dense(hidden_layer, activation="relu", dtype=policy)(
+            latent_inputs
+        )  # relu
+
+        outputs = layers.Dense(original_dim, activation="sigmoid", dtype="float32")(x)
+        decoder = keras.Model(latent_inputs, outputs, name="decoder")
+        self.decoder = decoder
+
+        self.loss_tracker = keras.metrics.Mean(name="loss")
+        self.reconstruction_loss_tracker = keras.metrics.Mean(
+            name="reconstruction_loss"
+        )
+        self.kl_loss_tracker = keras.metrics.Mean(name="kl_loss")
+
+        if opt is None:
+            opt = tf.keras.optimizers.Adam(learning_rate=0.001, clipnorm=0.001)
+        if precision == "mixed_float16" and not isinstance(
+            opt, keras.mixed_precision.LossScaleOptimizer
+        ):
+            opt = keras.mixed_precision.LossScaleOptimizer(opt)
+        self.compile(optimizer=opt, jit_compile=jit_compile)
+
+    @property
+    def metrics(self):
+        return [
+            self.loss_tracker,
+            self.reconstruction_loss_tracker,
+            self.kl_loss_tracker,
+        ]
+
+    def call(self, inputs):
+        return self.decoder(self.encoder(inputs)[2])
+
+    def _vae_losses(self, x, training=False):
+        """
+        Compute the VAE objective and its reconstruction and KL terms.
+        """
+        z_mean, z_log_sigma, z = self.encoder(x, training=training)
+        outputs = self.decoder(z, training=training)
+
+        reconstruction_loss = tf.reduce_mean(tf.square(x - outputs), axis=-1)
+        reconstruction_loss *= self.original_dim
+        kl_loss = 1 + z_log_sigma - tf.square(z_mean) - tf.exp(z_log_sigma)
+        kl_loss = -0.5 * tf.reduce_sum(kl_loss, axis=-1)
+        vae_loss = tf.reduce_mean(0.9 * reconstruction_loss + 0.1 * kl_loss)
+        return vae_loss, reconstruction_loss, kl_loss
+
+    def _track_losses(self, vae_loss, reconstruction_loss, kl_loss):
+        self.loss_tracker.update_state(vae_loss)
+        self.reconstruction_loss_tracker.update_state(reconstruction_loss)
+        self.kl_loss_tracker.update_state(kl_loss)
+        return {metric.name: metric.result() for metric in self.metrics}
+
+    def train_step(self, data):
+        x, _, _ = tf.keras.utils.unpack_x_y_sample_weight(data)
+        with tf.GradientTape() as tape:
+            losses = self._vae_losses(x, training=True)
+            # a LossScaleOptimizer scales the loss here and unscales the
+            # gradients in apply_gradients, other optimizers leave it as is
+            loss = self.optimizer.scale_loss(losses[0])
+        gradients = tape.gradient(loss, self.trainable_weights)
+        self.optimizer.apply_gradients(zip(gradients, self.trainable_weights))
+        return self._track_losses(*losses)
+
+    def test_step(self, data):
+        x, _, _ = tf.keras.utils.unpack_x_y_sample_weight(data)
+        return self._track_losses(*self._vae_losses(x))
+
+    def get_config(self):
+        return {
+            "original_dim": self.original_dim,
+            "hidden_layer": self.hidden_layer,
+            "latent_dim": self.latent_dim,
+            "precision": self.precision,
+        }
+
+    def fit(self, x, batch_size=32, epochs=50, validation_data=None, **kwargs):
+        """
+        Train the model.
+
+        Parameters
+        ----------
+        x : np.ndarray or tf.data.Dataset
+            Training data, or a dataset of batches.
+        batch_size : int, optional
+            Batch size for training, by default 32. Ignored for datasets.
+        epochs : int, optional
+            Number of training epochs, by default 50.
+        validation_data : np.ndarray or tf.data.Dataset, optional
+            Data evaluated at the end of every epoch, by default None.
+        **kwargs
+            Passed to `keras.Model.fit`.
+
+        Returns
+        -------
+        history : keras.callbacks.History
+        """
+        if isinstance(x, tf.data.Dataset):
+            batch_size = None
+        if validation_data is not None and not isinstance(
+            validation_data, tf.data.Dataset
+        ):
+            validation_data = (validation_data,)
+        return super(VAE, self).fit(
+            x,
+            batch_size=batch_size,
+            epochs=epochs,
+            validation_data=validation_data,
+            **kwargs,
+        )
+
+    def partial_fit(self, x, batch_size=32, epochs=1, **kwargs):
+        """
+        Continue training from the current weights, e.g. on updated samples.
+
+        The optimizer continues from its current state too, including after
+        `load` when the model was saved after training.
+
+        Parameters
+        ----------
+        x : np.ndarray or tf.data.Dataset
+            Training data, or a dataset of batches.
+        batch_size : int, optional
+            Batch size for training, by default 32.
+        epochs : int, optional
+            Number of additional training epochs, by default 1.
+        **kwargs
+            Passed to `fit`.
+
+        Returns
+        -------
+        history : keras.callbacks.History
+        """
+        return self.fit(x, batch_size=batch_size, epochs=epochs, **kwargs)
+
+    def reset(self):
+        """
+        Draw new initial weights and clear the optimizer state and the
+        metrics, so that the model can be trained from scratch on other data
+        of the same shape without building it again. The traced (and XLA
+        compiled) training step is kept.
+
+        The weights are drawn by new initializers and the sampling noise is
+        reseeded, as when building the model, so after
+        ``tf.keras.utils.set_random_seed`` the model trains as one built with
+        that seed.
+        """
+        for layer in self.encoder.layers + self.decoder.layers:
+            for name in ("kernel", "bias"):
+                weight = getattr(layer, name, None)
+                if weight is not None:
+                    initializer = getattr(layer, name + "_initializer")
+                    initializer = initializer.from_config(initializer.get_config())
+                    weight.assign(initializer(weight.shape, dtype=weight.dtype))
+            if isinstance(layer, Sampling):
+                reseeded = keras.random.SeedGenerator()
+                layer.seed_generator.state.assign(reseeded.state.value)
+        # the loss scale of a LossScaleOptimizer keeps adapting as it is
+        optimizer = getattr(self.optimizer, "inner_optimizer", self.optimizer)
+        for variable in optimizer.variables:
+            # the step count and the moments, not the learning rate variable
+            if variable is not optimizer.learning_rate:
+                variable.assign(tf.zeros_like(variable))
+        for metric in self.metrics:
+            metric.reset_state()
+
+    def encode(self, x, batch_size=32):
+        """
+        Compute the latent spaces of the rows of `x`.
+
+        Parameters
+        ----------
+        x : np.ndarray, scipy.sparse.csr_matrix or tf.data.Dataset
+            Data with one row per protein and `original_dim` columns.
+        batch_size : int, optional
+            Batch size for encoding, by default 32.
+
+        Returns
+        -------
+        x_encoded : np.ndarray
+            Array of shape ``(3, rows, latent_dim)`` holding the latent means,
+            the latent log-sigmas and the sampled latent vectors, in float32
+            (float16 with a mixed precision policy).
+        """
+        if isinstance(x, tf.data.Dataset):
+            return np.stack(self.encoder.predict(x)).astype(self.latent_dtype)
+        # encode blocks of rows straight into one buffer of the latent type
+        block_rows = 64 * batch_size
+        if issparse(x):
+            blocks = _row_batches(x, block_rows)
+        else:
+            blocks = (x[i : i + block_rows] for i in range(0, x.shape[0], block_rows))
+        encoded = np.empty((3, x.shape[0], self.latent_dim), dtype=self.latent_dtype)
+        return _encode_into(self.encoder, blocks, encoded, batch_size)
+
+    def save(self, filepath, overwrite=True, **kwargs):
+        """
+        Save the architecture, the weights and the optimizer state (step
+        count and moments) of the model to a directory.
+
+        Parameters
+        ----------
+        filepath : str
+            Directory to write to. It is created if needed.
+        overwrite : bool, optional
+            Whether to overwrite an existing model, by default True.
+        """
+        if not overwrite and os.path.exists(os.path.join(filepath, "config.json")):
+            raise FileExistsError(f"A model is already saved in {filepath}")
+        os.makedirs(filepath, exist_ok=True)
+        with open(os.path.join(filepath, "config.json"), "w") as outfile:
+            json.dump(self.get_config(), outfile)
+        self.encoder.save_weights(os.path.join(filepath, "encoder.weights.h5"))
+        self.decoder.save_weights(os.path.join(filepath, "decoder.weights.h5"))
+        optimizer = getattr(self.optimizer, "inner_optimizer", self.optimizer)
+        np.savez(
+            os.path.join(filepath, "optimizer.npz"),
+            *[variable.numpy() for variable in optimizer.variables],
+        )
+
+    @classmethod
+    def load(cls, filepath):
+        """
+        Load a model saved with `save`, with its optimizer state so that
+        `partial_fit` resumes the training.
+
+        Parameters
+        ----------
+        filepath : str
+            Directory the model was saved to.
+
+        Returns
+        -------
+        vae : VAE
+        """
+        with open(os.path.join(filepath, "config.json")) as infile:
+            vae = cls(**json.load(infile))
+        vae.encoder.load_weights(os.path.join(filepath, "encoder.weights.h5"))
+        vae.decoder.load_weights(os.path.join(filepath, "decoder.weights.h5"))
+        # models saved before training, or by older versions, have no state
+        state_path = os.path.join(filepath, "optimizer.npz")
+        optimizer = getattr(vae.optimizer, "inner_optimizer", vae.optimizer)
+        if os.path.exists(state_path):
+            with np.load(state_path) as state:
+                values = [state[f"arr_{i}"] for i in range(len(state.files))]
+            if len(values) > 1:
+                optimizer.build(vae.trainable_weights)
+            for variable, value in zip(optimizer.variables, values):
+                variable.assign(value)
+        return vae
@@ -1,6 +1,13 @@
+import gzip
+import json
 import os
+import subprocess
+import sys
+import numpy as np
 import pandas as pd
 import pytest
+import anndata
+from scipy import sparse
 from pathlib import Path
 
 from favapy import fava
@@ -32,3 +39,808 @@ def test_favapy(test_dataset):
         interaction_count=100,
     )
     return FAVA_network
+
+
+def test_create_protein_pairs_matches_dense_correlation():
+    rng = np.random.default_rng(0)
+    x_test_encoded = rng.normal(size=(3, 40, 5)).astype(np.float32)
+    row_names = [f"P{i}" for i in range(40)]
+
+    latent = np.concatenate(list(x_test_encoded), axis=1)
+    expected = np.corrcoef(latent)
+    np.fill_diagonal(expected, -np.inf)
+    expected = np.sort(expected.ravel())[::-1][:50]
+
+    pairs = fava._create_protein_pairs(
+        x_test_encoded, row_names, interaction_count=50, block_size=7
+    )
+    assert list(pairs.columns) == ["Protein_1", "Protein_2", "Score"]
+    assert len(pairs) == 50
+    assert (pairs.Protein_1 != pairs.Protein_2).all()
+    np.testing.assert_allclose(pairs.Score.to_numpy(), expected, rtol=1e-6)
+
+    above = fava._create_protein_pairs(
+        x_test_encoded, row_names, CC_cutoff=0.5, block_size=7
+    )
+    assert (above.Score >= 0.5).all()
+    assert len(above) == np.count_nonzero(np.corrcoef(latent) >= 0.5) - 40
+
+
+def test_create_protein_pairs_upper_triangle():
+    rng = np.random.default_rng(1)
+    x_test_encoded = rng.normal(size=(3, 30, 4)).astype(np.float32)
+    row_names = [f"P{i}" for i in range(30)]
+
+    pairs = fava._create_protein_pairs(
+        x_test_encoded, row_names, interaction_count=20, upper_triangle=True
+    )
+    assert len(pairs) == 20
+    index = {name: i for i, name in enumerate(row_names)}
+    assert all(index[a] < index[b] for a, b in zip(pairs.Protein_1, pairs.Protein_2))
+
+    both = fava._create_protein_pairs(x_test_encoded, row_names, interaction_count=40)
+    np.testing.assert_allclose(both.Score.to_numpy()[::2], pairs.Score.to_numpy())
+
+    mirrored = fava._create_protein_pairs(
+        x_test_encoded,
+        row_names,
+        interaction_count=20,
+        upper_triangle=True,
+        mirror=True,
+    )
+    assert len(mirrored) == 40
+    assert list(mirrored.Protein_1[1::2]) == list(pairs.Protein_2)
+
+
+def test_zero_interaction_count_selects_no_pairs():
+    rng = np.random.default_rng(4)
+    x_test_encoded = rng.normal(size=(3, 50, 4))
+    row_names = [f"P{i}" for i in range(50)]
+
+    pairs = fava._create_protein_pairs(
+        x_test_encoded, row_names, interaction_count=0, upper_triangle=True
+    )
+    assert len(pairs) == 0
+    for kwargs in ({"num_workers": 2, "block_size": 8}, {"neighbors": 5}):
+        rows, _, _ = fava._score_pairs(x_test_encoded, interaction_count=0, **kwargs)
+        assert len(rows) == 0
+
+
+def test_create_protein_pairs_spearman_matches_pandas():
+    rng = np.random.default_rng(2)
+    # rounding creates ties, which must get their average rank
+    x_test_encoded = rng.normal(size=(3, 25, 4)).round(1)
+    row_names = [f"P{i}" for i in range(25)]
+
+    latent = np.concatenate(list(x_test_encoded), axis=1)
+    expected = pd.DataFrame(latent.T).corr(method="spearman").to_numpy()
+    expected = np.sort(expected[np.triu_indices(25, k=1)])[::-1][:30]
+
+    pairs = fava._create_protein_pairs(
+        x_test_encoded,
+        row_names,
+        correlation_type="spearman",
+        interaction_count=30,
+        block_size=4,
+        upper_triangle=True,
+    )
+    np.testing.assert_allclose(pairs.Score.to_numpy(), expected, rtol=1e-10)
+
+
+def test_create_protein_pairs_parallel_matches_serial():
+    rng = np.random.default_rng(3)
+    x_test_encoded = rng.normal(size=(3, 50, 4))
+    row_names = [f"P{i}" for i in range(50)]
+    blas_variables = fava._BLAS_THREAD_VARIABLES
+    blas_env = {name: os.environ.get(name) for name in blas_variables}
+
+    serial = fava._create_protein_pairs(
+        x_test_encoded, row_names, interaction_count=60, upper_triangle=True
+    )
+    parallel = fava._create_protein_pairs(
+        x_test_encoded,
+        row_names,
+        interaction_count=60,
+        upper_triangle=True,
+        block_size=8,
+        num_workers=2,
+    )
+    np.testing.assert_allclose(parallel.Score, serial.Score, rtol=1e-10)
+    assert list(parallel.Protein_1) == list(serial.Protein_1)
+
+    above = fava._create_protein_pairs(
+        x_test_encoded, row_names, CC_cutoff=0.3, block_size=8, num_workers=2
+    )
+    assert len(above) == np.count_nonzero(
+        np.corrcoef(np.concatenate(list(x_test_encoded), axis=1)) >= 0.3
+    ) - len(row_names)
+    # the BLAS limits of the workers do not leak into this process
+    assert {name: os.environ.get(name) for name in blas_variables} == blas_env
+
+    with pytest.raises(ValueError, match="num_workers"):
+        fava._create_protein_pairs(x_test_encoded, row_names, num_workers=0)
+
+
+def test_latent_components_select_the_encoder_outputs():
+    rng = np.random.default_rng(3)
+    encoded = rng.normal(size=(3, 25, 4)).astype(np.float32)
+
+    latent = fava._latent_matrix(encoded, "mean_sigma")
+    assert latent.flags.c_contiguous and latent.dtype == np.float64
+    np.testing.assert_array_equal(latent, np.concatenate(encoded[:2], axis=1))
+    np.testing.assert_array_equal(
+        fava._latent_matrix(encoded), np.concatenate(encoded, axis=1)
+    )
+
+    mean_only = fava._score_pairs(
+        encoded, interaction_count=30, latent_components="mean"
+    )
+    expected = fava._score_pairs(encoded[:1], interaction_count=30)
+    for found, exact in zip(mean_only, expected):
+        np.testing.assert_array_equal(found, exact)
+
+
+def test_query_pairs_score_only_the_query_rows():
+    rng = np.random.default_rng(6)
+    encoded = rng.normal(size=(3, 40, 4))
+    correlation = np.corrcoef(np.concatenate(encoded, axis=1))
+    np.fill_diagonal(correlation, -np.inf)
+    query = np.array([7, 2])
+
+    rows, cols, scores = fava._query_pairs(
+        encoded, query, interaction_count=5, block_size=1
+    )
+    assert list(rows) == [7] * 5 + [2] * 5
+    for i in query:
+        expected = np.sort(correlation[i])[::-1][:5]
+        np.testing.assert_allclose(scores[rows == i], expected, rtol=1e-10)
+        np.testing.assert_allclose(correlation[i, cols[rows == i]], expected)
+
+    rows, cols, scores = fava._query_pairs(encoded, query, CC_cutoff=0.2)
+    assert len(rows) == np.count_nonzero(correlation[query] >= 0.2)
+
+    data = pd.DataFrame(
+        rng.poisson(3, size=(30, 12)), index=[f"G{i}" for i in range(30)]
+    )
+    pairs = fava.cook(
+        data, epochs=1, batch_size=8, interaction_count=4, query=["G3", "X", "G0"]
+    )
+    assert list(pairs.Protein_1) == ["G3"] * 4 + ["G0"] * 4
+    assert (pairs.Protein_2 != pairs.Protein_1).all()
+    with pytest.raises(ValueError):
+        fava.cook(data, query=["G3"], upper_triangle=True)
+
+
+def test_approximate_neighbors_recall_the_exact_pairs():
+    rng = np.random.default_rng(5)
+    centres = rng.normal(size=(20, 6))
+    latent = centres[rng.integers(0, 20, size=1000)] + 0.3 * rng.normal(size=(1000, 6))
+    z = fava._standardize_rows(latent)
+
+    indices, scores = fava._approximate_neighbors(z, neighbors=5, n_trees=16)
+    assert indices.shape == scores.shape == (1000, 5)
+    assert (indices != np.arange(1000)[:, None]).all()
+    np.testing.assert_allclose(
+        scores, np.einsum("ij,ikj->ik", z, z[indices]), rtol=1e-6, atol=1e-12
+    )
+
+    rows, cols, scores = fava._score_pairs(
+        [latent], interaction_count=200, neighbors=5, n_trees=16
+    )
+    exact_rows, exact_cols, _ = fava._score_pairs([latent], interaction_count=200)
+    assert (rows < cols).all()
+    assert np.all(np.diff(scores) <= 0)
+    recall = len(set(zip(rows, cols)) & set(zip(exact_rows, exact_cols))) / 200
+    assert recall > 0.9
+
+
+def test_cook_neighbors_keeps_every_neighbour_pair():
+    rng = np.random.default_rng(6)
+    data = pd.DataFrame(
+        rng.poisson(3, size=(40, 12)), index=[f"G{i}" for i in range(40)]
+    )
+    assert fava.Pipeline().options["interaction_count"] == 100000
+    assert fava.Pipeline(neighbors=3).options["interaction_count"] is None
+
+    params = dict(epochs=1, batch_size=8, neighbors=3, upper_triangle=True, seed=0)
+    pairs = fava.cook(data, **params)
+    # the 3 neighbours of every protein are kept, mutual neighbours once
+    degree = pd.concat([pairs.Protein_1, pairs.Protein_2]).value_counts()
+    assert len(degree) == 40 and (degree >= 3).all()
+    assert 60 <= len(pairs) <= 120
+    assert len(fava.cook(data, interaction_count=5, **params)) == 5
+
+
+def test_load_data_streams_plain_and_gzip_files(tmp_path):
+    rng = np.random.default_rng(4)
+    values = rng.poisson(3, size=(23, 6)).astype(np.float32)
+    lines = ["gene," + ",".join(f"c{j}" for j in range(6))]
+    lines += [f"G{i}," + ",".join(map(str, row)) for i, row in enumerate(values)]
+    text = "\n".join(lines) + "\n"
+    (tmp_path / "data.csv").write_text(text)
+    with gzip.open(tmp_path / "data.csv.gz", "wt") as outfile:
+        outfile.write(text)
+
+    expected = np.log2(1 + values)
+    low = expected.min(axis=1, keepdims=True)
+    high = expected.max(axis=1, keepdims=True)
+    expected = (expected - low) / (high - low + 1e-8)
+
+    for name in ["data.csv", "data.csv.gz"]:
+        expr, row_names = fava._load_data(tmp_path / name, "csv", chunk_size=5)
+        assert expr.dtype == np.float32
+        assert row_names == [f"G{i}" for i in range(23)]
+        np.testing.assert_array_equal(expr, values)
+        fava._normalize(expr, normalization="minmax", chunk_size=5)
+        np.testing.assert_allclose(expr, expected, atol=1e-6)
+
+
+def test_cli_reads_10x_mtx_and_h5ad_inputs_as_sparse(tmp_path):
+    from scipy.io import mmwrite
+
+    rng = np.random.default_rng(11)
+    counts = sparse.random(25, 40, density=0.2, format="csr", random_state=11)
+    counts.data = rng.poisson(4, size=counts.nnz).astype(np.float32) + 1
+    # gene symbols repeat, e.g. Gene3 is also the symbol of the last gene
+    symbols = [f"Gene{i}" for i in range(24)] + ["Gene3"]
+    genes = [f"ENSG{i}\t{symbol}" for i, symbol in enumerate(symbols)]
+    tenx = tmp_path / "10x"
+    tenx.mkdir()
+    with gzip.open(tenx / "matrix.mtx.gz", "wb") as outfile:
+        mmwrite(outfile, counts)
+    with gzip.open(tenx / "features.tsv.gz", "wt") as outfile:
+        outfile.write("\n".join(genes) + "\n")
+    (tenx / "barcodes.tsv").write_text("\n".join(f"B{j}" for j in range(40)))
+
+    expr, row_names = fava._load_mtx(str(tenx))
+    assert sparse.isspmatrix_csr(expr) and expr.dtype == np.float32
+    assert (expr != counts).nnz == 0
+    assert row_names == [f"Gene{i}" for i in range(24)] + ["Gene3-1"]
+
+    adata = anndata.AnnData(X=counts.T.tocsr())
+    adata.var.index = row_names
+    adata.write_h5ad(tmp_path / "counts.h5ad")
+    for data_type, path in [("mtx", tenx), ("h5ad", tmp_path / "counts.h5ad")]:
+        output = tmp_path / f"{data_type}.tsv"
+        subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "favapy.fava",
+                str(path),
+                str(output),
+                "-t",
+                data_type,
+                "-e",
+                "1",
+                "-n",
+                "10",
+            ],
+            check=True,
+            capture_output=True,
+        )
+        pairs = pd.read_csv(output, sep="\t")
+        assert len(pairs) == 10
+        assert pairs["Protein_1"].isin(adata.var.index).all()
+
+
+def test_normalize_sparse_matches_dense():
+    rng = np.random.default_rng(5)
+    dense = rng.poisson(0.5, size=(12, 30)).astype(np.float32)
+    dense[3] = 0
+    expected = fava._normalize(dense.copy())
+    normalized = fava._normalize(sparse.csr_matrix(dense))
+    assert sparse.issparse(normalized)
+    np.testing.assert_allclose(normalized.toarray(), expected, rtol=1e-6)
+
+
+def test_cook_keeps_sparse_anndata_unchanged():
+    rng = np.random.default_rng(6)
+    counts = sparse.random(40, 20, density=0.3, format="csr", random_state=6)
+    counts.data = rng.poisson(5, size=counts.nnz).astype(np.float32) + 1
+    adata = anndata.AnnData(X=counts.copy())
+    adata.var.index = [f"G{i}" for i in range(20)]
+
+    pairs = fava.cook(adata, epochs=1, batch_size=8, interaction_count=10)
+    assert len(pairs) == 10
+    assert sparse.issparse(adata.X)
+    assert (adata.X != counts).nnz == 0
+
+
+def test_cook_returns_sparse_adjacency_in_varp(tmp_path):
+    rng = np.random.default_rng(8)
+    adata = anndata.AnnData(X=rng.poisson(4, size=(40, 20)).astype(np.float32))
+    adata.var.index = [f"G{i}" for i in range(20)]
+    params = dict(epochs=1, batch_size=8, interaction_count=11, seed=0)
+
+    pairs = fava.cook(adata, cache_dir=tmp_path, **params)
+    adjacency = fava.cook(
+        adata, cache_dir=tmp_path, output="sparse", varp_key="fava", **params
+    )
+    assert adjacency is adata.varp["fava"]
+    assert adjacency.shape == (20, 20)
+    assert adjacency.dtype == np.float32 and adjacency.indices.dtype == np.int32
+    assert adjacency.nnz == len(pairs) == 11
+
+    index = {name: i for i, name in enumerate(adata.var.index)}
+    for protein_1, protein_2, score in pairs.itertuples(index=False):
+        assert adjacency[index[protein_1], index[protein_2]] == pytest.approx(score)
+
+    with pytest.raises(ValueError):
+        fava.cook(adata.to_df().T, varp_key="fava", output="sparse")
+
+
+def test_cook_streams_out_of_core_inputs(tmp_path):
+    rng = np.random.default_rng(7)
+    counts = rng.poisson(2, size=(30, 16)).astype(np.float32)
+
+    np.save(tmp_path / "x.npy", counts.T)
+    x = np.load(tmp_path / "x.npy", mmap_mode="r")
+    log2_normalization, offset, scale = fava._row_scale(x)
+    assert log2_normalization
+    assert not offset.any()
+    streamed = np.concatenate(
+        list(
+            fava._row_batches(
+                x,
+                4,
+                block_rows=5,
+                transform=lambda block, start: np.log2(1 + block)
+                * scale[start : start + len(block), None],
+            )
+        )
+    )
+    np.testing.assert_allclose(
+        streamed, fava._normalize(counts.T.copy()), rtol=1e-6, atol=1e-7
+    )
+    _, offset, scale = fava._row_scale(x, normalization="minmax")
+    np.testing.assert_allclose(
+        (np.log2(1 + counts.T) - offset[:, None]) * scale[:, None],
+        fava._normalize(counts.T.copy(), normalization="minmax"),
+        rtol=1e-6,
+        atol=1e-7,
+    )
+
+    adata = anndata.AnnData(X=counts)
+    adata.var.index = [f"G{i}" for i in range(16)]
+    adata.write_h5ad(tmp_path / "counts.h5ad")
+    for data in [
+        str(tmp_path / "x.npy"),
+        anndata.read_h5ad(tmp_path / "counts.h5ad", backed="r"),
+    ]:
+        pairs = fava.cook(
+            data, epochs=1, batch_size=4, interaction_count=6, temp_dir=tmp_path
+        )
+        assert len(pairs) == 6
+    assert set(pairs.Protein_1) <= set(adata.var.index)
+
+
+def test_vae_fit_encode_save_load(tmp_path):
+    rng = np.random.default_rng(8)
+    x = rng.uniform(size=(20, 12)).astype(np.float32)
+
+    vae = fava.VAE(original_dim=12, hidden_layer=6, latent_dim=3)
+    vae.fit(x, batch_size=8, epochs=1, verbose=0)
+    vae.partial_fit(x[:5], batch_size=8, verbose=0)
+    encoded = vae.encode(x, batch_size=8)
+    assert encoded.shape == (3, 20, 3)
+
+    vae.save(tmp_path / "model")
+    loaded = fava.VAE.load(tmp_path / "model")
+    np.testing.assert_allclose(loaded.encode(x)[0], encoded[0], rtol=1e-5)
+
+    # the loaded optimizer resumes where the saved one stopped
+    for saved, restored in zip(vae.optimizer.variables, loaded.optimizer.variables):
+        np.testing.assert_array_equal(restored.numpy(), saved.numpy())
+    assert len(loaded.optimizer.variables) > 1
+    loaded.partial_fit(x, batch_size=8, verbose=0)
+    assert int(loaded.optimizer.iterations) == int(vae.optimizer.iterations) + 3
+
+
+def test_seeded_fits_give_identical_encodings():
+    import tensorflow as tf
+
+    rng = np.random.default_rng(12)
+    x = rng.uniform(size=(40, 12)).astype(np.float32)
+
+    encodings = []
+    for _ in range(2):
+        tf.keras.utils.set_random_seed(0)
+        vae = fava.VAE(12, 6, 3)
+        vae.fit(x, batch_size=8, epochs=2, verbose=0)
+        encodings.append(vae.encode(x, batch_size=8))
+    np.testing.assert_array_equal(encodings[0], encodings[1])
+
+
+def test_mixed_precision_stores_float16_latent_spaces(tmp_path):
+    rng = np.random.default_rng(9)
+    x = rng.uniform(size=(40, 12)).astype(np.float32)
+
+    vae = fava.VAE(12, 6, 3, precision="mixed_float16")
+    history = vae.fit(x, batch_size=8, epochs=2, verbose=0)
+    assert np.isfinite(history.history["loss"]).all()
+    encoded = vae.encode(x, batch_size=8)
+    assert encoded.dtype == np.float16 and encoded.shape == (3, 40, 3)
+
+    vae.save(tmp_path / "model")
+    assert fava.VAE.load(tmp_path / "model").precision == "mixed_float16"
+
+    # float32 accumulation of float16 latent spaces stays close to float64
+    rows, cols, scores = fava._score_pairs(encoded, dtype=np.float32)
+    assert scores.dtype == np.float32
+    exact = np.corrcoef(fava._latent_matrix(encoded))[rows, cols]
+    np.testing.assert_allclose(scores, exact, atol=1e-5)
+
+
+def test_cook_reuses_cached_embedding(tmp_path, monkeypatch):
+    rng = np.random.default_rng(9)
+    data = pd.DataFrame(
+        rng.poisson(3, size=(30, 12)), index=[f"G{i}" for i in range(30)]
+    )
+    cache_dir = tmp_path / "cache"
+    first = fava.cook(
+        data, epochs=1, batch_size=8, interaction_count=10, seed=0, cache_dir=cache_dir
+    )
+    assert len(os.listdir(cache_dir)) == 1
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the cached embedding should be reused")
+
+    monkeypatch.setattr(fava.VAE, "fit", fail)
+    second = fava.cook(
+        data,
+        epochs=1,
+        batch_size=8,
+        interaction_count=20,
+        seed=0,
+        cache_dir=cache_dir,
+    )
+    pd.testing.assert_frame_equal(second.iloc[:10], first)
+
+
+def test_update_splices_changed_proteins_into_saved_network(tmp_path, monkeypatch):
+    rng = np.random.default_rng(14)
+    data = pd.DataFrame(
+        rng.poisson(3, size=(30, 12)), index=[f"G{i}" for i in range(30)]
+    )
+    save_dir = tmp_path / "saved"
+    fava.cook(data, epochs=1, batch_size=8, CC_cutoff=0.5, seed=0, save_dir=save_dir)
+    before = np.load(save_dir / "encoded.npy")
+
+    def fail(*args, **kwargs):
+        raise AssertionError("an update should not train the model")
+
+    monkeypatch.setattr(fava.VAE, "fit", fail)
+    changed = pd.DataFrame(
+        rng.poisson(3, size=(2, 12)), index=["G4", "NEW"], columns=data.columns
+    )
+    updated = fava.update(save_dir, changed)
+
+    encoded = np.load(save_dir / "encoded.npy")
+    assert encoded.shape == (3, 31, before.shape[2])
+    unchanged = [i for i in range(30) if i != 4]
+    np.testing.assert_array_equal(encoded[:, unchanged], before[:, unchanged])
+    # with a cut-off, the update selects what a full scoring would
+    names = [f"G{i}" for i in range(30)] + ["NEW"]
+    expected = fava._pairs_frame(
+        *fava._score_pairs(encoded, CC_cutoff=0.5), names, CC_cutoff=0.5
+    )
+    assert set(zip(updated.Protein_1, updated.Protein_2)) == set(
+        zip(expected.Protein_1, expected.Protein_2)
+    )
+    assert "NEW" in set(updated.Protein_1)
+
+
+def test_update_rejects_approximate_networks(tmp_path):
+    rng = np.random.default_rng(15)
+    data = pd.DataFrame(
+        rng.poisson(3, size=(30, 12)), index=[f"G{i}" for i in range(30)]
+    )
+    params = dict(epochs=1, batch_size=8, seed=0)
+    with pytest.raises(ValueError, match="neighbors"):
+        fava.cook(data, neighbors=3, save_dir=tmp_path / "approximate", **params)
+
+    # a state saved in approximate mode cannot be updated either
+    save_dir = tmp_path / "saved"
+    fava.cook(data, save_dir=save_dir, **params)
+    with open(save_dir / "state.json") as infile:
+        state = json.load(infile)
+    state["options"]["neighbors"] = 3
+    with open(save_dir / "state.json", "w") as outfile:
+        json.dump(state, outfile)
+    with pytest.raises(ValueError, match="neighbors"):
+        fava.update(save_dir, data.iloc[:1])
+
+
+def test_consensus_pairs_average_members_and_count_stability():
+    members = [
+        (np.array([0, 0]), np.array([1, 2]), np.array([0.9, 0.6])),
+        (np.array([0, 1]), np.array([1, 2]), np.array([0.7, 0.8])),
+    ]
+    rows, cols, scores, stability = fava._consensus_pairs(members, 3, 2)
+    np.testing.assert_array_equal(rows, [0, 1])
+    np.testing.assert_array_equal(cols, [1, 2])
+    np.testing.assert_allclose(scores, [0.8, 0.4])
+    np.testing.assert_array_equal(stability, [2, 1])
+
+    rows, cols, scores, stability = fava._consensus_pairs(members, 3, CC_cutoff=0.3)
+    np.testing.assert_allclose(scores, [0.8, 0.4, 0.3])
+    np.testing.assert_array_equal(stability, [2, 1, 1])
+
+
+def test_cook_ensemble_trains_seeded_models_in_parallel(tmp_path):
+    rng = np.random.default_rng(4)
+    data = pd.DataFrame(
+        rng.poisson(3, size=(30, 12)), index=[f"G{i}" for i in range(30)]
+    )
+    network = fava.cook(
+        data,
+        epochs=1,
+        batch_size=8,
+        interaction_count=20,
+        seed=0,
+        cache_dir=tmp_path,
+        ensemble=3,
+        ensemble_workers=2,
+    )
+    assert list(network.columns) == ["Protein_1", "Protein_2", "Score", "Stability"]
+    assert len(network) == 20
+    assert network["Stability"].between(1, 3).all()
+    assert network["Score"].is_monotonic_decreasing
+    # one cached model per seed
+    assert len(os.listdir(tmp_path)) == 3
+
+
+def _selected_pairs():
+    rows, cols = np.array([0, 1, 0]), np.array([2, 2, 1])
+    return rows, cols, np.array([0.9, 0.5, 0.2]), np.array(["a", "b", "c"])
+
+
+def test_write_pairs_text_and_npz_in_chunks(tmp_path):
+    rows, cols, scores, names = _selected_pairs()
+    expected = fava._pairs_frame(rows, cols, scores, names, interaction_count=5)
+
+    def chunks():
+        return fava._pair_chunks(
+            rows, cols, [scores], interaction_count=5, chunk_size=1
+        )
+
+    assert fava._write_pairs(chunks(), ["Score"], names, tmp_path / "out.txt") == 5
+    text = pd.read_csv(tmp_path / "out.txt", sep=" ", header=None)
+    np.testing.assert_array_equal(text.values, expected.values)
+
+    fava._write_pairs(chunks(), ["Score"], names, tmp_path / "out.tsv.gz")
+    with gzip.open(tmp_path / "out.tsv.gz", "rt") as handle:
+        pd.testing.assert_frame_equal(pd.read_csv(handle, sep="\t"), expected)
+
+    fava._write_pairs(chunks(), ["Score"], names, tmp_path / "out.npz")
+    adjacency = sparse.load_npz(tmp_path / "out.npz")
+    np.testing.assert_allclose(
+        adjacency.toarray(), [[0, 0.2, 0.9], [0, 0, 0.5], [0.9, 0.5, 0]]
+    )
+    np.testing.assert_array_equal(np.load(tmp_path / "out.npz")["names"], names)
+
+
+@pytest.mark.parametrize("output_format", ["parquet", "feather"])
+def test_write_pairs_arrow_formats(tmp_path, output_format):
+    pytest.importorskip("pyarrow")
+    rows, cols, scores, names = _selected_pairs()
+    expected = fava._pairs_frame(
+        rows, cols, scores, names, upper_triangle=True, Stability=np.array([3, 2, 1])
+    )
+    chunks = fava._pair_chunks(
+        rows, cols, [scores, np.array([3, 2, 1])], upper_triangle=True, chunk_size=2
+    )
+    path = tmp_path / f"out.{output_format}"
+    fava._write_pairs(chunks, ["Score", "Stability"], names, path)
+
+    written = getattr(pd, f"read_{output_format}")(path)
+    assert isinstance(written["Protein_1"].dtype, pd.CategoricalDtype)
+    pd.testing.assert_frame_equal(
+        written.astype({"Protein_1": object, "Protein_2": object}), expected
+    )
+
+
+def test_arrow_formats_name_the_extra_without_pyarrow(tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, "pyarrow", None)
+    rows, cols, scores, names = _selected_pairs()
+    chunks = fava._pair_chunks(rows, cols, [scores], upper_triangle=True)
+    with pytest.raises(ImportError, match=r"favapy\[parquet\]"):
+        fava._write_pairs(chunks, ["Score"], names, tmp_path / "out.parquet")
+    # a run fails before training
+    with pytest.raises(ImportError, match="feather"):
+        fava.Pipeline().run(
+            pd.DataFrame(np.ones((4, 3))), output_file=tmp_path / "out.feather"
+        )
+
+
+def test_configure_threads_from_argument_and_environment():
+    script = (
+        "import tensorflow as tf; from favapy import fava; "
+        "assert tf.config.threading.get_intra_op_parallelism_threads() == 0; "
+        "fava._configure_threads({!r}); "
+        "print(tf.config.threading.get_intra_op_parallelism_threads())"
+    )
+    env = dict(os.environ, FAVAPY_NUM_THREADS="3")
+    for argument, expected in [(None, "3"), (2, "2"), ("auto", "0")]:
+        result = subprocess.run(
+            [sys.executable, "-c", script.format(argument)],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        assert result.stdout.strip() == expected
+
+
+def test_import_and_help_stay_within_startup_budget():
+    benchmark = Path(__file__).parents[1] / "benchmarks" / "bench_startup.py"
+    result = subprocess.run(
+        [sys.executable, str(benchmark), "--repeat", "1", "--import-budget", "3"],
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stdout
+
+
+def test_benchmark_suite_reports_every_stage(tmp_path):
+    benchmark = Path(__file__).parents[1] / "benchmarks" / "bench_suite.py"
+    subprocess.run(
+        [
+            sys.executable,
+            str(benchmark),
+            "--cases",
+            "sparse-1k",
+            "--tolerance",
+            "1000",
+            "--memory-tolerance",
+            "1000",
+            "--output",
+            str(tmp_path / "report.json"),
+        ],
+        check=True,
+        capture_output=True,
+    )
+    with open(tmp_path / "report.json") as infile:
+        report = json.load(infile)
+    stages = [stage["stage"] for stage in report["cases"]["sparse-1k"]]
+    assert stages == [
+        "load",
+        "normalize",
+        "train",
+        "encode",
+        "score",
+        "select",
+        "correlation",
+    ]
+    assert report["regressions"] == []
+
+
+def test_embed_holds_out_validation_rows_and_stops_early(monkeypatch):
+    rng = np.random.default_rng(10)
+    x = rng.uniform(size=(40, 12)).astype(np.float32)
+    histories = []
+    fit = fava.VAE.fit
+
+    def recording_fit(self, *args, **kwargs):
+        history = fit(self, *args, verbose=0, **kwargs)
+        histories.append(history.history)
+        return history
+
+    monkeypatch.setattr(fava.VAE, "fit", recording_fit)
+    for data in [x, sparse.csr_matrix(x)]:
+        encoded = fava._embed(
+            data,
+            6,
+            2,
+            epochs=20,
+            batch_size=8,
+            validation_split=0.25,
+            early_stopping=True,
+            patience=1,
+            min_delta=1e9,
+        )
+        assert encoded.shape == (3, 40, 2)
+        assert len(histories[-1]["val_loss"]) == 2
+
+    fava._embed(x, 6, 2, epochs=2, batch_size=8)
+    assert "val_loss" not in histories[-1]
+
+
+def test_pipeline_reports_stages_to_callback_and_profile(tmp_path):
+    rng = np.random.default_rng(12)
+    data = pd.DataFrame(
+        rng.poisson(3, size=(30, 12)), index=[f"G{i}" for i in range(30)]
+    )
+    reports = []
+    fava.cook(
+        data, epochs=2, batch_size=8, interaction_count=10, callback=reports.append
+    )
+    assert [report["stage"] for report in reports] == [
+        "load",
+        "normalize",
+        "train",
+        "encode",
+        "score",
+        "select",
+    ]
+    assert reports[2]["items"] == 2 * 30 and reports[2]["unit"] == "samples"
+    assert reports[4]["items"] == 30 * 29 // 2
+    assert all(report["seconds"] >= 0 for report in reports)
+
+    data.to_csv(tmp_path / "data.tsv", sep="\t")
+    subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "favapy.fava",
+            str(tmp_path / "data.tsv"),
+            str(tmp_path / "pairs.txt"),
+            "-e",
+            "1",
+            "-n",
+            "10",
+            "--profile",
+            str(tmp_path / "profile.json"),
+        ],
+        check=True,
+        capture_output=True,
+    )
+    with open(tmp_path / "profile.json") as infile:
+        profile = json.load(infile)
+    assert [stage["stage"] for stage in profile["stages"]][-1] == "write"
+    assert profile["stages"][-1]["items"] == 10
+    assert profile["peak_rss_mib"] > 0
+
+
+def test_batch_reuses_models_and_isolates_failures(tmp_path, monkeypatch):
+    rng = np.random.default_rng(13)
+    for name in ("a", "b"):
+        pd.DataFrame(
+            rng.poisson(3, size=(25, 10)), index=[f"G{i}" for i in range(25)]
+        ).to_csv(tmp_path / f"{name}.tsv", sep="\t")
+    manifest = tmp_path / "manifest.tsv"
+    manifest.write_text(
+        "# input\toutput\targuments\n"
+        f"{tmp_path / 'a.tsv'}\t{tmp_path / 'a.txt'}\n"
+        f"{tmp_path / 'missing.tsv'}\t{tmp_path / 'missing.txt'}\n"
+        f"{tmp_path / 'b.tsv'}\t{tmp_path / 'b.txt'}\t-n 6\n"
+    )
+
+    # keep the reused model with its weights right after the reset
+    reused = []
+    pooled_vae = fava._pooled_vae
+
+    def recording_pooled_vae(*args):
+        vae = pooled_vae(*args)
+        if vae is not None:
+            reused.append((vae, [weight.numpy() for weight in vae.trainable_weights]))
+        return vae
+
+    monkeypatch.setattr(fava, "_pooled_vae", recording_pooled_vae)
+    monkeypatch.setenv("FAVAPY_NUM_THREADS", "auto")
+    summary = fava.run_batch(
+        str(manifest),
+        threads_per_job=2,
+        common_args=["-e", "3", "-n", "10", "--seed", "0"],
+        report=tmp_path / "r.json",
+    )
+    # the thread settings of the calling process are restored
+    assert os.environ["FAVAPY_NUM_THREADS"] == "auto"
+    assert [job["status"] for job in summary["jobs"]] == ["done", "failed", "done"]
+    assert [job["interactions"] for job in summary["jobs"]] == [10, None, 6]
+    assert "FileNotFoundError" in summary["jobs"][1]["error"]
+    # the second job of the same shape trains the model of the first one
+    assert [job["reused_model"] for job in summary["jobs"]] == [False, False, True]
+    # and the reset model trains: its weights change and its loss drops
+    ((vae, reset_weights),) = reused
+    assert float(vae.optimizer.learning_rate) == pytest.approx(0.001)
+    assert all(
+        not np.array_equal(weight.numpy(), reset)
+        for weight, reset in zip(vae.trainable_weights, reset_weights)
+    )
+    loss = vae.history.history["loss"]
+    assert loss[-1] < loss[0]
+    assert summary["failed"] == 1 and fava._model_pool is None
+    with open(tmp_path / "r.json") as infile:
+        assert json.load(infile)["jobs"][2]["output_file"] == str(tmp_path / "b.txt")